@@ -0,0 +1,104 @@
+import os
+import re
+from datetime import datetime, timedelta, timezone
+
+from reconcile import extract_amount_simple
+from payment_index import open_payments, is_open
+
+# Second-chance matcher for SMS that don't contain the buyer's M-Pesa number
+# (paid from another phone, masked number). Candidates are the open payments
+# whose expected or remaining amount equals the SMS amount (within
+# AMOUNT_MATCH_TOLERANCE cents), taken from the amount-sorted open payments
+# index and created within AMOUNT_MATCH_WINDOW seconds before the SMS arrived.
+#
+# Each candidate is scored on amount, recency and whether the buyer's name
+# appears in the SMS. The best one only wins if it scores at least
+# AMOUNT_MATCH_MIN_SCORE and beats the runner-up by AMOUNT_MATCH_MARGIN;
+# anything ambiguous is left for ops rather than credited to a guess.
+
+AMOUNT_MATCH_WINDOW = int(os.environ.get("AMOUNT_MATCH_WINDOW", 6 * 3600))
+AMOUNT_MATCH_TOLERANCE = int(os.environ.get("AMOUNT_MATCH_TOLERANCE", 0))
+AMOUNT_MATCH_MIN_SCORE = float(os.environ.get("AMOUNT_MATCH_MIN_SCORE", 0.6))
+AMOUNT_MATCH_MARGIN = float(os.environ.get("AMOUNT_MATCH_MARGIN", 0.2))
+MAX_CANDIDATE_ROWS = 5
+
+# Clock skew allowed between the payment row and the SMS timestamp
+CLOCK_SKEW = timedelta(minutes=5)
+
+
+def parse_time(value):
+    """
+    ISO timestamp from Supabase as an aware UTC datetime (naive means UTC), or None.
+    """
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def name_in_sms(buyer_name, msg):
+    words = [word for word in re.findall(r"[A-Za-z]+", buyer_name or "") if len(word) > 1]
+    if not words:
+        return 0.0
+    text = msg.upper()
+    return sum(1 for word in words if word.upper() in text) / len(words)
+
+
+def score_candidate(record, row, paid_cents, sms_time, msg):
+    remaining = record.amount - record.amount_paid
+    difference = min(abs(remaining - paid_cents), abs(record.amount - paid_cents))
+    amount_score = 1.0 if difference == 0 else 1.0 - difference / (AMOUNT_MATCH_TOLERANCE + 1)
+
+    created = parse_time(record.timestampz)
+    age = (sms_time - created).total_seconds() if created else AMOUNT_MATCH_WINDOW
+    recency_score = 1.0 - max(0.0, age) / AMOUNT_MATCH_WINDOW
+
+    return 0.5 * amount_score + 0.2 * recency_score + 0.3 * name_in_sms(row.get("buyer_name"), msg)
+
+
+def match_by_amount(supabase, sms_row):
+    """
+    The open payment an SMS most plausibly pays, or None if there is no clear winner.
+    """
+    msg = sms_row.get("message") or ""
+    paid_amount = extract_amount_simple(msg)
+    if paid_amount is None or not open_payments.ready:
+        return None
+
+    sms_time = parse_time(sms_row.get("created_at")) or datetime.now(timezone.utc)
+    earliest = sms_time - timedelta(seconds=AMOUNT_MATCH_WINDOW)
+
+    candidates = []
+    for record in open_payments.with_amount(paid_amount.cents - AMOUNT_MATCH_TOLERANCE, paid_amount.cents + AMOUNT_MATCH_TOLERANCE):
+        created = parse_time(record.timestampz)
+        if created is None or earliest <= created <= sms_time + CLOCK_SKEW:
+            candidates.append(record)
+    if not candidates:
+        return None
+
+    # Newest first; only the leading few are worth a read for the name check
+    candidates.sort(reverse=True)
+    candidates = candidates[:MAX_CANDIDATE_ROWS]
+    response = supabase.table("payments").select("*").in_("id", [record.id for record in candidates]).execute()
+    rows = {str(row["id"]): row for row in response.data or [] if is_open(row)}
+
+    scored = sorted(
+        ((score_candidate(record, rows[str(record.id)], paid_amount.cents, sms_time, msg), rows[str(record.id)])
+         for record in candidates if str(record.id) in rows),
+        key=lambda pair: pair[0],
+        reverse=True
+    )
+    if not scored:
+        return None
+
+    best_score, best = scored[0]
+    runner_up = scored[1][0] if len(scored) > 1 else 0.0
+    if best_score < AMOUNT_MATCH_MIN_SCORE or best_score - runner_up < AMOUNT_MATCH_MARGIN:
+        print(f"⚠️ SMS {sms_row.get('id')} amount match is ambiguous ({len(scored)} candidates), left for review")
+        return None
+    return best
@@ -0,0 +1,69 @@
+import secrets
+from datetime import datetime
+
+from money import Money, ZERO
+from phone import normalize_numbers
+import payment_state
+
+# Validation for /create-payments: many payment links from one request.
+# Numbers are normalized in a single batch pass and every entry is checked
+# before anything is written, so one bad row never leaves half a batch behind
+# without telling the seller which row it was.
+
+MAX_PAYMENTS_PER_REQUEST = 1000
+REQUIRED_FIELDS = ("product_name", "amount", "buyer_name", "buyer_email", "mpesa_number")
+
+
+def validate_payment_entries(entries, user_id):
+    """
+    Returns (records ready to insert, errors sorted by row). Records keep their 1-based
+    position under "_row"; strip it before inserting.
+    """
+    errors = []
+    valid = []
+    for row_number, entry in enumerate(entries, start=1):
+        if not isinstance(entry, dict):
+            errors.append({"row": row_number, "error": "Expected an object"})
+            continue
+        missing = [field for field in REQUIRED_FIELDS if not entry.get(field)]
+        if missing:
+            errors.append({"row": row_number, "error": f"Missing {', '.join(missing)}"})
+            continue
+        try:
+            amount = Money.parse(entry["amount"])
+        except ValueError:
+            errors.append({"row": row_number, "error": "Invalid amount"})
+            continue
+        if amount <= ZERO:
+            errors.append({"row": row_number, "error": "Amount must be greater than zero"})
+            continue
+        if "@" not in str(entry["buyer_email"]):
+            errors.append({"row": row_number, "error": "Invalid buyer_email"})
+            continue
+        valid.append((row_number, entry, amount))
+
+    numbers = normalize_numbers([entry["mpesa_number"] for _, entry, _ in valid])
+    now = datetime.utcnow().isoformat()
+
+    records = []
+    for (row_number, entry, amount), number in zip(valid, numbers):
+        if number is None:
+            errors.append({"row": row_number, "error": "Invalid mpesa_number"})
+            continue
+        records.append({
+            "_row": row_number,
+            "user_id": user_id,
+            "product_name": entry["product_name"],
+            "amount": amount.amount,
+            "buyer_name": entry["buyer_name"],
+            "buyer_email": entry["buyer_email"],
+            "mpesa_number": number,
+            "status": payment_state.NOT_PAID,
+            "paid": False,
+            "amount_paid": 0,
+            "auth_token": secrets.token_hex(16),
+            "timestampz": now,
+            "updated_at": now
+        })
+    errors.sort(key=lambda error: error["row"])
+    return records, errors
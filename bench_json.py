@@ -0,0 +1,53 @@
+# bench_json.py
+# Compare the stdlib and orjson JSON providers on a /buyer-transactions sized
+# payload (same columns the route selects). Run: python bench_json.py [rows]
+import sys
+import uuid
+import timeit
+from datetime import datetime, timedelta, timezone
+
+from flask import Flask
+
+from json_provider import StdlibJSONProvider, OrjsonProvider, orjson
+
+
+def buyer_transactions(rows):
+    now = datetime.now(timezone.utc)
+    return [{
+        "id": str(uuid.uuid4()),
+        "product_name": f"Product {i}",
+        "amount": 1500 + i,
+        "buyer_name": f"Buyer {i}",
+        "mpesa_number": f"2547{i:08d}",
+        "amount_paid": (1500 + i) / 2,
+        "status": "partially-paid" if i % 3 else "paid-held",
+        "user_id": "b1e7c1de-5a11-4c6f-9f3e-0f6d1c2a9b77",
+        "timestampz": now - timedelta(minutes=i)
+    } for i in range(rows)]
+
+
+def bench(provider_class, payload, number):
+    app = Flask(__name__)
+    app.json = provider_class(app)
+    with app.app_context():
+        encode = timeit.timeit(lambda: app.json.response(payload), number=number)
+        body = app.json.response(payload).get_data()
+        decode = timeit.timeit(lambda: app.json.loads(body), number=number)
+    return encode / number * 1000, decode / number * 1000, len(body)
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    number = 200
+    payload = buyer_transactions(rows)
+
+    providers = [("stdlib", StdlibJSONProvider)]
+    if orjson:
+        providers.append(("orjson", OrjsonProvider))
+    else:
+        print("orjson not installed, only timing the stdlib provider")
+
+    print(f"/buyer-transactions payload: {rows} rows, {number} runs")
+    for name, provider_class in providers:
+        encode_ms, decode_ms, size = bench(provider_class, payload, number)
+        print(f"{name:>7}: encode {encode_ms:.3f} ms  decode {decode_ms:.3f} ms  ({size} bytes)")
@@ -0,0 +1,25 @@
+# Helpers for bulk writes: one insert per chunk instead of one per row.
+
+BULK_CHUNK_SIZE = 500
+
+
+def chunked(items, size=BULK_CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield start, items[start:start + size]
+
+
+def insert_in_chunks(supabase, table, records, size=BULK_CHUNK_SIZE):
+    """
+    Insert records `size` at a time.
+    Returns (inserted_rows, failures) where failures is a list of
+    (index_in_records, error message) for every row of a chunk that failed.
+    """
+    inserted, failures = [], []
+    for start, chunk in chunked(records, size):
+        try:
+            response = supabase.table(table).insert(chunk).execute()
+            inserted.extend(response.data or [])
+        except Exception as e:
+            print(f"❌ Bulk insert into {table} failed for rows {start}-{start + len(chunk) - 1}:", e)
+            failures.extend((start + i, str(e)) for i in range(len(chunk)))
+    return inserted, failures
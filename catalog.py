@@ -0,0 +1,64 @@
+import csv
+import io
+
+from money import Money, ZERO
+
+# Validation and CSV parsing for bulk catalog onboarding (/add-products,
+# /import-products). Everything is checked in a single pass and every bad
+# row is reported with its position, so a seller can fix the file in one go.
+
+MAX_PRODUCTS_PER_REQUEST = 5000
+MAX_PRODUCT_NAME_LENGTH = 200
+CSV_COLUMNS = ("product_name", "amount")
+
+
+def validate_products(items, user_id):
+    """
+    Returns (records ready to insert, errors). Each record keeps its original
+    row number under "_row"; strip it before inserting.
+    """
+    records, errors = [], []
+    for row_number, item in enumerate(items, start=1):
+        if not isinstance(item, dict):
+            errors.append({"row": row_number, "error": "Expected an object"})
+            continue
+
+        product_name = str(item.get("product_name") or "").strip()
+        if not product_name:
+            errors.append({"row": row_number, "error": "Missing product_name"})
+            continue
+        if len(product_name) > MAX_PRODUCT_NAME_LENGTH:
+            errors.append({"row": row_number, "error": "product_name is too long"})
+            continue
+
+        try:
+            amount = Money.parse(item.get("amount"))
+        except ValueError:
+            errors.append({"row": row_number, "error": "Invalid amount"})
+            continue
+        if amount <= ZERO:
+            errors.append({"row": row_number, "error": "Amount must be greater than zero"})
+            continue
+
+        records.append({
+            "_row": row_number,
+            "user_id": user_id,
+            "product_name": product_name,
+            "amount": amount.amount,
+            "status": "pending"
+        })
+    return records, errors
+
+
+def parse_products_csv(text):
+    """
+    Rows of a product CSV as dicts. Needs a header with product_name and amount.
+    Raises ValueError if the header is missing them.
+    """
+    reader = csv.DictReader(io.StringIO(text.lstrip("\ufeff")))
+    header = [(name or "").strip().lower() for name in (reader.fieldnames or [])]
+    missing = [column for column in CSV_COLUMNS if column not in header]
+    if missing:
+        raise ValueError(f"CSV is missing column(s): {', '.join(missing)}")
+    reader.fieldnames = header
+    return list(reader)
@@ -0,0 +1,93 @@
+import os
+import re
+import time
+import base64
+from datetime import datetime
+
+# Change feed over payments.updated_at for seller dashboards.
+# A cursor is the (updated_at, id) of the last row a client has seen, encoded
+# as an opaque url-safe string; fetch_changes() returns the rows after it in
+# (updated_at, id) order, so a refresh costs O(changes) instead of O(history).
+# updated_at is stamped by every write path (payment_state.transition,
+# create_payment) and by a trigger, see migrations/003_payments_updated_at.sql.
+
+FEED_COLUMNS = "id, product_name, amount, buyer_name, mpesa_number, amount_paid, status, user_id, updated_at"
+FEED_PAGE_SIZE = 200
+STREAM_POLL_INTERVAL = float(os.environ.get("FEED_STREAM_POLL_INTERVAL", 3))
+STREAM_MAX_SECONDS = int(os.environ.get("FEED_STREAM_MAX_SECONDS", 300))
+STREAM_HEARTBEAT = 15
+
+# Cursor fields end up inside a PostgREST filter string, so only plain ids pass
+CURSOR_ID_RE = re.compile(r"[0-9A-Za-z_-]{1,64}")
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(row):
+    raw = f"{row['updated_at']}|{row['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        updated_at, row_id = base64.urlsafe_b64decode(padded.encode()).decode().split("|", 1)
+        updated_at = datetime.fromisoformat(updated_at.replace("Z", "+00:00")).isoformat()
+    except Exception:
+        raise InvalidCursor("Invalid cursor")
+    if not CURSOR_ID_RE.fullmatch(row_id):
+        raise InvalidCursor("Invalid cursor")
+    return updated_at, row_id
+
+
+def fetch_changes(supabase, user_id, cursor=None, limit=FEED_PAGE_SIZE):
+    """
+    Payments for a seller modified after `cursor` (None = from the beginning).
+    Returns (rows, next_cursor); next_cursor stays put when nothing changed.
+    """
+    query = (
+        supabase.table("payments")
+        .select(FEED_COLUMNS)
+        .eq("user_id", user_id)
+    )
+    if cursor:
+        updated_at, row_id = decode_cursor(cursor)
+        query = query.or_(
+            f'updated_at.gt."{updated_at}",'
+            f'and(updated_at.eq."{updated_at}",id.gt.{row_id})'
+        )
+
+    response = (
+        query.order("updated_at")
+        .order("id")
+        .limit(limit)
+        .execute()
+    )
+    rows = response.data or []
+    next_cursor = encode_cursor(rows[-1]) if rows else cursor
+    return rows, next_cursor
+
+
+def stream_changes(supabase, user_id, cursor, dumps):
+    """
+    Server-sent events: one `changes` event per batch of modified payments,
+    with the cursor as the event id so EventSource resumes via Last-Event-ID.
+    Ends after STREAM_MAX_SECONDS so a dashboard can't pin a worker forever.
+    """
+    started = last_sent = time.monotonic()
+    yield f"retry: {int(STREAM_POLL_INTERVAL * 1000)}\n\n"
+
+    while time.monotonic() - started < STREAM_MAX_SECONDS:
+        rows, next_cursor = fetch_changes(supabase, user_id, cursor)
+        if rows:
+            cursor = next_cursor
+            last_sent = time.monotonic()
+            yield f"id: {cursor}\nevent: changes\ndata: {dumps(rows)}\n\n"
+            if len(rows) == FEED_PAGE_SIZE:
+                continue  # more waiting, don't sleep
+        elif time.monotonic() - last_sent >= STREAM_HEARTBEAT:
+            last_sent = time.monotonic()
+            yield ": keep-alive\n\n"
+        time.sleep(STREAM_POLL_INTERVAL)
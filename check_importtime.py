@@ -0,0 +1,68 @@
+import os
+import re
+import sys
+import subprocess
+
+# Import-time check for cold starts: runs `python -X importtime -c "import main"`
+# in a fresh interpreter, prints the slowest imports, and fails if
+#   - any module that main.py is meant to load lazily was imported eagerly, or
+#   - the total import time is over --budget-ms (default IMPORT_BUDGET_MS, 0 = no limit).
+#
+#   python check_importtime.py [--budget-ms 800] [--top 15]
+
+LAZY_MODULES = ("supabase", "postgrest", "httpx", "sendgrid", "realtime", "opentelemetry")
+IMPORT_BUDGET_MS = int(os.environ.get("IMPORT_BUDGET_MS", 0))
+
+LINE_RE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def measure(module="main"):
+    env = dict(os.environ)
+    env.setdefault("SUPABASE_URL", "https://example.supabase.co")
+    env.setdefault("SUPABASE_KEY", "importtime-check")
+    env.setdefault("SECRET_KEY", "importtime-check")
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, env=env, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    if result.returncode != 0:
+        print(result.stderr)
+        raise SystemExit(f"❌ import {module} failed")
+
+    imports = []
+    for line in result.stderr.splitlines():
+        match = LINE_RE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            imports.append((name, int(self_us), int(cumulative_us), len(indent) // 2))
+    return imports
+
+
+def main(argv):
+    budget = IMPORT_BUDGET_MS
+    top = 15
+    if "--budget-ms" in argv:
+        budget = int(argv[argv.index("--budget-ms") + 1])
+    if "--top" in argv:
+        top = int(argv[argv.index("--top") + 1])
+
+    imports = measure()
+    total_ms = imports[-1][2] / 1000
+    print(f"import main: {total_ms:.1f} ms")
+    print("slowest top-level imports:")
+    for name, _, cumulative_us, _ in sorted((i for i in imports if i[3] == 1), key=lambda i: -i[2])[:top]:
+        print(f"  {cumulative_us / 1000:8.1f} ms  {name}")
+
+    failed = False
+    eager = sorted({name for name, _, _, _ in imports if name.split(".")[0] in LAZY_MODULES})
+    if eager:
+        print("❌ imported at startup but should be lazy:", ", ".join(eager))
+        failed = True
+    if budget and total_ms > budget:
+        print(f"❌ import time {total_ms:.1f} ms is over the {budget} ms budget")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
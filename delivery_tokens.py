@@ -0,0 +1,120 @@
+import os
+import hmac
+import time
+from datetime import datetime, timezone
+from hashlib import sha256
+
+from session_tokens import InvalidToken
+
+# Signed confirm-delivery links: /confirm-delivery/<payment_id>/<token>
+#
+# Token format: <key id>.<expiry unix time>.<hex HMAC-SHA256 of "payment_id.expiry">
+# Keys are read once at import from CONFIRM_KEYS ("id:secret,id:secret,...");
+# new links are signed with CONFIRM_KEY_ID and any listed key still verifies,
+# so a key can be rotated out by adding the new one, switching CONFIRM_KEY_ID,
+# and dropping the old one once its links have expired.
+#
+# Without CONFIRM_KEYS, SECRET_KEY is the one key; with neither the app
+# refuses to start rather than sign links with a guessable key.
+#
+# Links already sent by email are a bare HMAC of the payment id under
+# SECRET_KEY with no expiry. They are only accepted with LEGACY_CONFIRM_LINKS=1,
+# and only until LEGACY_CONFIRM_LINKS_UNTIL (an ISO date or time, UTC).
+
+BASE_URL = os.environ.get("PUBLIC_BASE_URL", "https://trustpay-backend.onrender.com")
+CONFIRM_LINK_TTL = int(os.environ.get("CONFIRM_LINK_TTL", 30 * 24 * 3600))
+LEGACY_CONFIRM_LINKS = os.environ.get("LEGACY_CONFIRM_LINKS", "0") == "1"
+
+LEGACY_SECRET = os.environ.get("SECRET_KEY")
+
+
+def parse_until(value):
+    until = datetime.fromisoformat(value)
+    if until.tzinfo is None:
+        until = until.replace(tzinfo=timezone.utc)
+    return until.timestamp()
+
+
+LEGACY_LINKS_UNTIL = None
+if LEGACY_CONFIRM_LINKS:
+    if not LEGACY_SECRET or not os.environ.get("LEGACY_CONFIRM_LINKS_UNTIL"):
+        raise RuntimeError("LEGACY_CONFIRM_LINKS=1 needs SECRET_KEY and LEGACY_CONFIRM_LINKS_UNTIL")
+    LEGACY_LINKS_UNTIL = parse_until(os.environ["LEGACY_CONFIRM_LINKS_UNTIL"])
+
+
+def load_keys(spec):
+    keys = {}
+    for entry in (spec or "").split(","):
+        key_id, _, secret = entry.strip().partition(":")
+        if key_id and secret:
+            keys[key_id] = hmac.new(secret.encode(), digestmod=sha256)
+    return keys
+
+
+# Keyed once; each signature copies the prepared HMAC state
+KEYS = load_keys(os.environ.get("CONFIRM_KEYS"))
+if not KEYS:
+    if not LEGACY_SECRET:
+        raise RuntimeError("Set CONFIRM_KEYS (or SECRET_KEY) to sign confirm-delivery links")
+    KEYS = {"0": hmac.new(LEGACY_SECRET.encode(), digestmod=sha256)}
+CURRENT_KEY_ID = os.environ.get("CONFIRM_KEY_ID") or next(iter(KEYS))
+if CURRENT_KEY_ID not in KEYS:
+    raise RuntimeError(f"CONFIRM_KEY_ID {CURRENT_KEY_ID!r} is not in CONFIRM_KEYS")
+
+_legacy_signer = hmac.new(LEGACY_SECRET.encode(), digestmod=sha256) if LEGACY_CONFIRM_LINKS else None
+
+
+def _digest(signer, message):
+    mac = signer.copy()
+    mac.update(message.encode())
+    return mac.hexdigest()
+
+
+def sign_confirm_token(payment_id, ttl=None, now=None):
+    expires = int(now or time.time()) + (CONFIRM_LINK_TTL if ttl is None else ttl)
+    signature = _digest(KEYS[CURRENT_KEY_ID], f"{payment_id}.{expires}")
+    return f"{CURRENT_KEY_ID}.{expires}.{signature}"
+
+
+def sign_confirm_tokens(payment_ids, ttl=None):
+    """
+    Tokens for many payments at once (reminder runs): {payment_id: token}.
+    """
+    now = int(time.time())
+    return {payment_id: sign_confirm_token(payment_id, ttl, now) for payment_id in payment_ids}
+
+
+def confirm_link(payment_id, token=None):
+    return f"{BASE_URL}/confirm-delivery/{payment_id}/{token or sign_confirm_token(payment_id)}"
+
+
+def confirm_links(payment_ids, ttl=None):
+    return {payment_id: confirm_link(payment_id, token) for payment_id, token in sign_confirm_tokens(payment_ids, ttl).items()}
+
+
+def verify_confirm_token(payment_id, token):
+    """
+    Check a confirm-delivery token for this payment, or raise InvalidToken.
+    """
+    token = token or ""
+    parts = token.split(".")
+
+    if len(parts) == 1:
+        if (
+            _legacy_signer is not None
+            and time.time() < LEGACY_LINKS_UNTIL
+            and hmac.compare_digest(_digest(_legacy_signer, str(payment_id)), token)
+        ):
+            return
+        raise InvalidToken("Invalid confirmation link")
+
+    if len(parts) != 3:
+        raise InvalidToken("Invalid confirmation link")
+    key_id, expires, signature = parts
+    signer = KEYS.get(key_id)
+    if signer is None or not expires.isdigit():
+        raise InvalidToken("Invalid confirmation link")
+    if not hmac.compare_digest(_digest(signer, f"{payment_id}.{expires}"), signature):
+        raise InvalidToken("Invalid confirmation link")
+    if int(expires) < time.time():
+        raise InvalidToken("Confirmation link expired")
@@ -0,0 +1,57 @@
+import gzip
+from functools import wraps
+
+from flask import request, make_response
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always there
+    brotli = None
+
+# Conditional GET + compression for the read endpoints the dashboards poll.
+# Every 200 gets a content-hash ETag; a matching If-None-Match turns into an
+# empty 304, so an unchanged list costs headers only. Bodies above
+# COMPRESS_MIN_SIZE are brotli/gzip encoded when the client accepts it.
+
+COMPRESS_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def compress(response):
+    if response.status_code != 200 or response.direct_passthrough:
+        return response
+    if "Content-Encoding" in response.headers:
+        return response
+
+    response.vary.add("Accept-Encoding")
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        response.set_data(brotli.compress(body, quality=BROTLI_QUALITY))
+        response.headers["Content-Encoding"] = "br"
+    elif accepted["gzip"]:
+        response.set_data(gzip.compress(body, compresslevel=GZIP_LEVEL))
+        response.headers["Content-Encoding"] = "gzip"
+    return response
+
+
+def conditional_json(view):
+    """
+    Wrap a JSON GET route with ETag / If-None-Match handling and compression.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        response = make_response(view(*args, **kwargs))
+        if response.status_code != 200:
+            return response
+
+        # Weak tag: same JSON is equivalent whatever encoding we send it in
+        response.add_etag(weak=True)
+        response.headers["Cache-Control"] = "private, no-cache"
+        response.make_conditional(request)
+        return compress(response)
+    return wrapper
@@ -0,0 +1,53 @@
+import uuid
+import decimal
+import dataclasses
+from datetime import date, datetime, time
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # fall back to the stdlib encoder
+    orjson = None
+
+# JSON provider for the app: orjson when installed, stdlib json otherwise.
+# Both encode datetime/date/time as ISO 8601, UUID as its string and Decimal
+# as a string (so money never goes through a float), and both parse request
+# bodies through the same fast path used by request.get_json().
+
+
+def default(obj):
+    if isinstance(obj, (datetime, date, time)):
+        return obj.isoformat()
+    if isinstance(obj, (decimal.Decimal, uuid.UUID)):
+        return str(obj)
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        return dataclasses.asdict(obj)
+    if hasattr(obj, "__html__"):
+        return str(obj.__html__())
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class StdlibJSONProvider(DefaultJSONProvider):
+    default = staticmethod(default)
+    sort_keys = False
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    option = orjson.OPT_NON_STR_KEYS if orjson else 0
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=default, option=self.option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=default, option=self.option | orjson.OPT_APPEND_NEWLINE)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+def init_json(app):
+    app.json = OrjsonProvider(app) if orjson else StdlibJSONProvider(app)
+    return app.json
@@ -1,17 +1,43 @@
 import bcrypt
-from flask import Flask, request, jsonify, redirect
+from flask import Flask, request, jsonify, redirect, Response, stream_with_context, g
 from flask_cors import CORS
-from supabase import create_client, Client
 import os
-import re
+import threading
 from datetime import datetime
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
+from phone import InvalidNumber, normalize_number, try_normalize
+from reconcile import extract_amount_simple, find_open_payment, find_unused_sms, settle_sms, credit_payment
+from sweeper import start_sweeper
+from ratelimit import rate_limit, POLL_LIMITS, LOGIN_LIMITS, READ_LIMITS, SELLER_LIMITS
+from payment_index import open_payments
+from http_cache import conditional_json
+from json_provider import init_json
+from money import Money, ZERO
+import payment_state
+from payment_state import InvalidTransition, status_for, transition
+from change_feed import FEED_PAGE_SIZE, InvalidCursor, decode_cursor, fetch_changes, stream_changes
+from realtime_sync import start_realtime
+from session_tokens import SESSIONS_ENABLED, InvalidToken, issue_session, seller_auth, verify_token
+from user_cache import find_login_user, forget
+from bulk import insert_in_chunks
+from catalog import MAX_PRODUCTS_PER_REQUEST, parse_products_csv, validate_products
+from batch_payments import MAX_PAYMENTS_PER_REQUEST, validate_payment_entries
+from delivery_tokens import confirm_link, verify_confirm_token
+from release import ALREADY_RELEASED, NOT_RELEASABLE, release
+from payout_engine import start_payout_engine
+from sms_dedup import extract_transaction_code, is_duplicate_key_error, is_known_code, seen_codes
+from tracing import init_tracing, span
+from profiler import init_profiler
+from supabase_client import LazySupabase
+from resilience import EMAIL_TIMEOUT, email_breaker, guarded, init_resilience
+from webhooks import WEBHOOK_EVENTS, InvalidWebhookUrl, create_endpoint, delete_endpoint, list_endpoints, start_webhooks
 
 def send_email(to_email, subject, body):
     """
     Send an email using SendGrid API
     """
+    from sendgrid import SendGridAPIClient
+    from sendgrid.helpers.mail import Mail
+
     try:
         message = Mail(
             from_email="felixmoseti254@gmail.com",  # your verified SendGrid sender
@@ -20,21 +46,57 @@ def send_email(to_email, subject, body):
             html_content=body
         )
 
-        sg = SendGridAPIClient(os.environ.get("SENDGRID_API_KEY"))
-        response = sg.send(message)
+        with span("sendgrid.send", **{"email.subject": subject}):
+            sg = SendGridAPIClient(os.environ.get("SENDGRID_API_KEY"))
+            sg.client.timeout = EMAIL_TIMEOUT
+            response = guarded(email_breaker, sg.send, message)
         print(f"📧 Email sent to {to_email} | Status: {response.status_code}")
     except Exception as e:
         print("❌ SendGrid error:", e)
 
+def send_emails(messages):
+    """
+    Send many (to_email, subject, body) emails through one SendGrid client.
+    """
+    from sendgrid import SendGridAPIClient
+    from sendgrid.helpers.mail import Mail
+
+    sg = SendGridAPIClient(os.environ.get("SENDGRID_API_KEY"))
+    sg.client.timeout = EMAIL_TIMEOUT
+    for to_email, subject, body in messages:
+        try:
+            message = Mail(
+                from_email="felixmoseti254@gmail.com",
+                to_emails=to_email,
+                subject=subject,
+                html_content=body
+            )
+            with span("sendgrid.send", **{"email.subject": subject}):
+                response = guarded(email_breaker, sg.send, message)
+            print(f"📧 Email sent to {to_email} | Status: {response.status_code}")
+        except Exception as e:
+            print("❌ SendGrid error:", e)
+
+def queue_emails(messages):
+    """
+    Send a batch of emails in the background so the request doesn't wait on SendGrid.
+    """
+    if messages:
+        threading.Thread(target=send_emails, args=(messages,), daemon=True).start()
+
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=["ETag", "Retry-After"])
+init_json(app)
+init_tracing(app)
+init_profiler(app)
+init_resilience(app)
 
 # Get Supabase credentials from environment
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
 
-# Initialize Supabase client
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Supabase client, built on first use so a cold start doesn't wait for it
+supabase = LazySupabase(SUPABASE_URL, SUPABASE_KEY)
 
 @app.route('/signup', methods=['POST'])
 def signup():
@@ -44,7 +106,8 @@ def signup():
     email = data.get('email')
     phone = data.get('phone')
     raw_password = data.get('password')
-    hashed_password = bcrypt.hashpw(raw_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    with span("bcrypt.hashpw"):
+        hashed_password = bcrypt.hashpw(raw_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
 
     try:
         response = supabase.table('users').insert({
@@ -54,43 +117,70 @@ def signup():
             "phone": phone,
             "password": hashed_password
         }).execute()
+        forget(email)
         return jsonify({"message": "Account created successfully!"}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/login', methods=['POST'])
+@rate_limit(LOGIN_LIMITS)
 def login(): 
     data = request.get_json()
     email = data.get('email')
     password = data.get('password')
 
+    if not email or not password:
+        return jsonify({"error": "Invalid email or password."}), 401
+
     try:
-        response = supabase.table('users').select('*').eq('email', email).execute()
-        users = response.data
+        user = find_login_user(supabase, email)
 
-        if not users:
+        if not user:
             return jsonify({"error": "Invalid email or password."}), 401
 
-        user = users[0]
         stored_hash = user['password']
 
-        if bcrypt.checkpw(password.encode('utf-8'), stored_hash.encode('utf-8')):
+        with span("bcrypt.checkpw"):
+            password_ok = bcrypt.checkpw(password.encode('utf-8'), stored_hash.encode('utf-8'))
+
+        if password_ok:
             return jsonify({
                 "message": f"Welcome, {user['full_name']}!",
                 "user_id": user['id'],
-                "full_name": user['full_name']
+                "full_name": user['full_name'],
+                **(issue_session(user['id']) if SESSIONS_ENABLED else {})
             }), 200
         else:
             return jsonify({"error": "Invalid email or password."}), 401
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+
+@app.route('/refresh', methods=['POST'])
+@rate_limit(LOGIN_LIMITS)
+def refresh():
+    """
+    Trade a refresh token for a new access/refresh pair. No database hit.
+    """
+    data = request.get_json(silent=True) or {}
+    refresh_token = data.get('refresh_token')
+    if not refresh_token:
+        return jsonify({"error": "Missing refresh_token"}), 400
+
+    try:
+        claims = verify_token(refresh_token, "refresh")
+    except InvalidToken as e:
+        return jsonify({"error": str(e)}), 401
+
+    return jsonify(issue_session(claims["sub"])), 200
+
 # ===================== ADD PRODUCT ROUTE =====================
 @app.route('/add-product', methods=['POST'])
+@seller_auth
 def add_product():
     try:
         data = request.json
-        user_id = data.get("user_id")
+        user_id = g.user_id
         product_name = data.get("product_name")
         amount = data.get("amount")
 
@@ -114,10 +204,75 @@ def add_product():
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+def save_products(items, user_id):
+    """
+    Validate and bulk insert products; responds with per-row errors.
+    """
+    if not user_id:
+        return jsonify({"error": "Missing user_id"}), 400
+    if not items:
+        return jsonify({"error": "No products provided"}), 400
+    if len(items) > MAX_PRODUCTS_PER_REQUEST:
+        return jsonify({"error": f"At most {MAX_PRODUCTS_PER_REQUEST} products per request"}), 400
+
+    records, errors = validate_products(items, user_id)
+    rows = [{k: v for k, v in record.items() if k != "_row"} for record in records]
+    inserted, failures = insert_in_chunks(supabase, "products", rows)
+    for index, message in failures:
+        errors.append({"row": records[index]["_row"], "error": message})
+    errors.sort(key=lambda error: error["row"])
+
+    if not inserted:
+        status = 400
+    elif errors:
+        status = 200
+    else:
+        status = 201
+    return jsonify({
+        "message": f"{len(inserted)} product(s) added",
+        "inserted": len(inserted),
+        "errors": errors
+    }), status
+
+@app.route('/add-products', methods=['POST'])
+@seller_auth(required=True)
+def add_products():
+    try:
+        data = request.get_json(silent=True) or {}
+        items = data.get("products")
+        if items is not None and not isinstance(items, list):
+            return jsonify({"error": "products must be a list"}), 400
+        return save_products(items, g.user_id)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/import-products', methods=['POST'])
+@seller_auth(required=True)
+def import_products():
+    """
+    CSV catalog import: multipart upload in field "file", or a text/csv body.
+    Columns: product_name, amount.
+    """
+    try:
+        upload = request.files.get("file")
+        raw = upload.read() if upload else request.get_data()
+        try:
+            items = parse_products_csv(raw.decode("utf-8"))
+        except UnicodeDecodeError:
+            return jsonify({"error": "CSV must be UTF-8 encoded"}), 400
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return save_products(items, g.user_id)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/products', methods=['GET'])
+@conditional_json
+@seller_auth
+@rate_limit(SELLER_LIMITS)
 def get_products():
     try:
-        user_id = request.args.get('user_id')
+        user_id = g.user_id
         if not user_id:
             return jsonify({"error": "Missing user_id"}), 400
 
@@ -136,10 +291,12 @@ def get_products():
 import secrets
 
 @app.route('/create-payment', methods=['POST'])
+@seller_auth
+@rate_limit(SELLER_LIMITS)
 def create_payment():
     try:
         data = request.get_json()
-        user_id = data.get("user_id")
+        user_id = g.user_id
         product_name = data.get("product_name")
         amount = data.get("amount")
         buyer_name = data.get("buyer_name")
@@ -151,18 +308,19 @@ def create_payment():
         if not user_id or not product_name or not amount or not buyer_name or not buyer_email or not mpesa_number:
             return jsonify({"error": "Missing required fields"}), 400
 
+        # ✅ Validate amount (stored exactly, to the cent)
+        try:
+            amount = Money.parse(amount)
+        except ValueError:
+            return jsonify({"error": "Invalid amount"}), 400
+        if amount <= ZERO:
+            return jsonify({"error": "Amount must be greater than zero"}), 400
+
         # ✅ Normalize phone number
-        def normalize_number(number):
-            number = number.strip().replace(" ", "").replace("+", "")
-            if number.startswith("0") and len(number) == 10:
-                return "254" + number[1:]
-            elif number.startswith("7") and len(number) == 9:
-                return "254" + number
-            elif number.startswith("254") and len(number) == 12:
-                return number
-            return number
-
-        normalized_mpesa = normalize_number(mpesa_number)
+        try:
+            normalized_mpesa = normalize_number(mpesa_number)
+        except InvalidNumber as e:
+            return jsonify({"error": str(e)}), 400
 
         # ✅ Generate secure token
         auth_token = secrets.token_hex(16)  # 32-char random hex string
@@ -171,18 +329,21 @@ def create_payment():
         insert_response = supabase.table("payments").insert({
             "user_id": user_id,
             "product_name": product_name,
-            "amount": amount,
+            "amount": amount.amount,
             "buyer_name": buyer_name,
             "buyer_email": buyer_email,
             "mpesa_number": normalized_mpesa,
-            "status": "Not paid",
+            "status": payment_state.NOT_PAID,
             "paid": False,
             "amount_paid": 0,
             "auth_token": auth_token,   # <-- store token
-            "timestampz": datetime.utcnow().isoformat()
+            "timestampz": datetime.utcnow().isoformat(),
+            "updated_at": datetime.utcnow().isoformat()
         }).execute()
 
         if insert_response.data:
+            open_payments.track(insert_response.data[0])
+            payment_state.created(supabase, insert_response.data[0])
             return jsonify({
                 "message": "Payment created successfully",
                 "payment": insert_response.data[0],
@@ -194,6 +355,84 @@ def create_payment():
     except Exception as e:
         print("❌ Error in create-payment:", e)
         return jsonify({"error": str(e)}), 500
+def payment_invite(payment):
+    """
+    (to_email, subject, body) inviting a buyer to pay a new payment link.
+    """
+    body = f"""
+    <html>
+      <body>
+        <p>Hello {payment.get("buyer_name")},</p>
+        <p>You have a new payment request of <b>KES {Money.parse(payment.get("amount"))}</b> for <b>{payment.get("product_name")}</b>.</p>
+        <p>Your money is held safely by TrustPay until you confirm delivery.</p>
+        <a href="https://trustpay-backend.onrender.com/pay-balance/{payment["id"]}"
+           style="padding:10px 20px; background-color:green; color:white; text-decoration:none; border-radius:5px;">
+           💳 Pay Now
+        </a>
+        <br><br>
+        <p>Thank you,<br>TrustPay Team</p>
+      </body>
+    </html>
+    """
+    return payment.get("buyer_email"), "Payment Request", body
+
+@app.route('/create-payments', methods=['POST'])
+@seller_auth(required=True)
+@rate_limit(SELLER_LIMITS)
+def create_payments():
+    """
+    Create many payment links at once (group orders, invoices).
+    Body: {"payments": [{product_name, amount, buyer_name, buyer_email, mpesa_number}, ...],
+           "send_invites": true}
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        entries = data.get("payments")
+        user_id = g.user_id
+
+        if not user_id:
+            return jsonify({"error": "Missing user_id"}), 400
+        if not entries or not isinstance(entries, list):
+            return jsonify({"error": "payments must be a non-empty list"}), 400
+        if len(entries) > MAX_PAYMENTS_PER_REQUEST:
+            return jsonify({"error": f"At most {MAX_PAYMENTS_PER_REQUEST} payments per request"}), 400
+
+        records, errors = validate_payment_entries(entries, user_id)
+        rows = [{k: v for k, v in record.items() if k != "_row"} for record in records]
+        inserted, failures = insert_in_chunks(supabase, "payments", rows)
+        for index, message in failures:
+            errors.append({"row": records[index]["_row"], "error": message})
+        errors.sort(key=lambda error: error["row"])
+
+        for row in inserted:
+            open_payments.track(row)
+        payment_state.created_many(supabase, inserted)
+
+        if data.get("send_invites"):
+            queue_emails([payment_invite(row) for row in inserted])
+
+        if not inserted:
+            status = 400
+        elif errors:
+            status = 200
+        else:
+            status = 201
+        return jsonify({
+            "message": f"{len(inserted)} payment(s) created",
+            "payments": [{
+                "id": row["id"],
+                "buyer_email": row.get("buyer_email"),
+                "mpesa_number": row.get("mpesa_number"),
+                "amount": row.get("amount"),
+                "token": row.get("auth_token")
+            } for row in inserted],
+            "errors": errors
+        }), status
+
+    except Exception as e:
+        print("❌ Error in create-payments:", e)
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/sms', methods=['POST'])
 def receive_sms():
     data = request.get_json()
@@ -202,10 +441,27 @@ def receive_sms():
     if not message:
         return jsonify({"error": "No message provided"}), 400
 
+    # --- Reject forwarder replays of an M-Pesa confirmation we already hold ---
+    code = extract_transaction_code(message)
+
     try:
-        response = supabase.table('sms_messages').insert({
-            "message": message
-        }).execute()
+        if code and is_known_code(supabase, code):
+            print("🧾 Duplicate SMS ignored:", code)
+            return jsonify({"status": "duplicate", "transaction_code": code}), 200
+
+        try:
+            response = supabase.table('sms_messages').insert({
+                "message": message,
+                "transaction_code": code
+            }).execute()
+        except Exception as e:
+            if code and is_duplicate_key_error(e):
+                # Two copies raced past the checks; the unique index kept one
+                seen_codes.add(code)
+                return jsonify({"status": "duplicate", "transaction_code": code}), 200
+            raise
+        if code:
+            seen_codes.add(code)
 
         return jsonify({"status": "SMS stoed"}), 200
     except Exception as e:
@@ -215,6 +471,7 @@ def receive_sms():
 
 
 @app.route("/check-payment", methods=["POST"])
+@rate_limit(POLL_LIMITS)
 def check_payment():
     data = request.get_json()
     mpesa_number = data.get("mpesa_number")
@@ -225,17 +482,9 @@ def check_payment():
         return jsonify({"error": "M-Pesa number or Payment ID is required"}), 400
 
     # --- Normalize phone number ---
-    def normalize_number(number):
-        number = number.strip().replace(" ", "").replace("+", "")
-        if number.startswith("0") and len(number) == 10:
-            return "254" + number[1:]
-        elif number.startswith("7") and len(number) == 9:
-            return "254" + number
-        elif number.startswith("254") and len(number) == 12:
-            return number
-        return number
-
-    normalized_number = normalize_number(mpesa_number) if mpesa_number else None
+    normalized_number = try_normalize(mpesa_number)
+    if mpesa_number and normalized_number is None:
+        return jsonify({"error": "Invalid M-Pesa number"}), 400
     print("🔍 Normalized number:", normalized_number)
 
     try:
@@ -260,16 +509,8 @@ def check_payment():
             )
             payment_data = [payment_response.data] if payment_response.data else []
         else:
-            payment_response = (
-                supabase.table("payments")
-                .select("*")
-                .or_("paid.eq.False,status.eq.partially-paid")
-                .eq("mpesa_number", normalized_number)
-                .order("timestampz", desc=True)
-                .limit(1)
-                .execute()
-            )
-            payment_data = payment_response.data
+            payment = find_open_payment(supabase, normalized_number)
+            payment_data = [payment] if payment else []
 
         if not payment_data:
             return jsonify({
@@ -279,86 +520,56 @@ def check_payment():
 
         payment = payment_data[0]
         payment_id = payment["id"]
-        expected_amount = float(payment.get("amount", 0))
-        old_paid = float(payment.get("amount_paid", 0))
+        expected_amount = Money.parse(payment.get("amount"))
+        old_paid = Money.parse(payment.get("amount_paid"))
         buyer_email = payment.get("buyer_email")
         buyer_name = payment.get("buyer_name", "Customer")
         product_name = payment.get("product_name", "Product")
 
         # --- Only add the first payment ---
-        if old_paid > 0:
+        if old_paid > ZERO:
             # Any further SMS payments are ignored; user must pay via /update-balance
             return jsonify({
                 "paid": old_paid >= expected_amount,
                 "status": payment.get("status", "partially-paid"),
                 "message": "Installments must be made via the Pay Balance button",
-                "amount_paid": old_paid,
-                "balance": expected_amount - old_paid
+                "amount_paid": old_paid.amount,
+                "balance": (expected_amount - old_paid).amount
             }), 200
 
         # --- Match latest unused SMS ---
-        message_response = (
-            supabase.table("sms_messages")
-            .select("*")
-            .like("message", f"%{normalized_number[-9:]}%")
-            .eq("used", False)
-            .order("id", desc=True)
-            .limit(1)
-            .execute()
-        )
+        sms_row = find_unused_sms(supabase, normalized_number)
 
-        if not message_response.data:
+        if not sms_row:
             return jsonify({
                 "paid": False,
                 "message": "No matching unused payment message found yet"
             }), 200
 
-        sms_row = message_response.data[0]
         sms_id = sms_row["id"]
         matched_msg = sms_row["message"]
         print("📨 Matched SMS:", matched_msg)
 
         # --- Extract amount from SMS ---
-        def extract_amount_simple(msg):
-            if "Ksh" in msg:
-                parts = msg.split("Ksh")
-                if len(parts) > 1:
-                    after_ksh = parts[1].strip()
-                    amount_str = after_ksh.split(" ")[0].replace(",", "")
-                    try:
-                        return float(amount_str)
-                    except ValueError:
-                        return None
-            return None
-
         paid_amount = extract_amount_simple(matched_msg)
-        print("💰 Extracted amount:", paid_amount or 0)
-
-        # --- Mark SMS as used ---
-        supabase.table("sms_messages").update({"used": True}).eq("id", sms_id).execute()
+        print("💰 Extracted amount:", paid_amount or ZERO)
 
         # --- Update payment with first payment only ---
-        new_total_paid = paid_amount or 0
+        new_total_paid = paid_amount or ZERO
         fully_paid = new_total_paid >= expected_amount
-        status = "paid-held" if fully_paid else "partially-paid"
+        status = status_for(new_total_paid, expected_amount)
 
-        supabase.table("payments").update({
-            "amount_paid": new_total_paid,
-            "paid": fully_paid,
-            "status": status
-        }).eq("id", payment_id).execute()
+        # --- Mark SMS as used and move the payment (skip if someone else got there first) ---
+        if settle_sms(supabase, payment, sms_id, status, new_total_paid) is None:
+            return jsonify({
+                "paid": False,
+                "message": "No matching unused payment message found yet"
+            }), 200
 
         # --- Email logic ---
         if buyer_email:
-            from hashlib import sha256
-            import hmac
-            SECRET_KEY = os.environ.get("SECRET_KEY", "supersecret")
-            def generate_secure_token(pid: str):
-                return hmac.new(SECRET_KEY.encode(), pid.encode(), sha256).hexdigest()
-
             if fully_paid:
-                token = generate_secure_token(str(payment_id))
-                confirm_url = f"https://trustpay-backend.onrender.com/confirm-delivery/{payment_id}/{token}"
+                confirm_url = confirm_link(payment_id)
                 subject = "Confirm Delivery"
                 body = f"""
                 <html><body>
@@ -369,7 +580,7 @@ def check_payment():
                 </body></html>
                 """
             else:
-                remaining = round(expected_amount - new_total_paid, 2)
+                remaining = expected_amount - new_total_paid
                 subject = "Installment Payment Received"
                 body = f"""
                 <html><body>
@@ -386,16 +597,19 @@ def check_payment():
             "paid": fully_paid,
             "status": status,
             "message": "First payment recorded; remaining installments via Pay Balance button",
-            "amount_paid": new_total_paid,
-            "balance": expected_amount - new_total_paid
+            "amount_paid": new_total_paid.amount,
+            "balance": (expected_amount - new_total_paid).amount
         }), 200
 
+    except InvalidTransition as e:
+        return jsonify({"error": str(e)}), 409
     except Exception as e:
         print("❌ Error in check-payment:", e)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/check", methods=["POST"])
-def check_payment():
+@rate_limit(POLL_LIMITS)
+def check():
     data = request.get_json()
     mpesa_number = data.get("mpesa_number")
     payment_id = data.get("payment_id")
@@ -405,17 +619,9 @@ def check_payment():
         return jsonify({"error": "M-Pesa number or Payment ID is required"}), 400
 
     # --- Normalize phone number ---
-    def normalize_number(number):
-        number = number.strip().replace(" ", "").replace("+", "")
-        if number.startswith("0") and len(number) == 10:
-            return "254" + number[1:]
-        elif number.startswith("7") and len(number) == 9:
-            return "254" + number
-        elif number.startswith("254") and len(number) == 12:
-            return number
-        return number
-
-    normalized_number = normalize_number(mpesa_number) if mpesa_number else None
+    normalized_number = try_normalize(mpesa_number)
+    if mpesa_number and normalized_number is None:
+        return jsonify({"error": "Invalid M-Pesa number"}), 400
     print("🔍 Normalized number:", normalized_number)
 
     try:
@@ -442,16 +648,8 @@ def check_payment():
             payment_data = [payment_response.data] if payment_response.data else []
         else:
             # Legacy fallback lookup by phone number
-            payment_response = (
-                supabase.table("payments")
-                .select("*")
-                .or_("paid.eq.False,status.eq.partially-paid")
-                .eq("mpesa_number", normalized_number)
-                .order("timestampz", desc=True)
-                .limit(1)
-                .execute()
-            )
-            payment_data = payment_response.data
+            payment = find_open_payment(supabase, normalized_number)
+            payment_data = [payment] if payment else []
 
         if not payment_data:
             return jsonify({
@@ -461,87 +659,51 @@ def check_payment():
 
         payment = payment_data[0]
         payment_id = payment["id"]
-        expected_amount = float(payment.get("amount", 0))
+        expected_amount = Money.parse(payment.get("amount"))
         buyer_email = payment.get("buyer_email")
         buyer_name = payment.get("buyer_name", "Customer")
         product_name = payment.get("product_name", "Product")
 
         # --- Match latest unused SMS ---
-        message_response = (
-            supabase.table("sms_messages")
-            .select("*")
-            .like("message", f"%{normalized_number[-9:]}%")
-            .eq("used", False)
-            .order("id", desc=True)
-            .limit(1)
-            .execute()
-        )
+        sms_row = find_unused_sms(supabase, normalized_number)
 
-        if not message_response.data:
+        if not sms_row:
             return jsonify({
                 "paid": False,
                 "message": "No matching unused payment message found yet"
             }), 200
 
-        sms_row = message_response.data[0]
         sms_id = sms_row["id"]
         matched_msg = sms_row["message"]
         print("📨 Matched SMS:", matched_msg)
 
         # --- Extract amount from SMS ---
-        def extract_amount_simple(msg):
-            if "Ksh" in msg:
-                parts = msg.split("Ksh")
-                if len(parts) > 1:
-                    after_ksh = parts[1].strip()
-                    amount_str = after_ksh.split(" ")[0].replace(",", "")
-                    try:
-                        return float(amount_str)
-                    except ValueError:
-                        return None
-            return None
-
         paid_amount = extract_amount_simple(matched_msg)
         print("💰 Extracted amount:", paid_amount)
 
-        # --- Mark SMS as used ---
-        supabase.table("sms_messages").update({"used": True}).eq("id", sms_id).execute()
-
         # --- Update payment incrementally ---
-        old_paid = float(payment.get("amount_paid", 0))
-        new_total_paid = old_paid + (paid_amount or 0)
+        old_paid = Money.parse(payment.get("amount_paid"))
+        new_total_paid = old_paid + (paid_amount or ZERO)
 
         # Prevent overpayment
         if new_total_paid > expected_amount:
             new_total_paid = expected_amount
 
         fully_paid = new_total_paid >= expected_amount
-        status = "paid-held" if fully_paid else "partially-paid"
+        status = status_for(new_total_paid, expected_amount)
 
-        supabase.table("payments").update({
-            "amount_paid": new_total_paid,
-            "paid": fully_paid,
-            "status": status
-        }).eq("id", payment_id).execute()
+        # --- Mark SMS as used and move the payment (skip if someone else got there first) ---
+        if settle_sms(supabase, payment, sms_id, status, new_total_paid) is None:
+            return jsonify({
+                "paid": False,
+                "message": "No matching unused payment message found yet"
+            }), 200
 
         # --- Email logic for both partial and full payments ---
         if buyer_email:
-            from hashlib import sha256
-            import hmac
-
-            SECRET_KEY = os.environ.get("SECRET_KEY", "supersecret")
-
-            def generate_secure_token(pid: str):
-                return hmac.new(
-                    SECRET_KEY.encode(),
-                    pid.encode(),
-                    sha256
-                ).hexdigest()
-
             if fully_paid:
                 # Final payment email: confirm delivery
-                token = generate_secure_token(str(payment_id))
-                confirm_url = f"https://trustpay-backend.onrender.com/confirm-delivery/{payment_id}/{token}"
+                confirm_url = confirm_link(payment_id)
 
                 subject = "Confirm Delivery of Your Purchase"
                 body = f"""
@@ -561,7 +723,7 @@ def check_payment():
                 """
             else:
                 # Partial payment email with remaining balance
-                remaining = round(expected_amount - new_total_paid, 2)
+                remaining = expected_amount - new_total_paid
                 subject = "Installment Payment Received"
                 body = f"""
                 <html>
@@ -588,16 +750,77 @@ def check_payment():
             "paid": fully_paid,
             "status": status,
             "message": "Payment updated successfully",
-            "amount_paid": new_total_paid,
-            "balance": expected_amount - new_total_paid
+            "amount_paid": new_total_paid.amount,
+            "balance": (expected_amount - new_total_paid).amount
         }), 200
 
+    except InvalidTransition as e:
+        return jsonify({"error": str(e)}), 409
     except Exception as e:
         print("❌ Error in check-payment:", e)
         return jsonify({"error": str(e)}), 500
                         
+def notify_buyer(payment, new_total_paid):
+    """
+    Email the buyer after an SMS credit: pay-balance link while a balance is
+    left, confirm-delivery link once the payment is fully held.
+    Shared by /check-pay and the background SMS sweeper.
+    """
+    buyer_email = payment.get("buyer_email")
+    if not buyer_email:
+        return
+
+    payment_id = payment["id"]
+    expected_amount = Money.parse(payment.get("amount"))
+    buyer_name = payment.get("buyer_name")
+    product_name = payment.get("product_name")
+
+    if new_total_paid < expected_amount:
+        balance = expected_amount - new_total_paid
+        subject = "Partial Payment Received"
+        body = f"""
+        <html>
+          <body>
+            <p>Hello {buyer_name},</p>
+            <p>We have received <b>KES {new_total_paid}</b> for <b>{product_name}</b>, 
+            but the expected amount was KES {expected_amount}.</p>
+            <p>You still owe <b>KES {balance}</b>.</p>
+            <p>
+              <a href="https://trustpay-backend.onrender.com/pay-balance/{payment_id}"
+                 style="padding:10px 20px; background-color:orange; color:white; text-decoration:none; border-radius:5px;">
+                 💳 Pay Balance
+              </a>
+            </p>
+            <p>Thank you,<br>TrustPay Team</p>
+          </body>
+        </html>
+        """
+        send_email(buyer_email, subject, body)
+    else:
+        confirm_url = confirm_link(payment_id)
+
+        subject = "Confirm Delivery"
+        body = f"""
+        <html>
+          <body>
+            <p>Hello {buyer_name},</p>
+            <p>Your full payment of <b>KES {new_total_paid}</b> for <b>{product_name}</b> has been received and is being held safely.</p>
+            <p>Please confirm you have received your product:</p>
+            <a href="{confirm_url}"
+               style="padding:10px 20px; background-color:green; color:white; text-decoration:none; border-radius:5px;">
+               ✅ Confirm Delivery
+            </a>
+            <p>Once confirmed, your seller will receive the funds.</p>
+            <br>
+            <p>Thank you,<br>TrustPay Team</p>
+          </body>
+        </html>
+        """
+        send_email(buyer_email, subject, body)
+
 @app.route("/check-pay", methods=["POST"])
-def check_payment():
+@rate_limit(POLL_LIMITS)
+def check_pay():
     data = request.get_json()
     mpesa_number = data.get("mpesa_number")
     payment_id = data.get("payment_id")  # from bal.html
@@ -607,17 +830,9 @@ def check_payment():
         return jsonify({"error": "M-Pesa number or Payment ID is required"}), 400
 
     # Normalize phone number
-    def normalize_number(number):
-        number = number.strip().replace(" ", "").replace("+", "")
-        if number.startswith("0") and len(number) == 10:
-            return "254" + number[1:]
-        elif number.startswith("7") and len(number) == 9:
-            return "254" + number
-        elif number.startswith("254") and len(number) == 12:
-            return number
-        return number
-
-    normalized_number = normalize_number(mpesa_number) if mpesa_number else None
+    normalized_number = try_normalize(mpesa_number)
+    if mpesa_number and normalized_number is None:
+        return jsonify({"error": "Invalid M-Pesa number"}), 400
     print("🔍 Normalized number:", normalized_number)
 
     try:
@@ -646,16 +861,8 @@ def check_payment():
 
         # 3️⃣ Legacy fallback: by phone number (pay.html flow)
         else:
-            payment_response = (
-                supabase.table("payments")
-                .select("*")
-                .or_("paid.eq.False,status.eq.partially-paid")  # ✅ also pick partial
-                .eq("mpesa_number", normalized_number)
-                .order("timestampz", desc=True)
-                .limit(1)
-                .execute()
-            )
-            payment_data = payment_response.data
+            payment = find_open_payment(supabase, normalized_number)
+            payment_data = [payment] if payment else []
 
         print("📦 Matching unpaid/partial payment:", payment_data)
 
@@ -666,143 +873,43 @@ def check_payment():
             }), 200
 
         payment = payment_data[0]
-        payment_id = payment["id"]
-        expected_amount = float(payment.get("amount", 0))
-        buyer_email = payment.get("buyer_email")
-        buyer_name = payment.get("buyer_name")
-        product_name = payment.get("product_name")
+        expected_amount = Money.parse(payment.get("amount"))
 
         # 4️⃣ Match latest unused SMS
-        message_response = (
-            supabase.table("sms_messages")
-            .select("*")
-            .like("message", f"%{normalized_number[-9:]}%")
-            .eq("used", False)
-            .order("id", desc=True)
-            .limit(1)
-            .execute()
-        )
+        sms_row = find_unused_sms(supabase, normalized_number)
 
-        if not message_response.data:
+        if not sms_row:
             return jsonify({
                 "paid": False,
                 "message": "No matching unused payment message found yet"
             }), 200
 
-        sms_row = message_response.data[0]
-        sms_id = sms_row["id"]
-        matched_msg = sms_row["message"]
-        print("📨 Matched SMS:", matched_msg)
-
-        # --- Extract amount ---
-        def extract_amount_simple(msg):
-            if "Ksh" in msg:
-                parts = msg.split("Ksh")
-                if len(parts) > 1:
-                    after_ksh = parts[1].strip()
-                    amount_str = after_ksh.split(" ")[0].replace(",", "")
-                    try:
-                        return float(amount_str)
-                    except ValueError:
-                        return None
-            return None
-
-        paid_amount = extract_amount_simple(matched_msg)
-        print("💰 Extracted amount:", paid_amount)
+        print("📨 Matched SMS:", sms_row["message"])
 
-        # --- Mark SMS as used ---
-        supabase.table("sms_messages").update({"used": True}).eq("id", sms_id).execute()
-
-        # --- Update payment correctly ---
-        update_data = {}
-        if paid_amount is not None:
-            old_paid = float(payment.get("amount_paid", 0))
-            new_total_paid = old_paid + paid_amount
-
-            # ✅ Prevent overpayment
-            if new_total_paid > expected_amount:
-                new_total_paid = expected_amount
-
-            update_data["amount_paid"] = new_total_paid
-
-            # ✅ Update status correctly
-            if new_total_paid >= expected_amount:
-                update_data["paid"] = True
-                update_data["status"] = "paid-held"
-            else:
-                update_data["paid"] = False
-                update_data["status"] = "partially-paid"
-        else:
-            new_total_paid = float(payment.get("amount_paid", 0))
+        # --- Mark SMS as used and credit the payment (same rules as the sweeper) ---
+        result = credit_payment(supabase, payment, sms_row)
+        if result is None:
+            return jsonify({
+                "paid": False,
+                "message": "No matching unused payment message found yet"
+            }), 200
 
-        # --- Save to Supabase ---
-        supabase.table("payments").update(update_data).eq("id", payment_id).execute()
+        update_data, new_total_paid = result
+        amount_paid = Money.parse(update_data.get("amount_paid", 0))
 
         # --- Email logic ---
-        if buyer_email:
-            if new_total_paid < expected_amount:
-                balance = expected_amount - new_total_paid
-                subject = "Partial Payment Received"
-                body = f"""
-                <html>
-                  <body>
-                    <p>Hello {buyer_name},</p>
-                    <p>We have received <b>KES {new_total_paid}</b> for <b>{product_name}</b>, 
-                    but the expected amount was KES {expected_amount}.</p>
-                    <p>You still owe <b>KES {balance}</b>.</p>
-                    <p>
-                      <a href="https://trustpay-backend.onrender.com/pay-balance/{payment_id}"
-                         style="padding:10px 20px; background-color:orange; color:white; text-decoration:none; border-radius:5px;">
-                         💳 Pay Balance
-                      </a>
-                    </p>
-                    <p>Thank you,<br>TrustPay Team</p>
-                  </body>
-                </html>
-                """
-                send_email(buyer_email, subject, body)
-            else:
-                from hashlib import sha256
-                import hmac
-                SECRET_KEY = os.environ.get("SECRET_KEY", "supersecret")
-
-                def generate_secure_token(payment_id: str):
-                    return hmac.new(
-                        SECRET_KEY.encode(),
-                        str(payment_id).encode(),
-                        sha256
-                    ).hexdigest()
-
-                token = generate_secure_token(str(payment_id))
-                confirm_url = f"https://trustpay-backend.onrender.com/confirm-delivery/{payment_id}/{token}"
-
-                subject = "Confirm Delivery"
-                body = f"""
-                <html>
-                  <body>
-                    <p>Hello {buyer_name},</p>
-                    <p>Your full payment of <b>KES {new_total_paid}</b> for <b>{product_name}</b> has been received and is being held safely.</p>
-                    <p>Please confirm you have received your product:</p>
-                    <a href="{confirm_url}"
-                       style="padding:10px 20px; background-color:green; color:white; text-decoration:none; border-radius:5px;">
-                       ✅ Confirm Delivery
-                    </a>
-                    <p>Once confirmed, your seller will receive the funds.</p>
-                    <br>
-                    <p>Thank you,<br>TrustPay Team</p>
-                  </body>
-                </html>
-                """
-                send_email(buyer_email, subject, body)
+        notify_buyer(payment, new_total_paid)
 
         return jsonify({
             "paid": update_data.get("paid", False),
             "status": update_data.get("status", "unknown"),
             "message": "Payment updated successfully",
-            "amount_paid": update_data.get("amount_paid", 0),
-            "balance": expected_amount - update_data.get("amount_paid", 0)
+            "amount_paid": amount_paid.amount,
+            "balance": (expected_amount - amount_paid).amount
         }), 200
 
+    except InvalidTransition as e:
+        return jsonify({"error": str(e)}), 409
     except Exception as e:
         print("❌ Error in check-payment:", e)
         return jsonify({"error": str(e)}), 500
@@ -824,6 +931,9 @@ def check_payment_status():
 
 # ===================== PRODUCTS.HTML ROUTE =====================
 @app.route('/products-page', methods=['GET'])
+@conditional_json
+@seller_auth
+@rate_limit(SELLER_LIMITS)
 def get_products_page():
     """
     Specil route used ONLY for products.html.
@@ -831,7 +941,7 @@ def get_products_page():
     without touching payments table.
     """
     try:
-        user_id = request.args.get('user_id')
+        user_id = g.user_id
         if not user_id:
             return jsonify({"error": "Missing user_id"}), 400
 
@@ -849,9 +959,12 @@ def get_products_page():
         return jsonify({"error": str(e)}), 500
         
 @app.route('/buyer-transactions', methods=['GET'])
+@conditional_json
+@seller_auth
+@rate_limit(SELLER_LIMITS)
 def get_buyer_transactions():
     try:
-        user_id = request.args.get('user_id')
+        user_id = g.user_id
         if not user_id:
             return jsonify({"error": "Missing user_id"}), 400
 
@@ -868,29 +981,154 @@ def get_buyer_transactions():
         return jsonify({"error": str(e)}), 500
 
 
+@app.route('/payment-events', methods=['GET'])
+@seller_auth(required=True)
+@rate_limit(SELLER_LIMITS)
+def get_payment_events():
+    """
+    Status changes for a seller's payments after event id `after`, oldest first.
+    Dashboards keep the last id they saw and only fetch the delta.
+    """
+    try:
+        user_id = g.user_id
+        if not user_id:
+            return jsonify({"error": "Missing user_id"}), 400
+        after = int(request.args.get('after', 0))
+        limit = min(int(request.args.get('limit', 200)), 1000)
+
+        response = (
+            supabase.table('payment_events')
+            .select('id, payment_id, from_status, to_status, amount_paid, reason, created_at')
+            .eq('user_id', user_id)
+            .gt('id', after)
+            .order('id')
+            .limit(limit)
+            .execute()
+        )
+        events = response.data or []
+
+        return jsonify({
+            "events": events,
+            "next": events[-1]["id"] if events else after
+        }), 200
 
-from hashlib import sha256
-import hmac
+    except ValueError:
+        return jsonify({"error": "after and limit must be integers"}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/buyer-transactions/changes', methods=['GET'])
+@seller_auth(required=True)
+@rate_limit(SELLER_LIMITS)
+def get_buyer_transaction_changes():
+    """
+    Payments changed since `since` (cursor from the previous call).
+    Without `since` it starts from the beginning, paging by `limit`.
+    """
+    try:
+        user_id = g.user_id
+        if not user_id:
+            return jsonify({"error": "Missing user_id"}), 400
+        limit = min(int(request.args.get('limit', FEED_PAGE_SIZE)), 1000)
+
+        rows, cursor = fetch_changes(supabase, user_id, request.args.get('since'), limit)
+
+        return jsonify({
+            "changes": rows,
+            "cursor": cursor,
+            "has_more": len(rows) == limit
+        }), 200
+
+    except (InvalidCursor, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/buyer-transactions/stream', methods=['GET'])
+@seller_auth(required=True)
+def stream_buyer_transactions():
+    """
+    Same feed as /buyer-transactions/changes, pushed as server-sent events.
+    """
+    user_id = g.user_id
+    if not user_id:
+        return jsonify({"error": "Missing user_id"}), 400
+
+    cursor = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        if cursor:
+            decode_cursor(cursor)
+    except InvalidCursor as e:
+        return jsonify({"error": str(e)}), 400
+
+    events = stream_changes(supabase, user_id, cursor, app.json.dumps)
+    return Response(stream_with_context(events), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+@app.route('/webhooks', methods=['POST'])
+@seller_auth(required=True)
+def add_webhook():
+    """
+    Register a URL for payment webhooks. The signing secret is only shown here.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        user_id = g.user_id
+        if not user_id:
+            return jsonify({"error": "Missing user_id"}), 400
+
+        endpoint = create_endpoint(supabase, user_id, data.get("url"))
+        return jsonify({
+            "id": endpoint["id"],
+            "url": endpoint["url"],
+            "secret": endpoint["secret"],
+            "events": [f"payment.{event}" for event in WEBHOOK_EVENTS]
+        }), 201
+    except InvalidWebhookUrl as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print("❌ Error in add-webhook:", e)
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/webhooks', methods=['GET'])
+@seller_auth(required=True)
+def get_webhooks():
+    try:
+        user_id = g.user_id
+        if not user_id:
+            return jsonify({"error": "Missing user_id"}), 400
+        return jsonify(list_endpoints(supabase, user_id)), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/webhooks/<endpoint_id>', methods=['DELETE'])
+@seller_auth(required=True)
+def remove_webhook(endpoint_id):
+    try:
+        user_id = g.user_id
+        if not user_id:
+            return jsonify({"error": "Missing user_id"}), 400
+        if not delete_endpoint(supabase, user_id, endpoint_id):
+            return jsonify({"error": "Webhook not found"}), 404
+        return jsonify({"message": "Webhook removed"}), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
 @app.route("/confirm-delivery/<payment_id>/<token>", methods=["GET"])
 def confirm_delivery(payment_id, token):
     try:
-        SECRET_KEY = os.environ.get("SECRET_KEY", "supersecret")
-
         # 🔐 Verify token
-        expected_token = hmac.new(
-            SECRET_KEY.encode(),
-            str(payment_id).encode(),
-            sha256
-        ).hexdigest()
-
-        if token != expected_token:
+        try:
+            verify_confirm_token(payment_id, token)
+        except InvalidToken:
             return "❌ Invalid or expired confirmation link.", 400
 
-        # ✅ Update payment status to paid-released
-        supabase.table("payments").update({
-            "status": "paid-released"
-        }).eq("id", payment_id).execute()
+        # ✅ Release held funds (only a paid-held payment can move to paid-released)
+        outcome, _ = release(supabase, payment_id, "confirm-delivery")
+        if outcome == NOT_RELEASABLE:
+            return "⚠️ This payment can't be released: it is not fully paid yet.", 409
 
         return """
         <html>
@@ -923,10 +1161,40 @@ def pay_balance(payment_id):
 
 @app.route("/release-payment/<payment_id>", methods=["POST"])
 def release_payment(payment_id):
+    """
+    Release a held payment on the buyer's say-so. Body: {"token": <confirm-delivery
+    token>} or {"auth_token": <the payment's auth_token>}.
+    """
+    data = request.get_json(silent=True) or {}
+    token = data.get("token")
+    auth_token = data.get("auth_token")
+
     try:
-        supabase.table("payments").update({
-            "status": "paid-released"
-        }).eq("id", payment_id).execute()
+        # 🔐 Only the buyer may release: a confirm link token or the payment's own token
+        if token:
+            try:
+                verify_confirm_token(payment_id, token)
+            except InvalidToken as e:
+                return jsonify({"error": str(e)}), 403
+        elif auth_token:
+            owner = (
+                supabase.table("payments")
+                .select("id")
+                .eq("id", payment_id)
+                .eq("auth_token", auth_token)
+                .limit(1)
+                .execute()
+            )
+            if not owner.data:
+                return jsonify({"error": "Invalid payment token"}), 403
+        else:
+            return jsonify({"error": "token or auth_token is required"}), 401
+
+        outcome, _ = release(supabase, payment_id, "release-payment")
+        if outcome == NOT_RELEASABLE:
+            return jsonify({"error": "Payment is not fully paid yet"}), 409
+        if outcome == ALREADY_RELEASED:
+            return jsonify({"message": "Payment was already released"}), 200
 
         return jsonify({"message": "✅ Payment released successfully"}), 200
     except Exception as e:
@@ -934,6 +1202,8 @@ def release_payment(payment_id):
         return jsonify({"error": "Could not release payment"}), 500
 
 @app.route("/get-payment/<payment_id>", methods=["GET"])
+@rate_limit(READ_LIMITS)
+@conditional_json
 def get_payment(payment_id):
     try:
         response = supabase.table("payments").select("*").eq("id", payment_id).single().execute()
@@ -953,7 +1223,12 @@ def get_payment(payment_id):
 def update_balance(payment_id):
     try:
         data = request.get_json()
-        extra_paid = float(data.get("amount_paid", 0))  # New installment
+        try:
+            extra_paid = Money.parse(data.get("amount_paid", 0))  # New installment
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if extra_paid.cents <= 0:
+            return jsonify({"error": "amount_paid must be greater than 0"}), 400
 
         # --- Fetch payment record ---
         payment = supabase.table("payments").select("*").eq("id", payment_id).single().execute()
@@ -965,8 +1240,8 @@ def update_balance(payment_id):
         buyer_name = payment_data.get("buyer_name", "Customer")
         product_name = payment_data.get("product_name", "Product")
 
-        current_paid = float(payment_data.get("amount_paid", 0))
-        expected_amount = float(payment_data.get("amount", 0))
+        current_paid = Money.parse(payment_data.get("amount_paid"))
+        expected_amount = Money.parse(payment_data.get("amount"))
 
         # --- Add new installment ---
         new_total_paid = current_paid + extra_paid
@@ -974,27 +1249,19 @@ def update_balance(payment_id):
             new_total_paid = expected_amount  # prevent overpayment
 
         fully_paid = new_total_paid >= expected_amount
-        status = "paid-held" if fully_paid else "partially-paid"
+        status = status_for(new_total_paid, expected_amount)
 
-        # --- Update Supabase record ---
-        supabase.table("payments").update({
-            "amount_paid": new_total_paid,
-            "paid": fully_paid,
-            "status": status
-        }).eq("id", payment_id).execute()
+        # --- Update Supabase record (compare-and-set against what we just read) ---
+        updated = transition(supabase, payment_data, status, {"amount_paid": new_total_paid.amount}, reason="update-balance")
+        if updated is None:
+            return jsonify({"error": "Payment was updated by another request, please retry"}), 409
+        open_payments.track(updated)
 
         # --- Send email notifications ---
         if buyer_email:
-            from hashlib import sha256
-            import hmac
-            SECRET_KEY = os.environ.get("SECRET_KEY", "supersecret")
-            def generate_secure_token(pid: str):
-                return hmac.new(SECRET_KEY.encode(), pid.encode(), sha256).hexdigest()
-
             if fully_paid:
                 # ✅ Final payment: confirm delivery
-                token = generate_secure_token(str(payment_id))
-                confirm_url = f"https://trustpay-backend.onrender.com/confirm-delivery/{payment_id}/{token}"
+                confirm_url = confirm_link(payment_id)
                 subject = "Confirm Delivery of Your Purchase"
                 body = f"""
                 <html>
@@ -1015,7 +1282,7 @@ def update_balance(payment_id):
                 send_email(buyer_email, subject, body)
             else:
                 # 🔄 Partial payment: send "Pay Next Installment" email
-                remaining = round(expected_amount - new_total_paid, 2)
+                remaining = expected_amount - new_total_paid
                 subject = "Installment Payment Received"
                 body = f"""
                 <html>
@@ -1038,11 +1305,13 @@ def update_balance(payment_id):
 
         return jsonify({
             "message": "Payment updated successfully",
-            "new_total_paid": new_total_paid,
+            "new_total_paid": new_total_paid.amount,
             "status": status,
             "confirm_email_sent": fully_paid
         }), 200
 
+    except InvalidTransition as e:
+        return jsonify({"error": str(e)}), 409
     except Exception as e:
         print("❌ Error in update-balance:", e)
         return jsonify({"error": str(e)}), 500
@@ -1050,5 +1319,11 @@ def update_balance(payment_id):
 
 
 if __name__ == '__main__':
+    open_payments.start_sync(supabase)
+    start_realtime(supabase)
+    seen_codes.start_warm(supabase)
+    start_sweeper(supabase, notify_buyer)
+    start_payout_engine(supabase)
+    start_webhooks(supabase)
     port = int(os.environ.get('PORT', 10000))
     app.run(debug=False, host='0.0.0.0', port=port)
@@ -0,0 +1,6 @@
+-- Watermark for the background SMS sweeper (sweeper.py).
+create table if not exists sweeper_state (
+    name text primary key,
+    last_id bigint not null default 0,
+    updated_at timestamptz not null default now()
+);
@@ -0,0 +1,14 @@
+-- Append-only log of payment status changes (payment_state.py).
+create table if not exists payment_events (
+    id bigserial primary key,
+    payment_id text not null,
+    user_id text,
+    from_status text,
+    to_status text not null,
+    amount_paid numeric,
+    reason text,
+    created_at timestamptz not null default now()
+);
+
+create index if not exists payment_events_user_id_id_idx on payment_events (user_id, id);
+create index if not exists payment_events_payment_id_idx on payment_events (payment_id);
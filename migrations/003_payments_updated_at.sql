@@ -0,0 +1,18 @@
+-- updated_at on payments, backing the /buyer-transactions/changes feed (change_feed.py).
+alter table payments add column if not exists updated_at timestamptz not null default now();
+
+create index if not exists payments_user_id_updated_at_id_idx on payments (user_id, updated_at, id);
+
+-- The app stamps updated_at on every write; the trigger keeps it honest for
+-- writes made anywhere else (dashboard, SQL editor, other services).
+create or replace function set_updated_at() returns trigger as $$
+begin
+    new.updated_at = now();
+    return new;
+end;
+$$ language plpgsql;
+
+drop trigger if exists payments_set_updated_at on payments;
+create trigger payments_set_updated_at
+    before insert or update on payments
+    for each row execute function set_updated_at();
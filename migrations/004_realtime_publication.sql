@@ -0,0 +1,6 @@
+-- Stream payments and sms_messages changes to the realtime cache worker (realtime_sync.py).
+alter publication supabase_realtime add table payments, sms_messages;
+
+-- Send the primary key of deleted rows so the caches can drop them.
+alter table payments replica identity full;
+alter table sms_messages replica identity full;
@@ -0,0 +1,12 @@
+-- One payout per released payment (release.py). The unique payment_id makes
+-- a second emit for the same payment fail instead of paying the seller twice.
+create table if not exists payouts (
+    id bigserial primary key,
+    payment_id text not null unique,
+    user_id text not null,
+    amount numeric not null,
+    status text not null default 'pending',
+    created_at timestamptz not null default now()
+);
+
+create index if not exists payouts_status_user_id_idx on payouts (status, user_id);
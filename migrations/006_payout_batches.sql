@@ -0,0 +1,20 @@
+-- Per-seller payout batches built by payout_engine.py from pending payouts.
+-- reference is derived from the payouts it covers, so re-running a chunk
+-- after a crash upserts the same batch instead of creating a second one.
+create table if not exists payout_batches (
+    id bigserial primary key,
+    reference text not null unique,
+    user_id text not null,
+    phone text,
+    gross numeric not null,
+    fee numeric not null default 0,
+    net numeric not null,
+    payment_count integer not null,
+    file text,
+    status text not null default 'ready',
+    created_at timestamptz not null default now()
+);
+
+alter table payouts add column if not exists batch_reference text;
+
+create index if not exists payout_batches_user_id_idx on payout_batches (user_id, id);
@@ -0,0 +1,7 @@
+-- M-Pesa transaction code of each stored SMS (sms_dedup.py). The unique index
+-- rejects a replayed confirmation even if two copies arrive at once.
+-- Rows stored before this column existed keep a null code.
+alter table sms_messages add column if not exists transaction_code text;
+
+create unique index if not exists sms_messages_transaction_code_key
+    on sms_messages (transaction_code);
@@ -0,0 +1,32 @@
+-- Seller webhooks (webhooks.py).
+-- webhook_endpoints: where a seller wants payment events delivered, and the
+-- secret their receiver uses to check our signature.
+create table if not exists webhook_endpoints (
+    id bigserial primary key,
+    user_id text not null,
+    url text not null,
+    secret text not null,
+    active boolean not null default true,
+    created_at timestamptz not null default now()
+);
+
+create index if not exists webhook_endpoints_user_id_idx on webhook_endpoints (user_id) where active;
+
+-- webhook_outbox: one row per (event, endpoint), written when the payment
+-- changes state and worked off by the dispatcher with retries.
+create table if not exists webhook_outbox (
+    id bigserial primary key,
+    endpoint_id bigint not null references webhook_endpoints (id) on delete cascade,
+    user_id text not null,
+    event_type text not null,
+    payload jsonb not null,
+    status text not null default 'pending',     -- pending | sending | delivered | dead
+    attempts integer not null default 0,
+    next_attempt_at timestamptz not null default now(),
+    claimed_at timestamptz,
+    last_error text,
+    delivered_at timestamptz,
+    created_at timestamptz not null default now()
+);
+
+create index if not exists webhook_outbox_due_idx on webhook_outbox (status, next_attempt_at);
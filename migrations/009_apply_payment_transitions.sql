@@ -0,0 +1,40 @@
+-- Batched payment status changes (payment_state.transition_many). Applies each
+-- change as the same compare-and-set transition() does - status must still be
+-- from_status, and amount_paid must still be expected_amount_paid when given -
+-- in array order, so a later change to the same payment sees the earlier one.
+-- Returns the array index and new row of every change that won.
+create or replace function apply_payment_transitions(changes jsonb)
+returns table (idx integer, payment jsonb)
+language plpgsql
+as $$
+declare
+    change jsonb;
+    target payments;
+    updated payments;
+begin
+    for i in 0 .. coalesce(jsonb_array_length(changes), 0) - 1 loop
+        change := changes -> i;
+        -- Cast the id to the column's own type so the primary key index is used
+        target := jsonb_populate_record(null::payments, jsonb_build_object('id', change -> 'id'));
+
+        update payments p set
+            status = change -> 'set' ->> 'status',
+            paid = (change -> 'set' ->> 'paid')::boolean,
+            amount_paid = case when change -> 'set' ? 'amount_paid'
+                               then (change -> 'set' ->> 'amount_paid')::numeric
+                               else p.amount_paid end,
+            updated_at = coalesce((change -> 'set' ->> 'updated_at')::timestamptz, now())
+        where p.id = target.id
+          and p.status = change ->> 'from_status'
+          and (change ->> 'expected_amount_paid' is null
+               or p.amount_paid = (change ->> 'expected_amount_paid')::numeric)
+        returning * into updated;
+
+        if found then
+            idx := i;
+            payment := to_jsonb(updated);
+            return next;
+        end if;
+    end loop;
+end;
+$$;
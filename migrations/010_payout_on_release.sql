@@ -0,0 +1,54 @@
+-- Payouts are written by the database in the same statement that releases the
+-- payment (release.py), so a release can no longer commit without its payout.
+-- The unique payment_id on payouts keeps it to one per payment.
+create or replace function emit_payout() returns trigger as $$
+begin
+    if new.user_id is not null then
+        insert into payouts (payment_id, user_id, amount, status)
+        values (new.id::text, new.user_id::text, new.amount::numeric, 'pending')
+        on conflict (payment_id) do nothing;
+    end if;
+    return new;
+end;
+$$ language plpgsql;
+
+drop trigger if exists payments_emit_payout on payments;
+create trigger payments_emit_payout
+    after update of status on payments
+    for each row
+    when (new.status = 'paid-released' and old.status is distinct from new.status)
+    execute function emit_payout();
+
+-- Releases from before this migration were paid out outside this table, so
+-- the safety net below only ever looks at releases after it ran.
+create table if not exists payout_settings (
+    id boolean primary key default true check (id),
+    missing_payouts_since timestamptz not null default now()
+);
+insert into payout_settings default values on conflict (id) do nothing;
+
+-- Safety net for releases without a payout row (released by hand with the
+-- trigger disabled). payout_engine.py calls it at the start of every run.
+-- Only payments whose release was logged after missing_payouts_since count.
+-- Returns the number of payouts added.
+create or replace function queue_missing_payouts() returns integer as $$
+declare
+    added integer;
+begin
+    insert into payouts (payment_id, user_id, amount, status)
+    select p.id::text, p.user_id::text, p.amount::numeric, 'pending'
+    from payments p
+    where p.status = 'paid-released'
+      and p.user_id is not null
+      and not exists (select 1 from payouts o where o.payment_id = p.id::text)
+      and exists (
+          select 1 from payment_events e, payout_settings s
+          where e.payment_id = p.id::text
+            and e.to_status = 'paid-released'
+            and e.created_at >= s.missing_payouts_since
+      )
+    on conflict (payment_id) do nothing;
+    get diagnostics added = row_count;
+    return added;
+end;
+$$ language plpgsql;
@@ -0,0 +1,85 @@
+-- Crash-safe payout batching (payout_engine.py). A batch is created and its
+-- payouts claimed in one transaction, under a reference taken from the
+-- batch's own id, before any disbursement file exists; a batch is then put
+-- into exactly one file, whose content is stored here rather than on the
+-- web dyno's ephemeral disk.
+
+-- B2C bulk disbursement files, one per settle run chunk.
+create table if not exists payout_files (
+    id bigserial primary key,
+    name text not null unique,
+    batch_count integer not null,
+    total numeric not null,
+    content text not null,
+    created_at timestamptz not null default now()
+);
+
+-- Claim pending payouts of one seller into a new ready batch. Totals come
+-- from the payouts actually claimed, in cents; the fee (fee_bps basis points)
+-- is rounded down. Returns the batch row, or null if none were still pending.
+create or replace function claim_payout_batch(
+    p_user_id text, p_phone text, p_payout_ids bigint[], p_fee_bps integer default 0
+) returns jsonb as $$
+declare
+    v_id bigint := nextval(pg_get_serial_sequence('payout_batches', 'id'));
+    v_reference text := 'PB' || v_id;
+    v_count integer;
+    v_gross bigint;
+    v_fee bigint;
+    v_batch payout_batches;
+begin
+    with claimed as (
+        update payouts
+        set status = 'batched', batch_reference = v_reference
+        where id = any(p_payout_ids) and user_id = p_user_id and status = 'pending'
+        returning amount
+    )
+    select count(*), coalesce(sum(round(amount * 100)), 0)::bigint
+    into v_count, v_gross
+    from claimed;
+
+    if v_count = 0 then
+        return null;
+    end if;
+
+    v_fee := v_gross * p_fee_bps / 10000;
+    insert into payout_batches (id, reference, user_id, phone, gross, fee, net, payment_count, status)
+    values (v_id, v_reference, p_user_id, p_phone, round(v_gross / 100.0, 2), round(v_fee / 100.0, 2),
+            round((v_gross - v_fee) / 100.0, 2), v_count, 'ready')
+    returning * into v_batch;
+    return to_jsonb(v_batch);
+end;
+$$ language plpgsql;
+
+-- Put every ready batch that has no file yet into a new file called p_name.
+-- Returns the payout_files row, or null when there was nothing to file.
+create or replace function file_payout_batches(p_name text) returns jsonb as $$
+declare
+    v_file payout_files;
+begin
+    with filed as (
+        update payout_batches
+        set file = p_name, status = 'filed'
+        where status = 'ready' and file is null
+        returning id, phone, net, reference
+    )
+    insert into payout_files (name, batch_count, total, content)
+    select p_name, count(*), sum(net),
+           'Phone Number,Amount,Reference' || E'\n'
+           || string_agg(phone || ',' || net || ',' || reference, E'\n' order by id) || E'\n'
+    from filed
+    having count(*) > 0
+    returning * into v_file;
+
+    if not found then
+        return null;
+    end if;
+    return to_jsonb(v_file);
+end;
+$$ language plpgsql;
+
+-- Batches held for a missing phone number were never revisited; hand their
+-- payouts back so the engine batches them once the seller has a number.
+update payouts set status = 'pending', batch_reference = null
+where batch_reference in (select reference from payout_batches where status = 'held');
+delete from payout_batches where status = 'held';
@@ -0,0 +1,70 @@
+-- payment_events rows are written by the database in the same statement as
+-- the payment change (payment_state.py), so the /payment-events deltas can't
+-- drift from the payments table when a separate insert fails. The app says
+-- why a row changed in last_change_reason; creations default to "created".
+alter table payments add column if not exists last_change_reason text;
+
+create or replace function record_payment_event() returns trigger as $$
+begin
+    insert into payment_events (payment_id, user_id, from_status, to_status, amount_paid, reason)
+    values (
+        new.id::text,
+        new.user_id::text,
+        case when tg_op = 'UPDATE' then old.status end,
+        new.status,
+        new.amount_paid,
+        coalesce(new.last_change_reason, case when tg_op = 'INSERT' then 'created' end)
+    );
+    return new;
+end;
+$$ language plpgsql;
+
+drop trigger if exists payments_record_event_insert on payments;
+create trigger payments_record_event_insert
+    after insert on payments
+    for each row execute function record_payment_event();
+
+drop trigger if exists payments_record_event_update on payments;
+create trigger payments_record_event_update
+    after update of status, amount_paid on payments
+    for each row
+    when (old.status is distinct from new.status or old.amount_paid is distinct from new.amount_paid)
+    execute function record_payment_event();
+
+-- apply_payment_transitions (migrations/009) also writes the reason now
+create or replace function apply_payment_transitions(changes jsonb)
+returns table (idx integer, payment jsonb)
+language plpgsql
+as $$
+declare
+    change jsonb;
+    target payments;
+    updated payments;
+begin
+    for i in 0 .. coalesce(jsonb_array_length(changes), 0) - 1 loop
+        change := changes -> i;
+        -- Cast the id to the column's own type so the primary key index is used
+        target := jsonb_populate_record(null::payments, jsonb_build_object('id', change -> 'id'));
+
+        update payments p set
+            status = change -> 'set' ->> 'status',
+            paid = (change -> 'set' ->> 'paid')::boolean,
+            amount_paid = case when change -> 'set' ? 'amount_paid'
+                               then (change -> 'set' ->> 'amount_paid')::numeric
+                               else p.amount_paid end,
+            last_change_reason = change -> 'set' ->> 'last_change_reason',
+            updated_at = coalesce((change -> 'set' ->> 'updated_at')::timestamptz, now())
+        where p.id = target.id
+          and p.status = change ->> 'from_status'
+          and (change ->> 'expected_amount_paid' is null
+               or p.amount_paid = (change ->> 'expected_amount_paid')::numeric)
+        returning * into updated;
+
+        if found then
+            idx := i;
+            payment := to_jsonb(updated);
+            return next;
+        end if;
+    end loop;
+end;
+$$;
@@ -0,0 +1,107 @@
+from array import array
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from functools import total_ordering
+
+# Money as integer cents. Amounts come in from JSON, Supabase numeric columns
+# and SMS text; parsing goes through Decimal so "1,000.10" is exactly 100010
+# cents, and from then on all sums and comparisons are plain int arithmetic.
+
+CENT = Decimal("0.01")
+# Far above any real payment, far below array('q') / bigint limits even summed
+MAX_CENTS = 10 ** 14
+
+
+def to_cents(value):
+    """
+    Parse an amount (int, float, str or Decimal, commas allowed) into integer cents.
+    None and "" count as zero. Raises ValueError for anything else unparseable
+    and for amounts beyond MAX_CENTS.
+    """
+    if value is None or value == "":
+        return 0
+    if isinstance(value, Money):
+        return value.cents
+    if isinstance(value, bool):
+        raise ValueError(f"Invalid amount: {value!r}")
+    if isinstance(value, int):
+        cents = value * 100
+    else:
+        try:
+            # str() first: Decimal(0.1) would carry the float's binary error along
+            amount = Decimal(str(value).strip().replace(",", ""))
+            if not amount.is_finite() or abs(amount) * 100 > MAX_CENTS:
+                raise ValueError
+            cents = int(amount.quantize(CENT, rounding=ROUND_HALF_UP) * 100)
+        except (ArithmeticError, ValueError):
+            # InvalidOperation is an ArithmeticError, callers only expect ValueError
+            raise ValueError(f"Invalid amount: {value!r}")
+    if abs(cents) > MAX_CENTS:
+        raise ValueError(f"Invalid amount: {value!r}")
+    return cents
+
+
+@total_ordering
+class Money:
+    __slots__ = ("cents",)
+
+    def __init__(self, cents=0):
+        self.cents = int(cents)
+
+    @classmethod
+    def parse(cls, value):
+        return cls(to_cents(value))
+
+    @property
+    def amount(self):
+        """
+        JSON/Supabase friendly number: int for whole shillings, float otherwise.
+        """
+        whole, cents = divmod(self.cents, 100)
+        return whole if cents == 0 else self.cents / 100
+
+    def __add__(self, other):
+        return Money(self.cents + other.cents)
+
+    def __sub__(self, other):
+        return Money(self.cents - other.cents)
+
+    def __neg__(self):
+        return Money(-self.cents)
+
+    def __eq__(self, other):
+        if not isinstance(other, Money):
+            return NotImplemented
+        return self.cents == other.cents
+
+    def __lt__(self, other):
+        if not isinstance(other, Money):
+            return NotImplemented
+        return self.cents < other.cents
+
+    def __hash__(self):
+        return hash(self.cents)
+
+    def __bool__(self):
+        return self.cents != 0
+
+    def __str__(self):
+        sign = "-" if self.cents < 0 else ""
+        whole, cents = divmod(abs(self.cents), 100)
+        return f"{sign}{whole:,}.{cents:02d}"
+
+    def __repr__(self):
+        return f"Money({self.cents})"
+
+
+ZERO = Money(0)
+
+
+def cents_array(values):
+    """
+    Parse many amounts at once into a compact array('q') of cents for bulk reports.
+    """
+    return array("q", (to_cents(v) for v in values))
+
+
+def total(values):
+    return Money(sum(cents_array(values)))
@@ -0,0 +1,203 @@
+import os
+import time
+import threading
+from bisect import bisect_left, bisect_right, insort
+
+from money import to_cents
+
+# In-process index of open payments (unpaid or partially-paid), keyed by
+# normalized M-Pesa number. Lets the legacy number lookup in the check routes
+# answer "is there an open payment for this number, and which one is newest"
+# without asking Supabase. Warmed at boot, kept current by the write paths in
+# main.py / reconcile.py, and rebuilt from the database every
+# OPEN_PAYMENTS_RESYNC seconds to pick up anything written elsewhere.
+# A second, amount-sorted view (expected and remaining amount per payment)
+# serves the amount matcher for SMS that don't name the buyer's number.
+
+OPEN_PAYMENTS_RESYNC = int(os.environ.get("OPEN_PAYMENTS_RESYNC", 300))
+WARM_PAGE_SIZE = 1000
+INDEX_COLUMNS = "id, mpesa_number, timestampz, amount, amount_paid, paid, status"
+
+
+class OpenPayment:
+    # amount / amount_paid are integer cents
+    __slots__ = ("timestampz", "id", "amount", "amount_paid")
+
+    def __init__(self, timestampz, id, amount, amount_paid):
+        self.timestampz = timestampz
+        self.id = id
+        self.amount = amount
+        self.amount_paid = amount_paid
+
+    def __lt__(self, other):
+        return (self.timestampz, str(self.id)) < (other.timestampz, str(other.id))
+
+    def amount_keys(self):
+        # Expected amount and what is still owed, each once
+        return {(self.amount, str(self.id)), (self.amount - self.amount_paid, str(self.id))}
+
+
+def is_open(row):
+    return row.get("paid") is False or row.get("status") == "partially-paid"
+
+
+class OpenPaymentsIndex:
+    def __init__(self):
+        self.by_number = {}   # number -> [OpenPayment] sorted oldest .. newest
+        self.number_of = {}   # payment id -> number
+        self.records = {}     # str(payment id) -> OpenPayment
+        self.by_amount = []   # sorted (cents, str(id)) for expected and remaining amounts
+        self.lock = threading.Lock()
+        self.ready = False
+        self.pending = None   # writes seen while a warm query is in flight
+        # One warm at a time: the resync thread and realtime reconnects both
+        # warm, and a second warm would replace the first one's pending writes
+        self.warm_lock = threading.Lock()
+
+    def _remove(self, payment_id):
+        number = self.number_of.pop(payment_id, None)
+        if number is None:
+            return
+        for key in self.records.pop(str(payment_id)).amount_keys():
+            position = bisect_left(self.by_amount, key)
+            if position < len(self.by_amount) and self.by_amount[position] == key:
+                del self.by_amount[position]
+        records = [r for r in self.by_number.get(number, []) if r.id != payment_id]
+        if records:
+            self.by_number[number] = records
+        else:
+            self.by_number.pop(number, None)
+
+    def _add(self, row):
+        number = row.get("mpesa_number")
+        if not number:
+            return
+        record = OpenPayment(
+            row.get("timestampz") or "",
+            row["id"],
+            to_cents(row.get("amount")),
+            to_cents(row.get("amount_paid"))
+        )
+        insort(self.by_number.setdefault(number, []), record)
+        self.number_of[row["id"]] = number
+        self.records[str(row["id"])] = record
+        for key in record.amount_keys():
+            insort(self.by_amount, key)
+
+    def track(self, row):
+        """
+        Record the latest known state of a payment row; closed payments drop out.
+        """
+        with self.lock:
+            self._remove(row["id"])
+            if is_open(row):
+                self._add(row)
+            if self.pending is not None:
+                self.pending[row["id"]] = row
+
+    def discard(self, payment_id):
+        with self.lock:
+            self._remove(payment_id)
+            if self.pending is not None:
+                self.pending[payment_id] = None
+
+    def latest(self, number):
+        """
+        Newest open payment for a number, or None.
+        """
+        with self.lock:
+            records = self.by_number.get(number)
+            return records[-1] if records else None
+
+    def with_amount(self, low, high):
+        """
+        Open payments whose expected or remaining amount is within [low, high] cents.
+        """
+        with self.lock:
+            start = bisect_left(self.by_amount, (low, ""))
+            end = bisect_right(self.by_amount, (high, "\uffff"))
+            ids = dict.fromkeys(payment_id for _, payment_id in self.by_amount[start:end])
+            return [self.records[payment_id] for payment_id in ids]
+
+    def load(self, rows):
+        by_number, number_of, records_by_id, by_amount = {}, {}, {}, []
+        for row in rows:
+            number = row.get("mpesa_number")
+            if not number or not is_open(row):
+                continue
+            record = OpenPayment(
+                row.get("timestampz") or "",
+                row["id"],
+                to_cents(row.get("amount")),
+                to_cents(row.get("amount_paid"))
+            )
+            by_number.setdefault(number, []).append(record)
+            number_of[row["id"]] = number
+            records_by_id[str(row["id"])] = record
+            by_amount.extend(record.amount_keys())
+        for records in by_number.values():
+            records.sort()
+        by_amount.sort()
+
+        with self.lock:
+            self.by_number = by_number
+            self.number_of = number_of
+            self.records = records_by_id
+            self.by_amount = by_amount
+            # Replay writes that raced with the warm query so they aren't lost
+            for payment_id, row in (self.pending or {}).items():
+                self._remove(payment_id)
+                if row is not None and is_open(row):
+                    self._add(row)
+            self.pending = None
+            self.ready = True
+
+    def warm(self, supabase):
+        with self.warm_lock:
+            with self.lock:
+                self.pending = {}
+            try:
+                rows = []
+                start = 0
+                while True:
+                    response = (
+                        supabase.table("payments")
+                        .select(INDEX_COLUMNS)
+                        .or_("paid.eq.False,status.eq.partially-paid")
+                        .order("id")
+                        .range(start, start + WARM_PAGE_SIZE - 1)
+                        .execute()
+                    )
+                    page = response.data or []
+                    rows.extend(page)
+                    if len(page) < WARM_PAGE_SIZE:
+                        break
+                    start += WARM_PAGE_SIZE
+            except Exception:
+                with self.lock:
+                    self.pending = None
+                raise
+
+            self.load(rows)
+        print(f"📇 Open payments index warmed: {len(self.number_of)} payments")
+
+    def run_sync(self, supabase, interval):
+        while True:
+            try:
+                self.warm(supabase)
+            except Exception as e:
+                print("⚠️ Error warming open payments index:", e)
+            time.sleep(interval)
+
+    def start_sync(self, supabase, interval=OPEN_PAYMENTS_RESYNC):
+        thread = threading.Thread(
+            target=self.run_sync,
+            args=(supabase, interval),
+            name="open_payments_index",
+            daemon=True
+        )
+        thread.start()
+        return thread
+
+
+open_payments = OpenPaymentsIndex()
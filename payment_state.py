@@ -0,0 +1,193 @@
+from datetime import datetime
+
+import webhooks
+from write_batcher import WriteBatcher
+
+# Payment state machine.
+# Every status change goes through transition(), which checks the move is
+# allowed and then does a compare-and-set update (.eq("status", current)) so
+# two requests racing on the same payment can't both win. Each successful
+# change is appended to the payment_events table (migrations/002) for
+# dashboards to read as deltas - by a trigger in the same statement
+# (migrations/012_payment_event_trigger.sql), with the reason taken from
+# payments.last_change_reason - and queued as seller webhooks (webhooks.py).
+#
+# transition_many() does the same for a batch of payments in one round trip
+# (migrations/009_apply_payment_transitions.sql); payment_writes coalesces
+# concurrent callers into those batches (write_batcher.py).
+
+NOT_PAID = "Not paid"
+PARTIALLY_PAID = "partially-paid"
+PAID_HELD = "paid-held"
+PAID_RELEASED = "paid-released"
+
+PAID_STATES = {PAID_HELD, PAID_RELEASED}
+
+# Columns transition_many() can set (the ones apply_payment_transitions writes)
+BATCH_COLUMNS = {"status", "paid", "amount_paid", "last_change_reason", "updated_at"}
+
+TRANSITIONS = {
+    None: {NOT_PAID},                                  # creation
+    NOT_PAID: {PARTIALLY_PAID, PAID_HELD},
+    PARTIALLY_PAID: {PARTIALLY_PAID, PAID_HELD},       # another installment
+    PAID_HELD: {PAID_RELEASED},
+    PAID_RELEASED: set(),
+}
+
+
+class InvalidTransition(Exception):
+    def __init__(self, from_status, to_status):
+        self.from_status = from_status
+        self.to_status = to_status
+        super().__init__(f"Cannot move payment from '{from_status}' to '{to_status}'")
+
+
+def can_transition(from_status, to_status):
+    return to_status in TRANSITIONS.get(from_status, set())
+
+
+def status_for(amount_paid, expected_amount):
+    """
+    Status a payment should be in after a credit (both Money).
+    """
+    return PAID_HELD if amount_paid >= expected_amount else PARTIALLY_PAID
+
+
+def record_events(supabase, changes):
+    """
+    Queue seller webhooks for a batch of (row, from_status, reason) changes.
+    The payment_events rows are already written by the database trigger.
+    """
+    webhooks.enqueue(supabase, [(row, from_status) for row, from_status, _ in changes])
+
+
+def record_event(supabase, row, from_status, reason=None):
+    record_events(supabase, [(row, from_status, reason)])
+
+
+def transition(supabase, payment, to_status, changes=None, reason=None):
+    """
+    Move `payment` (the row as last read) to `to_status`, applying `changes` too.
+    Returns the updated row, or None if the row changed underneath us
+    (status, or amount_paid when it is being changed). Raises InvalidTransition
+    for moves the state machine doesn't allow.
+    """
+    from_status = payment.get("status")
+    update_data = transition_update(payment, to_status, changes, reason)
+
+    query = (
+        supabase.table("payments")
+        .update(update_data)
+        .eq("id", payment["id"])
+        .eq("status", from_status)
+    )
+    if "amount_paid" in update_data and payment.get("amount_paid") is not None:
+        # Two installments landing together must not overwrite each other
+        query = query.eq("amount_paid", payment["amount_paid"])
+
+    response = query.execute()
+    if not response.data:
+        return None
+
+    row = response.data[0]
+    record_event(supabase, row, from_status, reason)
+    return row
+
+
+def transition_update(payment, to_status, changes=None, reason=None):
+    from_status = payment.get("status")
+    if not can_transition(from_status, to_status):
+        raise InvalidTransition(from_status, to_status)
+
+    update_data = {
+        "status": to_status,
+        "paid": to_status in PAID_STATES,
+        "last_change_reason": reason,
+        "updated_at": datetime.utcnow().isoformat()
+    }
+    update_data.update(changes or {})
+    return update_data
+
+
+def is_missing_function(e):
+    return getattr(e, "code", None) == "PGRST202"
+
+
+_batch_function = True   # False once apply_payment_transitions turned out not to be deployed
+
+
+def transition_many(supabase, moves):
+    """
+    transition() for a batch of (payment, to_status, changes, reason) moves in
+    one round trip. Moves apply in order, so a second move of the same payment
+    is checked against the first one's result. Returns one entry per move: the
+    updated row, None if it lost its compare-and-set, or the error for it
+    (InvalidTransition; ValueError for changes outside BATCH_COLUMNS).
+    """
+    global _batch_function
+
+    results = [None] * len(moves)
+    batch = []
+    for index, (payment, to_status, changes, reason) in enumerate(moves):
+        try:
+            update_data = transition_update(payment, to_status, changes, reason)
+        except InvalidTransition as e:
+            results[index] = e
+            continue
+        unsupported = set(update_data) - BATCH_COLUMNS
+        if unsupported:
+            results[index] = ValueError(f"transition_many can't change {', '.join(sorted(unsupported))}")
+            continue
+        expected = payment.get("amount_paid") if "amount_paid" in update_data else None
+        batch.append((index, {
+            "id": payment["id"],
+            "from_status": payment.get("status"),
+            "expected_amount_paid": expected,
+            "set": update_data
+        }))
+    if not batch:
+        return results
+
+    if _batch_function:
+        try:
+            response = supabase.rpc("apply_payment_transitions", {
+                "changes": [change for _, change in batch]
+            }).execute()
+        except Exception as e:
+            if not is_missing_function(e):
+                raise
+            print("⚠️ apply_payment_transitions is missing (migrations/009), updating payments one by one")
+            _batch_function = False
+
+    if not _batch_function:
+        for index, _ in batch:
+            payment, to_status, changes, reason = moves[index]
+            results[index] = transition(supabase, payment, to_status, changes, reason)
+        return results
+
+    events = []
+    for won in response.data or []:
+        index = batch[won["idx"]][0]
+        payment, _, _, reason = moves[index]
+        results[index] = won["payment"]
+        events.append((won["payment"], payment.get("status"), reason))
+    record_events(supabase, events)
+    return results
+
+
+payment_writes = WriteBatcher("payment_writes", transition_many)
+
+
+def created(supabase, row):
+    """
+    Hook for a payment row that was inserted as NOT_PAID (the event itself is
+    written by the insert trigger).
+    """
+    record_event(supabase, row, None, "created")
+
+
+def created_many(supabase, rows):
+    """
+    created() for a batch of payments.
+    """
+    record_events(supabase, [(row, None, "created") for row in rows])
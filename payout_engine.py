@@ -0,0 +1,161 @@
+import os
+import time
+import threading
+from datetime import datetime
+
+from phone import normalize_numbers
+
+# Settlement: turns pending payouts (one per released payment, written with
+# the release, see migrations/010_payout_on_release.sql) into one payout batch
+# per seller and a B2C bulk disbursement file per chunk.
+#
+# Every run first queues payouts for released payments that lack one, then
+# reads pending payouts in id order, CHUNK_SIZE at a time, and groups them by
+# user_id. Each seller's batch is created and its payouts claimed in one
+# database call (claim_payout_batch, migrations/011_payout_claims.sql): the
+# reference is the batch's own id and only still-pending payouts are taken,
+# summed in integer cents with the platform fee (PAYOUT_FEE_BPS basis points)
+# rounded down. Ready batches are then put into a file in a second call
+# (file_payout_batches), which stores the CSV in payout_files and can take a
+# batch only once. A run that dies half way leaves claimed batches ready for
+# the next run to file; no payout can end up in two batches or files.
+#
+# Sellers without a valid payout phone number are skipped; their payouts stay
+# pending until they add one. Set PAYOUT_DIR to also write each file to disk.
+
+ENGINE_NAME = "payout_engine"
+PAYOUT_INTERVAL = int(os.environ.get("PAYOUT_INTERVAL", 3600))   # seconds, 0 disables
+PAYOUT_CHUNK_SIZE = int(os.environ.get("PAYOUT_CHUNK_SIZE", 1000))
+PAYOUT_FEE_BPS = int(os.environ.get("PAYOUT_FEE_BPS", 0))
+PAYOUT_DIR = os.environ.get("PAYOUT_DIR")
+
+PENDING = "pending"
+BATCHED = "batched"
+
+
+def payouts_by_seller(payouts):
+    """
+    {user_id: [payout ids]}, in first-seen order.
+    """
+    ids = {}
+    for payout in payouts:
+        ids.setdefault(payout["user_id"], []).append(payout["id"])
+    return ids
+
+
+def seller_phones(supabase, user_ids):
+    response = supabase.table("users").select("id, phone").in_("id", list(user_ids)).execute()
+    rows = response.data or []
+    numbers = normalize_numbers([row.get("phone") for row in rows])
+    return {str(row["id"]): number for row, number in zip(rows, numbers) if number}
+
+
+def save_local_copy(payout_file, directory=PAYOUT_DIR):
+    if not directory:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{payout_file['name']}.csv")
+    with open(path, "w", newline="") as f:
+        f.write(payout_file["content"])
+    return path
+
+
+def claim_batches(supabase, payouts, fee_bps=PAYOUT_FEE_BPS):
+    """
+    Claim one chunk of pending payouts into per-seller batches. Returns the
+    batches created.
+    """
+    groups = payouts_by_seller(payouts)
+    phones = seller_phones(supabase, groups)
+
+    batches = []
+    for user_id, ids in groups.items():
+        phone = phones.get(str(user_id))
+        if not phone:
+            print(f"⚠️ Seller {user_id} has no payout phone number; {len(ids)} payouts left pending")
+            continue
+        batch = supabase.rpc("claim_payout_batch", {
+            "p_user_id": str(user_id),
+            "p_phone": phone,
+            "p_payout_ids": ids,
+            "p_fee_bps": fee_bps
+        }).execute().data
+        if batch:
+            batches.append(batch)
+    return batches
+
+
+def file_batches(supabase, directory=PAYOUT_DIR):
+    """
+    Put every ready batch into a new disbursement file. Returns the
+    payout_files row, or None when nothing was ready.
+    """
+    name = f"b2c-{datetime.utcnow():%Y%m%d%H%M%S%f}"
+    payout_file = supabase.rpc("file_payout_batches", {"p_name": name}).execute().data
+    if not payout_file:
+        return None
+    save_local_copy(payout_file, directory)
+    print(f"💸 Disbursement file {payout_file['name']}: {payout_file['batch_count']} batches, {payout_file['total']} total")
+    return payout_file
+
+
+def settle_once(supabase, chunk_size=PAYOUT_CHUNK_SIZE, directory=PAYOUT_DIR):
+    """
+    Batch every pending payout, chunk by chunk. Returns the number of batches.
+    """
+    # Payments released since migration 010 that somehow have no payout row
+    queued = supabase.rpc("queue_missing_payouts").execute().data
+    if queued:
+        print(f"💸 Queued {queued} missing payouts for released payments")
+
+    # Batches a previous run claimed but never got into a file
+    file_batches(supabase, directory)
+
+    total = 0
+    last_id = 0
+    while True:
+        response = (
+            supabase.table("payouts")
+            .select("id, user_id, amount")
+            .eq("status", PENDING)
+            .gt("id", last_id)
+            .order("id")
+            .limit(chunk_size)
+            .execute()
+        )
+        payouts = response.data or []
+        if not payouts:
+            break
+
+        batches = claim_batches(supabase, payouts)
+        file_batches(supabase, directory)
+        total += len(batches)
+        print(f"💸 Batched {sum(batch['payment_count'] for batch in batches)} payouts into {len(batches)} seller payouts")
+
+        last_id = payouts[-1]["id"]
+        if len(payouts) < chunk_size:
+            break
+
+    return total
+
+
+def run_payouts(supabase, interval=PAYOUT_INTERVAL):
+    while True:
+        try:
+            settle_once(supabase)
+        except Exception as e:
+            print("⚠️ Error in payout engine:", e)
+        time.sleep(interval)
+
+
+def start_payout_engine(supabase, interval=PAYOUT_INTERVAL):
+    if interval <= 0:
+        return None
+    thread = threading.Thread(
+        target=run_payouts,
+        args=(supabase, interval),
+        name=ENGINE_NAME,
+        daemon=True
+    )
+    thread.start()
+    return thread
@@ -0,0 +1,65 @@
+import os
+import re
+from functools import lru_cache
+
+# Kenyan mobile numbers (MSISDNs) in one canonical form: 2547XXXXXXXX or
+# 2541XXXXXXXX, digits only. Accepts what buyers and sellers actually type:
+# 0712 345 678, 0112-345-678, +254712345678, 254712345678, 00254..., 712345678.
+# Anything else is rejected instead of being passed through, so a typo can't
+# end up as a LIKE pattern against sms_messages.
+#
+# Hot numbers (the same buyer polling /check-pay) are memoized in a bounded LRU;
+# normalize_numbers() handles whole columns for bulk imports and reports.
+
+PHONE_CACHE_SIZE = int(os.environ.get("PHONE_CACHE_SIZE", 4096))
+
+SEPARATORS_RE = re.compile(r"[\s\-().]")
+MSISDN_RE = re.compile(r"(?:\+254|00254|254|0)?([17]\d{8})")
+
+
+class InvalidNumber(ValueError):
+    def __init__(self, number):
+        self.number = number
+        super().__init__(f"Invalid M-Pesa number: {number!r}")
+
+
+@lru_cache(maxsize=PHONE_CACHE_SIZE)
+def _canonical(number):
+    match = MSISDN_RE.fullmatch(SEPARATORS_RE.sub("", number))
+    return "254" + match.group(1) if match else None
+
+
+def normalize_number(number):
+    """
+    Canonical 254XXXXXXXXX form of a Kenyan mobile number; raises InvalidNumber.
+    """
+    canonical = _canonical(str(number)) if number is not None else None
+    if canonical is None:
+        raise InvalidNumber(number)
+    return canonical
+
+
+def try_normalize(number):
+    """
+    Like normalize_number(), but None for anything that isn't a valid number.
+    """
+    return _canonical(str(number)) if number is not None else None
+
+
+def is_valid_number(number):
+    return try_normalize(number) is not None
+
+
+def normalize_numbers(numbers):
+    """
+    Normalize a batch in one pass: canonical form or None per input, in order.
+    Repeated numbers are only worked out once.
+    """
+    seen = {}
+    result = []
+    for number in numbers:
+        key = str(number) if number is not None else None
+        if key not in seen:
+            seen[key] = _canonical(key) if key is not None else None
+        result.append(seen[key])
+    return result
@@ -0,0 +1,152 @@
+import os
+import sys
+import hmac
+import time
+import threading
+from collections import Counter
+
+from flask import request, jsonify, g, Response
+
+# Sampling profiler for live diagnosis (bcrypt vs JSON encoding vs SMS parsing).
+# A background thread snapshots the stacks of the other threads every
+# PROFILE_INTERVAL seconds via sys._current_frames() and counts them; the
+# result is a collapsed-stack file ("frame;frame;frame count" per line) that
+# flamegraph.pl, speedscope or inferno render directly.
+#
+#   GET /debug/profile?seconds=10   profile this worker process for a while
+#   any route with ?profile=1       profile just that request and return the
+#                                   stacks instead of the normal response
+#                                   (only with PROFILE_REQUESTS=1, e.g. staging)
+#
+# Both need PROFILER_TOKEN in an X-Profiler-Token header; without the env
+# var the whole thing is off and /debug/profile answers 404. Under gunicorn
+# each worker is its own process, so a profile covers the worker that served it.
+
+PROFILER_TOKEN = os.environ.get("PROFILER_TOKEN")
+PROFILE_REQUESTS = os.environ.get("PROFILE_REQUESTS", "0") == "1"
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", 0.005))
+PROFILE_MAX_SECONDS = 60
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapse(frame):
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+class Sampler:
+    """
+    Counts stacks of every other thread (or only `thread_id`) until stopped.
+    """
+    def __init__(self, interval=PROFILE_INTERVAL, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            frames = sys._current_frames()
+            if self.thread_id is not None:
+                frame = frames.get(self.thread_id)
+                if frame is not None:
+                    self.stacks[collapse(frame)] += 1
+            else:
+                for thread_id, frame in frames.items():
+                    if thread_id != own:
+                        self.stacks[collapse(frame)] += 1
+            self.samples += 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self
+
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+_busy = threading.Lock()
+
+
+def profile_for(seconds, interval=PROFILE_INTERVAL):
+    """
+    Sample the whole process for `seconds`. Returns the sampler, or None if a
+    profile is already running.
+    """
+    if not _busy.acquire(blocking=False):
+        return None
+    try:
+        sampler = Sampler(interval).start()
+        time.sleep(seconds)
+        return sampler.stop()
+    finally:
+        _busy.release()
+
+
+def authorized():
+    supplied = request.headers.get("X-Profiler-Token", "")
+    return bool(PROFILER_TOKEN) and hmac.compare_digest(supplied.encode(), PROFILER_TOKEN.encode())
+
+
+def collapsed_response(sampler, name):
+    return Response(sampler.collapsed(), mimetype="text/plain", headers={
+        "Content-Disposition": f'attachment; filename="{name}.collapsed"',
+        "X-Profile-Samples": str(sampler.samples)
+    })
+
+
+def init_profiler(app):
+    """
+    Register /debug/profile and the ?profile=1 request mode when PROFILER_TOKEN is set.
+    """
+    if not PROFILER_TOKEN:
+        return
+
+    @app.route("/debug/profile", methods=["GET"])
+    def debug_profile():
+        if not authorized():
+            return jsonify({"error": "Unauthorized"}), 401
+        try:
+            seconds = float(request.args.get("seconds", 10))
+            interval = float(request.args.get("interval", PROFILE_INTERVAL))
+        except ValueError:
+            return jsonify({"error": "seconds and interval must be numbers"}), 400
+        if not 0 < seconds <= PROFILE_MAX_SECONDS or not 0.001 <= interval <= 1:
+            return jsonify({"error": f"seconds must be in (0, {PROFILE_MAX_SECONDS}], interval in [0.001, 1]"}), 400
+
+        sampler = profile_for(seconds, interval)
+        if sampler is None:
+            return jsonify({"error": "A profile is already running"}), 409
+        return collapsed_response(sampler, f"profile-{int(time.time())}")
+
+    if not PROFILE_REQUESTS:
+        return
+
+    @app.before_request
+    def start_request_profile():
+        if request.args.get("profile") == "1" and authorized():
+            g.request_sampler = Sampler(interval=0.001, thread_id=threading.get_ident()).start()
+
+    @app.after_request
+    def finish_request_profile(response):
+        sampler = g.pop("request_sampler", None)
+        if sampler is None:
+            return response
+        sampler.stop()
+        return collapsed_response(sampler, f"request-{request.endpoint or 'unknown'}")
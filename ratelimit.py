@@ -0,0 +1,200 @@
+import os
+import math
+import time
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from flask import request, jsonify, g
+
+from phone import try_normalize
+
+# Token-bucket rate limiting for the polling and auth routes.
+# A limit is a (scope, rate, burst) tuple: `rate` tokens per second refill a
+# bucket holding at most `burst` tokens, one token per request. Buckets are
+# keyed per scope value (client IP, user_id, M-Pesa number, payment_id, email).
+#
+# Buckets live in process memory by default. Set RATE_LIMIT_REDIS_URL to share
+# them between workers/instances through Redis (or anything speaking its protocol);
+# the app then refuses to start if the Redis client can't be set up, rather
+# than quietly limiting per process.
+
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "1") != "0"
+RATE_LIMIT_REDIS_URL = os.environ.get("RATE_LIMIT_REDIS_URL")
+# Proxies in front of the app that append to X-Forwarded-For (Render: 1)
+TRUSTED_PROXY_HOPS = int(os.environ.get("TRUSTED_PROXY_HOPS", 1))
+
+# Frontend polls every few seconds; allow bursts but stop runaway loops
+POLL_LIMITS = [
+    ("ip", 2, 30),
+    ("mpesa_number", 1, 10),
+    ("payment_id", 1, 10),
+]
+# bcrypt is deliberately slow, keep login attempts scarce
+LOGIN_LIMITS = [
+    ("ip", 0.2, 10),
+    ("email", 0.05, 5),
+]
+READ_LIMITS = [
+    ("ip", 5, 50),
+    ("payment_id", 2, 20),
+]
+# Seller dashboard routes; goes under @seller_auth so user_id is the caller's
+SELLER_LIMITS = [
+    ("ip", 5, 50),
+    ("user_id", 5, 50),
+]
+
+
+class MemoryBackend:
+    """
+    Buckets in an LRU dict guarded by a lock. Good for a single process.
+    """
+
+    MAX_KEYS = 50000
+
+    def __init__(self, max_keys=MAX_KEYS):
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst, cost=1):
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+
+            if tokens >= cost:
+                self.buckets[key] = (tokens - cost, now)
+                allowed, retry_after = True, 0
+            else:
+                self.buckets[key] = (tokens, now)
+                allowed, retry_after = False, (cost - tokens) / rate
+            self.buckets.move_to_end(key)
+
+            # Drop the least recently used buckets; each pop is O(1)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+
+        return allowed, retry_after
+
+
+TOKEN_BUCKET_LUA = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local retry = 0
+if tokens >= cost then
+  tokens = tokens - cost
+  allowed = 1
+else
+  retry = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(retry)}
+"""
+
+
+class RedisBackend:
+    """
+    Buckets shared through Redis. The refill/take runs as one Lua script so
+    concurrent workers can't both spend the last token.
+    """
+
+    def __init__(self, client, prefix="ratelimit:"):
+        self.prefix = prefix
+        self.script = client.register_script(TOKEN_BUCKET_LUA)
+
+    def take(self, key, rate, burst, cost=1):
+        allowed, retry_after = self.script(
+            keys=[self.prefix + key],
+            args=[rate, burst, time.time(), cost]
+        )
+        return bool(int(allowed)), float(retry_after)
+
+
+def make_backend():
+    if RATE_LIMIT_REDIS_URL:
+        try:
+            import redis
+            return RedisBackend(redis.from_url(RATE_LIMIT_REDIS_URL))
+        except Exception as e:
+            raise RuntimeError(f"RATE_LIMIT_REDIS_URL is set but the Redis rate limiter can't be used: {e}") from e
+    return MemoryBackend()
+
+
+backend = make_backend()
+
+
+def client_ip():
+    """
+    The address our own proxy saw. Everything left of the hops it appended to
+    X-Forwarded-For comes from the client and can be made up.
+    """
+    hops = [hop.strip() for hop in request.headers.get("X-Forwarded-For", "").split(",") if hop.strip()]
+    if TRUSTED_PROXY_HOPS > 0 and len(hops) >= TRUSTED_PROXY_HOPS:
+        return hops[-TRUSTED_PROXY_HOPS]
+    return request.remote_addr or "unknown"
+
+
+def scope_value(scope):
+    data = request.get_json(silent=True) or {}
+    if scope == "ip":
+        return client_ip()
+    if scope == "mpesa_number":
+        number = data.get("mpesa_number")
+        return (try_normalize(number) or str(number).strip()) if number else None
+    if scope == "payment_id":
+        return (request.view_args or {}).get("payment_id") or data.get("payment_id")
+    if scope == "user_id":
+        return g.get("user_id") or request.args.get("user_id") or data.get("user_id")
+    if scope == "email":
+        email = data.get("email")
+        return email.strip().lower() if isinstance(email, str) else None
+    return None
+
+
+def check_limits(limits, endpoint):
+    """
+    Spend one token from each bucket that applies to this request, ip first,
+    stopping at the first one that is empty: a throttled client must not keep
+    creating buckets for made-up payment ids or numbers.
+    Returns the number of seconds to wait, or 0 if the request may go through.
+    """
+    for scope, rate, burst in sorted(limits, key=lambda limit: limit[0] != "ip"):
+        value = scope_value(scope)
+        if value is None:
+            continue
+        allowed, wait = backend.take(f"{endpoint}:{scope}:{value}", rate, burst)
+        if not allowed:
+            return wait
+    return 0
+
+
+def rate_limit(limits):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if RATE_LIMIT_ENABLED:
+                try:
+                    retry_after = check_limits(limits, request.endpoint)
+                except Exception as e:
+                    # A broken limiter must never take the API down with it
+                    print("⚠️ Rate limiter error:", e)
+                    retry_after = 0
+
+                if retry_after:
+                    response = jsonify({"error": "Too many requests, please slow down."})
+                    response.status_code = 429
+                    response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+                    return response
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
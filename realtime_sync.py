@@ -0,0 +1,154 @@
+import os
+import time
+import threading
+
+from payment_index import open_payments
+from sms_cache import unused_sms
+from payment_state import PAID_RELEASED
+from release import released_ids
+from sms_dedup import seen_codes
+
+# Keeps the in-process caches (open payments index, unused SMS cache) hot from
+# database change events instead of re-reading payments / sms_messages.
+#
+# Sources:
+#   SupabaseRealtimeSource - postgres_changes over Supabase Realtime
+#                            (tables must be in the supabase_realtime publication,
+#                            see migrations/004_realtime_publication.sql)
+#   LocalSource            - in-process stand-in; call emit() to feed changes
+#                            (tests, or local runs without a realtime server)
+#
+# Whenever the subscription (re)connects both caches are re-warmed from the
+# database, so events missed while disconnected are never lost. While it is
+# down the SMS cache is marked not live and the routes read the table directly.
+
+REALTIME_SOURCE = os.environ.get("REALTIME_SOURCE", "supabase")   # supabase | local | off
+REALTIME_TABLES = ("payments", "sms_messages")
+RECONNECT_DELAY = 5
+
+
+class LocalSource:
+    def __init__(self):
+        self.on_change = None
+        self.on_state = None
+
+    def start(self, on_change, on_state):
+        self.on_change = on_change
+        self.on_state = on_state
+        on_state(True)
+
+    def emit(self, table, event_type, record=None, old_record=None):
+        self.on_change(table, event_type, record or {}, old_record or {})
+
+    def disconnect(self):
+        self.on_state(False)
+
+
+class SupabaseRealtimeSource:
+    def __init__(self, url, key):
+        self.url = url.rstrip("/") + "/realtime/v1"
+        self.key = key
+
+    def start(self, on_change, on_state):
+        thread = threading.Thread(
+            target=self.run,
+            args=(on_change, on_state),
+            name="realtime_sync",
+            daemon=True
+        )
+        thread.start()
+        return thread
+
+    def run(self, on_change, on_state):
+        import asyncio
+
+        while True:
+            try:
+                asyncio.run(self.listen(on_change, on_state))
+            except Exception as e:
+                print("⚠️ Realtime connection lost:", e)
+            on_state(False)
+            time.sleep(RECONNECT_DELAY)
+
+    async def listen(self, on_change, on_state):
+        import asyncio
+        from realtime import AsyncRealtimeClient, RealtimeSubscribeStates
+
+        client = AsyncRealtimeClient(self.url, self.key)
+        await client.connect()
+        channel = client.channel("trustpay-caches")
+
+        def dispatch(payload):
+            data = payload.get("data", {})
+            on_change(data.get("table"), data.get("type"), data.get("record") or {}, data.get("old_record") or {})
+
+        for table in REALTIME_TABLES:
+            channel.on_postgres_changes("*", schema="public", table=table, callback=dispatch)
+
+        closed = asyncio.Event()
+
+        def subscribed(state, error):
+            if state == RealtimeSubscribeStates.SUBSCRIBED:
+                # Warming does blocking HTTP calls, keep it off the event loop
+                threading.Thread(target=on_state, args=(True,), daemon=True).start()
+            else:
+                print("⚠️ Realtime channel state:", state, error or "")
+                closed.set()
+
+        await channel.subscribe(subscribed)
+        await closed.wait()
+        await client.close()
+
+
+class RealtimeSync:
+    def __init__(self, supabase):
+        self.supabase = supabase
+
+    def on_state(self, healthy):
+        if not healthy:
+            unused_sms.live = False
+            return
+        try:
+            open_payments.warm(self.supabase)
+            unused_sms.warm(self.supabase)
+            unused_sms.live = True
+        except Exception as e:
+            print("⚠️ Error warming realtime caches:", e)
+            unused_sms.pending = None
+            unused_sms.live = False
+
+    def on_change(self, table, event_type, record, old_record):
+        event_type = getattr(event_type, "value", event_type)
+        if table == "payments":
+            if event_type == "DELETE":
+                if old_record.get("id") is not None:
+                    open_payments.discard(old_record["id"])
+            elif record.get("id") is not None:
+                open_payments.track(record)
+                if record.get("status") == PAID_RELEASED:
+                    released_ids.add(record["id"])
+        elif table == "sms_messages":
+            if event_type == "DELETE":
+                if old_record.get("id") is not None:
+                    unused_sms.discard(old_record["id"])
+            else:
+                unused_sms.apply(record)
+                if record.get("transaction_code"):
+                    seen_codes.add(record["transaction_code"])
+
+
+def start_realtime(supabase, source=None):
+    """
+    Start keeping the caches hot. Returns the source, or None when disabled.
+    """
+    if source is None:
+        if REALTIME_SOURCE == "off":
+            return None
+        if REALTIME_SOURCE == "local":
+            source = LocalSource()
+        else:
+            source = SupabaseRealtimeSource(os.environ.get("SUPABASE_URL"), os.environ.get("SUPABASE_KEY"))
+
+    sync = RealtimeSync(supabase)
+    source.start(sync.on_change, sync.on_state)
+    return source
@@ -0,0 +1,287 @@
+import re
+
+from money import Money
+from payment_index import open_payments, is_open
+from resilience import deadline_at
+from sms_cache import unused_sms
+from write_batcher import WriteBatcher
+from payment_state import PAID_HELD, InvalidTransition, can_transition, status_for, transition_many, payment_writes
+
+# Shared SMS <-> payment matching rules.
+# Used by the /check-pay route and by the background sweeper (sweeper.py),
+# so a payment is credited the same way no matter who finds the SMS first.
+# Claims and payment updates go through write batchers (write_batcher.py), so
+# concurrent requests share round trips; the sweeper settles whole batches
+# with credit_many().
+
+OPEN_PAYMENTS_FILTER = "paid.eq.False,status.eq.partially-paid"
+
+# Kenyan numbers as they show up inside M-Pesa messages (2547..., 07..., 7...)
+SMS_NUMBER_RE = re.compile(r"(?<!\d)(?:\+?254|0)?([17]\d{8})(?!\d)")
+
+
+def extract_amount_simple(msg):
+    """
+    Amount after the first "Ksh" in an SMS as Money, or None if there isn't one.
+    """
+    if "Ksh" in msg:
+        parts = msg.split("Ksh")
+        if len(parts) > 1:
+            after_ksh = parts[1].strip()
+            amount_str = after_ksh.split(" ")[0].rstrip(".")
+            try:
+                return Money.parse(amount_str)
+            except ValueError:
+                return None
+    return None
+
+
+def numbers_in_sms(msg):
+    """
+    Return the normalized phone numbers found in an SMS, in order, without duplicates.
+    """
+    found = []
+    for core in SMS_NUMBER_RE.findall(msg or ""):
+        number = "254" + core
+        if number not in found:
+            found.append(number)
+    return found
+
+
+def find_open_payment(supabase, normalized_number):
+    """
+    Latest unpaid or partially-paid payment for a number (legacy /check-pay lookup).
+    Answered from the open payments index once it is warm; only a hit costs a
+    primary-key read to fetch the full row.
+    """
+    if open_payments.ready:
+        record = open_payments.latest(normalized_number)
+        if record is None:
+            return None
+        response = supabase.table("payments").select("*").eq("id", record.id).limit(1).execute()
+        if response.data and is_open(response.data[0]):
+            return response.data[0]
+        # Index was stale (closed elsewhere); forget it and ask the database
+        open_payments.discard(record.id)
+
+    response = (
+        supabase.table("payments")
+        .select("*")
+        .or_(OPEN_PAYMENTS_FILTER)
+        .eq("mpesa_number", normalized_number)
+        .order("timestampz", desc=True)
+        .limit(1)
+        .execute()
+    )
+    return response.data[0] if response.data else None
+
+
+def has_payment(supabase, normalized_number):
+    """
+    Whether any payment, open or not, was ever made out to this number.
+    """
+    response = (
+        supabase.table("payments")
+        .select("id")
+        .eq("mpesa_number", normalized_number)
+        .limit(1)
+        .execute()
+    )
+    return bool(response.data)
+
+
+def find_unused_sms(supabase, normalized_number):
+    """
+    Newest unused SMS mentioning the number's last 9 digits. Served from the
+    realtime-fed cache while it is live, from sms_messages otherwise.
+    """
+    fragment = normalized_number[-9:]
+    if unused_sms.live:
+        return unused_sms.latest_containing(fragment)
+
+    response = (
+        supabase.table("sms_messages")
+        .select("*")
+        .like("message", f"%{fragment}%")
+        .eq("used", False)
+        .order("id", desc=True)
+        .limit(1)
+        .execute()
+    )
+    return response.data[0] if response.data else None
+
+
+def claim_many(supabase, sms_ids):
+    """
+    Mark a batch of SMS as used in one conditional update. Returns one bool per
+    id, True where this caller won the claim; an id listed twice wins only once.
+    """
+    unique = list(dict.fromkeys(sms_ids))
+    response = (
+        supabase.table("sms_messages")
+        .update({"used": True})
+        .in_("id", unique)
+        .eq("used", False)
+        .execute()
+    )
+    # Used either way now: by us, or by whoever beat us to it
+    for sms_id in unique:
+        unused_sms.discard(sms_id)
+
+    won = {str(row["id"]) for row in response.data or []}
+    results = []
+    for sms_id in sms_ids:
+        results.append(str(sms_id) in won)
+        won.discard(str(sms_id))
+    return results
+
+
+sms_claims = WriteBatcher("sms_claims", claim_many)
+
+
+def claim_sms(supabase, sms_id):
+    """
+    Mark an SMS as used only if nobody else has. Returns True when this caller won
+    the claim, so the same message can never be credited twice.
+    """
+    return sms_claims.write(supabase, sms_id)
+
+
+def unclaim_many(supabase, sms_ids):
+    """
+    Hand claimed SMS back when the payment updates they were meant for lost a race.
+    """
+    if sms_ids:
+        supabase.table("sms_messages").update({"used": False}).in_("id", list(sms_ids)).execute()
+
+
+def unclaim_sms(supabase, sms_id):
+    unclaim_many(supabase, [sms_id])
+
+
+def apply_credit(payment, paid_amount):
+    """
+    Work out the payment update for an SMS amount (Money).
+    Returns (update_data, new_total_paid); update_data is empty when no amount was found.
+    """
+    expected_amount = Money.parse(payment.get("amount"))
+    update_data = {}
+    if paid_amount is not None:
+        old_paid = Money.parse(payment.get("amount_paid"))
+        new_total_paid = old_paid + paid_amount
+
+        # Prevent overpayment
+        if new_total_paid > expected_amount:
+            new_total_paid = expected_amount
+
+        update_data["amount_paid"] = new_total_paid.amount
+        update_data["status"] = status_for(new_total_paid, expected_amount)
+        update_data["paid"] = update_data["status"] == PAID_HELD
+    else:
+        new_total_paid = Money.parse(payment.get("amount_paid"))
+
+    return update_data, new_total_paid
+
+
+def settle_sms(supabase, payment, sms_id, to_status, new_total_paid):
+    """
+    Claim an SMS and move its payment to `to_status` with the new total (Money).
+    Returns the updated payment row, or None if the SMS was already used or the
+    payment changed underneath us (the SMS is handed back in that case).
+    Raises InvalidTransition before touching anything if the move isn't allowed.
+    """
+    if not can_transition(payment.get("status"), to_status):
+        raise InvalidTransition(payment.get("status"), to_status)
+
+    if not claim_sms(supabase, sms_id):
+        return None
+
+    try:
+        row = payment_writes.write(supabase, (
+            payment, to_status,
+            {"amount_paid": new_total_paid.amount},
+            f"sms:{sms_id}"
+        ))
+    except Exception:
+        # The credit failed: hand the SMS back so the sweeper can retry it,
+        # even if the request's own budget is what ran out
+        try:
+            with deadline_at(None):
+                unclaim_sms(supabase, sms_id)
+        except Exception as e:
+            print(f"⚠️ Could not hand back SMS {sms_id}:", e)
+        raise
+    if row is None:
+        unclaim_sms(supabase, sms_id)
+        return None
+
+    open_payments.track(row)
+    return row
+
+
+def credit_payment(supabase, payment, sms_row):
+    """
+    Claim an SMS and credit its amount to a payment.
+    Returns (update_data, new_total_paid), or None if the SMS was already used or
+    the payment changed while we were crediting it. Raises InvalidTransition if
+    the payment can't take a credit (e.g. already paid-held).
+    """
+    paid_amount = extract_amount_simple(sms_row["message"])
+    print("💰 Extracted amount:", paid_amount)
+
+    update_data, new_total_paid = apply_credit(payment, paid_amount)
+    if update_data:
+        row = settle_sms(supabase, payment, sms_row["id"], update_data["status"], new_total_paid)
+        if row is None:
+            return None
+    elif not claim_sms(supabase, sms_row["id"]):
+        return None
+
+    return update_data, new_total_paid
+
+
+def credit_many(supabase, pairs):
+    """
+    credit_payment() for a batch of (payment, sms_row) pairs: one claim for all
+    the SMS, one write for all the payments. Each payment should appear once,
+    as read before any of these credits. Returns one entry per pair, what
+    credit_payment() would return or the InvalidTransition it would raise.
+    """
+    results = [None] * len(pairs)
+    credits = []
+    for index, (payment, sms_row) in enumerate(pairs):
+        update_data, new_total_paid = apply_credit(payment, extract_amount_simple(sms_row["message"]))
+        if update_data and not can_transition(payment.get("status"), update_data["status"]):
+            results[index] = InvalidTransition(payment.get("status"), update_data["status"])
+            continue
+        credits.append((index, update_data, new_total_paid))
+    if not credits:
+        return results
+
+    claimed = claim_many(supabase, [pairs[index][1]["id"] for index, _, _ in credits])
+    moves = []
+    for (index, update_data, new_total_paid), won in zip(credits, claimed):
+        if not won:
+            continue
+        if not update_data:
+            results[index] = update_data, new_total_paid
+            continue
+        payment, sms_row = pairs[index]
+        moves.append((index, update_data, new_total_paid, (
+            payment, update_data["status"],
+            {"amount_paid": new_total_paid.amount},
+            f"sms:{sms_row['id']}"
+        )))
+    if not moves:
+        return results
+
+    rows = transition_many(supabase, [move for _, _, _, move in moves])
+    lost = []
+    for (index, update_data, new_total_paid, _), row in zip(moves, rows):
+        if isinstance(row, dict):
+            open_payments.track(row)
+            results[index] = update_data, new_total_paid
+        else:
+            lost.append(pairs[index][1]["id"])
+    unclaim_many(supabase, lost)
+    return results
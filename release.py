@@ -0,0 +1,60 @@
+import threading
+from collections import OrderedDict
+
+from payment_state import PAID_HELD, PAID_RELEASED, transition
+
+# Releasing held funds to the seller (confirm-delivery link, /release-payment).
+# The release itself is the single conditional update paid-held -> paid-released
+# in transition(), so double clicks and retries can't release twice. The seller
+# payout is inserted by a trigger on that same update
+# (migrations/010_payout_on_release.sql), so a release never commits without
+# its payout, and the unique payment_id on payouts keeps it to one.
+# Ids known to be released are remembered so repeated clicks on the email
+# link are answered without touching the database.
+
+RELEASED = "released"
+ALREADY_RELEASED = "already-released"
+NOT_RELEASABLE = "not-releasable"
+
+RELEASED_CACHE_SIZE = 50000
+
+
+class ReleasedIds:
+    def __init__(self, max_size=RELEASED_CACHE_SIZE):
+        self.max_size = max_size
+        self.ids = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, payment_id):
+        with self.lock:
+            self.ids[str(payment_id)] = True
+            self.ids.move_to_end(str(payment_id))
+            while len(self.ids) > self.max_size:
+                self.ids.popitem(last=False)
+
+    def __contains__(self, payment_id):
+        with self.lock:
+            return str(payment_id) in self.ids
+
+
+released_ids = ReleasedIds()
+
+
+def release(supabase, payment_id, reason):
+    """
+    Release a held payment. Returns (outcome, row); row is only set for RELEASED.
+    """
+    if payment_id in released_ids:
+        return ALREADY_RELEASED, None
+
+    row = transition(supabase, {"id": payment_id, "status": PAID_HELD}, PAID_RELEASED, reason=reason)
+    if row is not None:
+        released_ids.add(payment_id)
+        return RELEASED, row
+
+    # Lost the conditional update: find out whether it was already released
+    response = supabase.table("payments").select("status").eq("id", payment_id).limit(1).execute()
+    if response.data and response.data[0].get("status") == PAID_RELEASED:
+        released_ids.add(payment_id)
+        return ALREADY_RELEASED, None
+    return NOT_RELEASABLE, None
@@ -0,0 +1,250 @@
+import os
+import time
+import threading
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from flask import current_app, request, jsonify, g, has_request_context
+
+# Keeps a slow or dead dependency from tying up every worker thread.
+#
+#   timeouts         - Supabase (SUPABASE_TIMEOUT, see supabase_client.py) and
+#                      SendGrid (EMAIL_TIMEOUT) calls give up instead of hanging
+#   circuit breakers - after BREAKER_FAILURES consecutive timeouts/connection
+#                      errors a dependency is skipped for BREAKER_RESET seconds,
+#                      then one probe call decides whether it is back
+#   route budgets    - each request gets a deadline (ROUTE_BUDGETS, by endpoint);
+#                      once it has passed, further dependency calls fail at once
+#
+# When a request fails because of any of these it is answered 503 with
+# Retry-After; the read endpoints in STALE_ENDPOINTS serve their last good
+# response instead, marked with X-Served-Stale.
+
+DEFAULT_ROUTE_BUDGET = float(os.environ.get("ROUTE_BUDGET", 10))
+EMAIL_TIMEOUT = float(os.environ.get("EMAIL_TIMEOUT", 10))
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", 5))
+BREAKER_RESET = float(os.environ.get("BREAKER_RESET", 30))
+
+ROUTE_BUDGETS = {
+    "login": 5,
+    "refresh": 2,
+    "check_payment": 8,
+    "check": 8,
+    "check_pay": 8,
+    "create_payment": 8,
+    "get_payment": 3,
+    "get_products": 5,
+    "get_products_page": 5,
+    "get_buyer_transactions": 5,
+    "get_buyer_transaction_changes": 5,
+    "create_payments": 30,
+    "add_products": 60,
+    "import_products": 60,
+    "stream_buyer_transactions": None,   # long-lived by design
+    "debug_profile": None,
+}
+
+STALE_ENDPOINTS = {"get_payment", "get_products", "get_products_page", "get_buyer_transactions"}
+STALE_CACHE_SIZE = 1000
+
+
+class DependencyUnavailable(Exception):
+    retry_after = 1
+
+
+class CircuitOpen(DependencyUnavailable):
+    def __init__(self, name, retry_after):
+        self.retry_after = max(1, int(retry_after))
+        super().__init__(f"{name} is unavailable, retry in {self.retry_after}s")
+
+
+class BudgetExceeded(DependencyUnavailable):
+    def __init__(self):
+        super().__init__("Request took too long")
+
+
+class CircuitBreaker:
+    def __init__(self, name, is_failure, failures=BREAKER_FAILURES, reset_after=BREAKER_RESET):
+        self.name = name
+        self.is_failure = is_failure
+        self.max_failures = failures
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if self.probing else "open"
+
+    def before(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            waited = time.monotonic() - self.opened_at
+            if waited < self.reset_after or self.probing:
+                raise CircuitOpen(self.name, self.reset_after - waited)
+            self.probing = True   # let one call through to test the dependency
+
+    def record(self, failed):
+        with self.lock:
+            if not failed:
+                if self.opened_at is not None:
+                    print(f"✅ {self.name} circuit closed")
+                self.failures = 0
+                self.opened_at = None
+                self.probing = False
+                return
+            self.failures += 1
+            if self.probing or self.failures >= self.max_failures:
+                if not self.probing:
+                    print(f"⚠️ {self.name} circuit opened after {self.failures} failures")
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+    def call(self, fn, *args, **kwargs):
+        self.before()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            # Errors the dependency answered with (bad query, 4xx) mean it is up
+            self.record(self.is_failure(e))
+            raise
+        self.record(False)
+        return result
+
+
+def is_email_failure(e):
+    return isinstance(e, OSError) or getattr(e, "status_code", 0) >= 500
+
+
+email_breaker = CircuitBreaker("sendgrid", is_email_failure)
+
+
+# --- Route budgets ---------------------------------------------------------------
+
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+def check_budget():
+    deadline = _deadline.get()
+    if deadline is not None and time.monotonic() > deadline:
+        raise BudgetExceeded()
+
+
+def current_deadline():
+    """
+    The running request's deadline (time.monotonic()), or None if it has none.
+    """
+    return _deadline.get()
+
+
+@contextmanager
+def deadline_at(deadline):
+    """
+    Run a block under `deadline`, e.g. work done on another thread for a request.
+    """
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def guarded(breaker, fn, *args, **kwargs):
+    """
+    Call a dependency through its breaker, within the current request's budget.
+    """
+    try:
+        check_budget()
+        return breaker.call(fn, *args, **kwargs)
+    except DependencyUnavailable as e:
+        if has_request_context():
+            g.unavailable = e
+        raise
+
+
+# --- Flask wiring ------------------------------------------------------------------
+
+_stale = OrderedDict()
+_stale_lock = threading.Lock()
+
+
+def stale_key(encoding):
+    return request.endpoint, request.full_path, str(g.get("user_id")), encoding
+
+
+def remember(response):
+    # Compressed copies are kept per encoding and only served to clients accepting it
+    key = stale_key(response.headers.get("Content-Encoding"))
+    copy = (response.get_data(), response.status_code, {
+        name: response.headers[name]
+        for name in ("Content-Type", "Content-Encoding", "ETag", "Vary")
+        if name in response.headers
+    })
+    with _stale_lock:
+        _stale[key] = copy
+        _stale.move_to_end(key)
+        while len(_stale) > STALE_CACHE_SIZE:
+            _stale.popitem(last=False)
+
+
+def stale_copy():
+    accepted = [encoding for encoding in ("br", "gzip") if request.accept_encodings[encoding]]
+    with _stale_lock:
+        for encoding in accepted + [None]:
+            cached = _stale.get(stale_key(encoding))
+            if cached is not None:
+                return cached
+    return None
+
+
+def unavailable_response(error):
+    if request.endpoint in STALE_ENDPOINTS:
+        cached = stale_copy()
+        if cached is not None:
+            body, status, headers = cached
+            response = current_app.response_class(body, status=status, headers=headers)
+            response.headers["X-Served-Stale"] = "1"
+            return response
+    response = jsonify({"error": str(error)})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response
+
+
+def init_resilience(app):
+    """
+    Per-route deadlines and 503 / stale answers for requests a dependency failed.
+    """
+    @app.before_request
+    def start_budget():
+        budget = ROUTE_BUDGETS.get(request.endpoint, DEFAULT_ROUTE_BUDGET)
+        g.budget_token = _deadline.set(time.monotonic() + budget if budget else None)
+
+    @app.after_request
+    def answer_unavailable(response):
+        error = g.pop("unavailable", None)
+        if error is not None and response.status_code >= 500:
+            return unavailable_response(error)
+        if (request.method == "GET" and request.endpoint in STALE_ENDPOINTS
+                and response.status_code == 200 and not response.direct_passthrough):
+            remember(response)
+        return response
+
+    @app.teardown_request
+    def end_budget(error=None):
+        token = g.pop("budget_token", None)
+        if token is not None:
+            try:
+                _deadline.reset(token)
+            except ValueError:
+                pass
+
+    @app.errorhandler(DependencyUnavailable)
+    def dependency_unavailable(error):
+        return unavailable_response(error)
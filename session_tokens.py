@@ -0,0 +1,148 @@
+import os
+import hmac
+import json
+import time
+import base64
+from hashlib import sha256
+from functools import wraps
+
+from flask import request, jsonify, g
+
+# Stateless seller sessions: HS256 JWTs signed with SESSION_SECRET.
+# /login hands out a short-lived access token and a longer-lived refresh
+# token; @seller_auth verifies the access token from the Authorization header
+# in constant time with no database hit and puts the seller id on g.user_id.
+#
+# While the frontend migrates, the routes it already calls still accept the
+# old user_id parameter when no token is sent; routes added since always need
+# the token. Set AUTH_REQUIRED=1 to turn the fallback off everywhere.
+#
+# Without SESSION_SECRET (or SECRET_KEY) no tokens are issued or accepted,
+# and AUTH_REQUIRED=1 refuses to start.
+
+SESSION_SECRET = os.environ.get("SESSION_SECRET") or os.environ.get("SECRET_KEY")
+ACCESS_TOKEN_TTL = int(os.environ.get("ACCESS_TOKEN_TTL", 15 * 60))
+REFRESH_TOKEN_TTL = int(os.environ.get("REFRESH_TOKEN_TTL", 30 * 24 * 3600))
+AUTH_REQUIRED = os.environ.get("AUTH_REQUIRED", "0") == "1"
+SESSIONS_ENABLED = bool(SESSION_SECRET)
+
+if AUTH_REQUIRED and not SESSIONS_ENABLED:
+    raise RuntimeError("AUTH_REQUIRED=1 needs SESSION_SECRET (or SECRET_KEY) to sign session tokens")
+
+HEADER = base64.urlsafe_b64encode(b'{"alg":"HS256","typ":"JWT"}').rstrip(b"=")
+
+# Keyed once at import; each signature copies the prepared HMAC state
+_signer = hmac.new(SESSION_SECRET.encode(), digestmod=sha256) if SESSIONS_ENABLED else None
+
+
+class InvalidToken(Exception):
+    pass
+
+
+class SessionsDisabled(InvalidToken):
+    def __init__(self):
+        super().__init__("Session tokens are not configured")
+
+
+def b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=")
+
+
+def b64decode(segment):
+    return base64.urlsafe_b64decode(segment + b"=" * (-len(segment) % 4))
+
+
+def sign(signing_input):
+    if _signer is None:
+        raise SessionsDisabled()
+    mac = _signer.copy()
+    mac.update(signing_input)
+    return b64encode(mac.digest())
+
+
+def issue_token(user_id, token_type, ttl):
+    now = int(time.time())
+    payload = json.dumps(
+        {"sub": str(user_id), "typ": token_type, "iat": now, "exp": now + ttl},
+        separators=(",", ":")
+    ).encode()
+    signing_input = HEADER + b"." + b64encode(payload)
+    return (signing_input + b"." + sign(signing_input)).decode()
+
+
+def issue_session(user_id):
+    return {
+        "access_token": issue_token(user_id, "access", ACCESS_TOKEN_TTL),
+        "refresh_token": issue_token(user_id, "refresh", REFRESH_TOKEN_TTL),
+        "token_type": "Bearer",
+        "expires_in": ACCESS_TOKEN_TTL
+    }
+
+
+def verify_token(token, token_type="access"):
+    """
+    Return the token's claims, or raise InvalidToken.
+    """
+    try:
+        signing_input, signature = token.encode().rsplit(b".", 1)
+        header, payload = signing_input.split(b".")
+    except (ValueError, AttributeError):
+        raise InvalidToken("Malformed token")
+
+    if header != HEADER or not hmac.compare_digest(sign(signing_input), signature):
+        raise InvalidToken("Invalid token signature")
+
+    try:
+        claims = json.loads(b64decode(payload))
+    except ValueError:
+        raise InvalidToken("Malformed token")
+
+    if claims.get("typ") != token_type:
+        raise InvalidToken("Wrong token type")
+    if claims.get("exp", 0) < time.time():
+        raise InvalidToken("Token expired")
+    return claims
+
+
+def bearer_token():
+    auth = request.headers.get("Authorization", "")
+    if auth.startswith("Bearer "):
+        return auth[7:].strip()
+    return None
+
+
+def requested_user_id():
+    data = request.get_json(silent=True) if request.is_json else None
+    return request.args.get("user_id") or (data or {}).get("user_id")
+
+
+def seller_auth(view=None, required=False):
+    """
+    Resolve the calling seller into g.user_id from the bearer token
+    (or, while AUTH_REQUIRED is off, from the legacy user_id parameter).
+    @seller_auth(required=True) always wants the token; it is for routes no
+    legacy frontend calls.
+    """
+    if view is None:
+        return lambda view: seller_auth(view, required)
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = bearer_token()
+        claimed = requested_user_id()
+
+        if token:
+            try:
+                claims = verify_token(token)
+            except InvalidToken as e:
+                return jsonify({"error": str(e)}), 401
+            if claimed and str(claimed) != claims["sub"]:
+                return jsonify({"error": "Token does not belong to this user"}), 403
+            g.user_id = claims["sub"]
+        elif AUTH_REQUIRED or required:
+            return jsonify({"error": "Missing access token"}), 401
+        else:
+            g.user_id = claimed
+
+        return view(*args, **kwargs)
+    return wrapper
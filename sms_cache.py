@@ -0,0 +1,81 @@
+import threading
+
+# In-process copy of the unused rows of sms_messages (id -> message).
+# Kept current by the realtime worker (realtime_sync.py). Only trusted while
+# `live` is set, i.e. after a warm load with the subscription healthy; the
+# check routes read sms_messages directly otherwise. A stale hit is harmless:
+# claim_sms() is a conditional update, so a row that was already used simply
+# fails the claim and is dropped from here.
+
+WARM_PAGE_SIZE = 1000
+
+
+class UnusedSmsCache:
+    def __init__(self):
+        self.rows = {}
+        self.lock = threading.Lock()
+        self.live = False
+        self.pending = None   # changes seen while a warm query is in flight
+
+    def apply(self, record):
+        if not record or record.get("id") is None:
+            return
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append(record)
+            self._apply(record)
+
+    def _apply(self, record):
+        if record.get("used"):
+            self.rows.pop(record["id"], None)
+        elif record.get("message") is not None:
+            self.rows[record["id"]] = record["message"]
+
+    def discard(self, sms_id):
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append({"id": sms_id, "used": True})
+            self.rows.pop(sms_id, None)
+
+    def latest_containing(self, fragment):
+        """
+        Newest unused SMS whose text contains `fragment` (same as the LIKE '%x%' query).
+        """
+        with self.lock:
+            matches = [sms_id for sms_id, message in self.rows.items() if fragment in message]
+            if not matches:
+                return None
+            sms_id = max(matches)
+            return {"id": sms_id, "message": self.rows[sms_id], "used": False}
+
+    def warm(self, supabase):
+        with self.lock:
+            self.pending = []
+        rows = {}
+        start = 0
+        while True:
+            response = (
+                supabase.table("sms_messages")
+                .select("id, message")
+                .eq("used", False)
+                .order("id")
+                .range(start, start + WARM_PAGE_SIZE - 1)
+                .execute()
+            )
+            page = response.data or []
+            for row in page:
+                rows[row["id"]] = row["message"] or ""
+            if len(page) < WARM_PAGE_SIZE:
+                break
+            start += WARM_PAGE_SIZE
+
+        with self.lock:
+            self.rows = rows
+            # Replay changes that raced with the warm query
+            for record in self.pending:
+                self._apply(record)
+            self.pending = None
+        print(f"📨 Unused SMS cache warmed: {len(rows)} messages")
+
+
+unused_sms = UnusedSmsCache()
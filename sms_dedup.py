@@ -0,0 +1,138 @@
+import os
+import re
+import math
+import threading
+from hashlib import blake2b
+from collections import OrderedDict
+
+# Replay protection for /sms. Every M-Pesa confirmation starts with a unique
+# transaction code ("QGH7ABC123 Confirmed. Ksh..."); it is stored in
+# sms_messages.transaction_code under a unique index
+# (migrations/007_sms_transaction_code.sql), so the database never holds the
+# same payment twice.
+#
+# In front of that sit two in-memory checks:
+#   recent_codes - exact set of the codes this process ingested most recently;
+#                  a forwarder resending a message is rejected with no query
+#   seen_codes   - Bloom filter over every stored code; "definitely new" (the
+#                  normal case) goes straight to the insert without a lookup
+# Anything the filter is unsure about is checked against the table.
+
+BLOOM_CAPACITY = int(os.environ.get("SMS_CODE_BLOOM_CAPACITY", 1000000))
+BLOOM_ERROR_RATE = float(os.environ.get("SMS_CODE_BLOOM_ERROR_RATE", 0.001))
+RECENT_CODES_SIZE = 10000
+WARM_PAGE_SIZE = 1000
+
+# Ten uppercase letters/digits with at least one of each, e.g. QGH7ABC123
+TRANSACTION_CODE_RE = re.compile(r"\b(?=[A-Z0-9]*\d)(?=[A-Z0-9]*[A-Z])[A-Z0-9]{10}\b")
+
+
+def extract_transaction_code(msg):
+    match = TRANSACTION_CODE_RE.search(msg or "")
+    return match.group(0) if match else None
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        digest = blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class SeenCodes:
+    def __init__(self, capacity=BLOOM_CAPACITY, error_rate=BLOOM_ERROR_RATE, recent_size=RECENT_CODES_SIZE):
+        self.bloom = BloomFilter(capacity, error_rate)
+        self.recent = OrderedDict()
+        self.recent_size = recent_size
+        self.lock = threading.Lock()
+        self.ready = False   # the filter only answers "new" once it holds every stored code
+
+    def add(self, code):
+        with self.lock:
+            self.bloom.add(code)
+            self.recent[code] = True
+            self.recent.move_to_end(code)
+            if len(self.recent) > self.recent_size:
+                self.recent.popitem(last=False)
+
+    def check(self, code):
+        """
+        True: certainly seen. False: certainly new. None: ask the database.
+        """
+        with self.lock:
+            if code in self.recent:
+                return True
+            if self.ready and code not in self.bloom:
+                return False
+        return None
+
+    def warm(self, supabase):
+        start = 0
+        count = 0
+        while True:
+            response = (
+                supabase.table("sms_messages")
+                .select("transaction_code")
+                .not_.is_("transaction_code", "null")
+                .order("id")
+                .range(start, start + WARM_PAGE_SIZE - 1)
+                .execute()
+            )
+            page = response.data or []
+            with self.lock:
+                for row in page:
+                    if row.get("transaction_code"):
+                        self.bloom.add(row["transaction_code"])
+            count += len(page)
+            if len(page) < WARM_PAGE_SIZE:
+                break
+            start += WARM_PAGE_SIZE
+
+        # Codes ingested while warming went into the same filter, nothing to replay
+        self.ready = True
+        print(f"🧾 Transaction code filter warmed: {count} codes")
+
+    def start_warm(self, supabase):
+        def run():
+            try:
+                self.warm(supabase)
+            except Exception as e:
+                print("⚠️ Error warming transaction code filter:", e)
+
+        thread = threading.Thread(target=run, name="sms_code_warm", daemon=True)
+        thread.start()
+        return thread
+
+
+seen_codes = SeenCodes()
+
+
+def is_duplicate_key_error(e):
+    return getattr(e, "code", None) == "23505" or "duplicate key" in str(e)
+
+
+def is_known_code(supabase, code):
+    """
+    Has this transaction code been stored already? Usually answered in memory.
+    """
+    known = seen_codes.check(code)
+    if known is not None:
+        return known
+    response = supabase.table("sms_messages").select("id").eq("transaction_code", code).limit(1).execute()
+    if response.data:
+        seen_codes.add(code)
+        return True
+    return False
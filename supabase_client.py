@@ -0,0 +1,69 @@
+import os
+import threading
+
+from resilience import CircuitBreaker, guarded
+
+# Lazily constructed Supabase client. Importing supabase-py (httpx, postgrest,
+# storage, auth, realtime) and building the client is most of a cold start,
+# so main.py only creates this proxy; the real client is built on first use,
+# i.e. by the first request or background worker that touches the database.
+#
+# Every query times out after SUPABASE_TIMEOUT seconds (supabase-py's default
+# is two minutes) and runs through supabase_breaker and the route budget
+# (resilience.py), so a struggling database fails requests fast.
+
+SUPABASE_TIMEOUT = float(os.environ.get("SUPABASE_TIMEOUT", 5))
+
+
+def is_supabase_failure(e):
+    import httpx
+    return isinstance(e, (httpx.TransportError, OSError))
+
+
+supabase_breaker = CircuitBreaker("supabase", is_supabase_failure)
+
+
+def guard_postgrest():
+    """
+    Route execute() of the postgrest request builders through supabase_breaker.
+    """
+    from postgrest._sync import request_builder
+
+    for name in ("SyncQueryRequestBuilder", "SyncSingleRequestBuilder",
+                 "SyncMaybeSingleRequestBuilder", "SyncExplainRequestBuilder"):
+        cls = getattr(request_builder, name, None)
+        if cls is None or getattr(cls.execute, "_guarded", False):
+            continue
+
+        def make_guarded(execute):
+            def guarded_execute(self):
+                return guarded(supabase_breaker, execute, self)
+            guarded_execute._guarded = True
+            return guarded_execute
+
+        cls.execute = make_guarded(cls.execute)
+
+
+class LazySupabase:
+    def __init__(self, url, key):
+        self._url = url
+        self._key = key
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from supabase import ClientOptions, create_client
+                    guard_postgrest()
+                    self._client = create_client(
+                        self._url, self._key,
+                        options=ClientOptions(postgrest_client_timeout=SUPABASE_TIMEOUT)
+                    )
+        return self._client
+
+    def __getattr__(self, name):
+        # Only reached for attributes the proxy itself doesn't have
+        return getattr(self.client, name)
@@ -0,0 +1,184 @@
+import os
+import time
+import threading
+from datetime import datetime, timedelta
+
+from reconcile import numbers_in_sms, find_open_payment, has_payment, credit_many
+from payment_state import InvalidTransition
+from amount_match import match_by_amount
+
+# Background sweeper: matches unused SMS to open payments for buyers who paid
+# but never polled /check-pay again. Progress is kept as a watermark on
+# sms_messages.id (table sweeper_state, see migrations/001_sweeper_state.sql)
+# so every run only scans rows it has not seen yet. SMS that name no number
+# (or only a masked one), or only numbers no payment was ever made out to,
+# fall back to the amount matcher (amount_match.py). An SMS from a known buyer
+# with nothing open is left alone rather than credited to a stranger.
+# Each batch is settled with credit_many(): one claim for all its SMS and one
+# write for all its payments, instead of two round trips per SMS.
+#
+# The watermark moves past SMS that matched nothing yet, or whose credit lost
+# a race and was handed back, so every SWEEP_RESCAN_EVERY runs the unused SMS
+# of the last SWEEP_RESCAN_AGE seconds below it are swept again.
+
+SWEEPER_NAME = "sms_sweeper"
+SWEEP_INTERVAL = int(os.environ.get("SMS_SWEEP_INTERVAL", 60))  # seconds, 0 disables
+SWEEP_BATCH_SIZE = int(os.environ.get("SMS_SWEEP_BATCH_SIZE", 100))
+SWEEP_RESCAN_EVERY = int(os.environ.get("SMS_SWEEP_RESCAN_EVERY", 10))         # runs, 0 disables
+SWEEP_RESCAN_AGE = int(os.environ.get("SMS_SWEEP_RESCAN_AGE", 3 * 24 * 3600))  # seconds
+
+
+def load_watermark(supabase):
+    response = (
+        supabase.table("sweeper_state")
+        .select("last_id")
+        .eq("name", SWEEPER_NAME)
+        .limit(1)
+        .execute()
+    )
+    return response.data[0]["last_id"] if response.data else 0
+
+
+def save_watermark(supabase, last_id):
+    supabase.table("sweeper_state").upsert({
+        "name": SWEEPER_NAME,
+        "last_id": last_id
+    }).execute()
+
+
+def match_sms(supabase, sms_row):
+    """
+    Find the open payment an SMS belongs to, using the same number rule as
+    /check-pay, then by amount and time if no number in it belongs to any payment.
+    """
+    numbers = numbers_in_sms(sms_row.get("message"))
+    for number in numbers:
+        payment = find_open_payment(supabase, number)
+        if payment:
+            return payment
+    if any(has_payment(supabase, number) for number in numbers):
+        return None
+    return match_by_amount(supabase, sms_row)
+
+
+def sweep_batch(supabase, rows, notify_buyer):
+    """
+    Match and credit one batch of unused SMS rows.
+    Returns (payments credited, id of the last row dealt with).
+    """
+    pairs = []
+    batch_payments = set()
+    last_id = None
+    for sms_row in rows:
+        payment = match_sms(supabase, sms_row)
+        if payment and str(payment["id"]) in batch_payments:
+            # A second SMS for the same payment waits for the next round,
+            # so it is credited against the row the first one produced
+            break
+        if payment:
+            pairs.append((payment, sms_row))
+            batch_payments.add(str(payment["id"]))
+        last_id = sms_row["id"]
+
+    credited = 0
+    for (payment, sms_row), result in zip(pairs, credit_many(supabase, pairs)):
+        if isinstance(result, InvalidTransition):
+            print(f"⚠️ Sweeper skipped SMS {sms_row['id']}:", result)
+            continue
+        if result is None:
+            continue  # /check-pay got there first
+
+        update_data, new_total_paid = result
+        if update_data:
+            credited += 1
+            print(f"🧹 Sweeper credited SMS {sms_row['id']} to payment {payment['id']}")
+            notify_buyer(payment, new_total_paid)
+    return credited, last_id
+
+
+def unused_sms_after(supabase, after_id, batch_size, until_id=None, since=None):
+    query = (
+        supabase.table("sms_messages")
+        .select("id, message, created_at")
+        .eq("used", False)
+        .gt("id", after_id)
+    )
+    if until_id is not None:
+        query = query.lte("id", until_id)
+    if since is not None:
+        query = query.gte("created_at", since)
+    return query.order("id").limit(batch_size).execute().data or []
+
+
+def sweep_once(supabase, notify_buyer, batch_size=SWEEP_BATCH_SIZE):
+    """
+    Process every unused SMS above the watermark, one batch at a time.
+    Returns the number of payments credited.
+    """
+    watermark = load_watermark(supabase)
+    credited = 0
+
+    while True:
+        rows = unused_sms_after(supabase, watermark, batch_size)
+        if not rows:
+            break
+
+        batch_credited, last_id = sweep_batch(supabase, rows, notify_buyer)
+        credited += batch_credited
+        watermark = last_id
+        save_watermark(supabase, watermark)
+
+        if len(rows) < batch_size and last_id == rows[-1]["id"]:
+            break
+
+    return credited
+
+
+def rescan_once(supabase, notify_buyer, batch_size=SWEEP_BATCH_SIZE, max_age=SWEEP_RESCAN_AGE):
+    """
+    Sweep the recent unused SMS below the watermark again (payment created
+    after the SMS, credit handed back after a lost race). Returns the number
+    of payments credited.
+    """
+    watermark = load_watermark(supabase)
+    since = (datetime.utcnow() - timedelta(seconds=max_age)).isoformat()
+    credited = 0
+    after_id = 0
+
+    while True:
+        rows = unused_sms_after(supabase, after_id, batch_size, until_id=watermark, since=since)
+        if not rows:
+            break
+
+        batch_credited, after_id = sweep_batch(supabase, rows, notify_buyer)
+        credited += batch_credited
+        if len(rows) < batch_size and after_id == rows[-1]["id"]:
+            break
+
+    return credited
+
+
+def run_sweeper(supabase, notify_buyer, interval=SWEEP_INTERVAL):
+    runs = 0
+    while True:
+        try:
+            sweep_once(supabase, notify_buyer)
+            runs += 1
+            if SWEEP_RESCAN_EVERY > 0 and runs % SWEEP_RESCAN_EVERY == 0:
+                rescan_once(supabase, notify_buyer)
+        except Exception as e:
+            print("⚠️ Error in SMS sweeper:", e)
+        time.sleep(interval)
+
+
+def start_sweeper(supabase, notify_buyer, interval=SWEEP_INTERVAL):
+    if interval <= 0:
+        return None
+    thread = threading.Thread(
+        target=run_sweeper,
+        args=(supabase, notify_buyer, interval),
+        name=SWEEPER_NAME,
+        daemon=True
+    )
+    thread.start()
+    return thread
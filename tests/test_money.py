@@ -0,0 +1,60 @@
+import pytest
+
+from money import MAX_CENTS, Money, ZERO, cents_array, to_cents, total
+from reconcile import extract_amount_simple
+
+
+@pytest.mark.parametrize("value, cents", [
+    (None, 0),
+    ("", 0),
+    (0, 0),
+    (150, 15000),
+    ("1,000.10", 100010),
+    (" 99.995 ", 10000),     # half up
+    (0.1, 10),
+    ("0.1", 10),
+    ("-5", -500),
+    (Money(123), 123),
+])
+def test_to_cents(value, cents):
+    assert to_cents(value) == cents
+
+
+@pytest.mark.parametrize("value", [
+    "abc", "1.2.3", "NaN", "Infinity", "-inf", True, [], "1e30", "1e999999999",
+    10 ** 13, str(MAX_CENTS),
+])
+def test_to_cents_rejects_with_value_error(value):
+    with pytest.raises(ValueError):
+        to_cents(value)
+
+
+def test_largest_amount_is_accepted():
+    assert to_cents(MAX_CENTS // 100) == MAX_CENTS
+
+
+def test_arithmetic_and_comparisons_are_exact():
+    assert Money.parse("0.1") + Money.parse("0.2") == Money.parse("0.3")
+    assert Money.parse(100) - Money.parse("40.5") == Money(5950)
+    assert -Money(5) == Money(-5)
+    assert Money(1) > ZERO
+    assert not ZERO
+    assert len({Money(1), Money.parse("0.01")}) == 1
+
+
+def test_amount_and_str():
+    assert Money.parse(100).amount == 100
+    assert Money.parse("99.5").amount == 99.5
+    assert str(Money.parse("1234567.8")) == "1,234,567.80"
+    assert str(Money(-5)) == "-0.05"
+
+
+def test_bulk_helpers():
+    assert list(cents_array(["1", 2, "3.50"])) == [100, 200, 350]
+    assert total(["1,000", "0.5"]) == Money(100050)
+
+
+def test_sms_amounts_that_cannot_be_money_are_ignored():
+    assert extract_amount_simple("Confirmed. Ksh1,500.00 sent to TRUSTPAY") == Money(150000)
+    assert extract_amount_simple("Confirmed. Ksh1e30 sent") is None
+    assert extract_amount_simple("no amount here") is None
@@ -0,0 +1,249 @@
+import threading
+import time
+
+import pytest
+from flask import Flask, g
+
+import payment_state
+import reconcile
+import resilience
+from write_batcher import WriteBatcher
+
+
+class Response:
+    def __init__(self, data):
+        self.data = data
+
+
+class Query:
+    """
+    Just enough of a PostgREST builder for conditional updates: update() with
+    eq()/in_() filters.
+    """
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+        self.changes = None
+        self.filters = []
+
+    def update(self, changes):
+        self.changes = changes
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def in_(self, column, values):
+        self.filters.append(lambda row: row.get(column) in values)
+        return self
+
+    def execute(self):
+        self.db.calls.append((self.table, "update"))
+        updated = []
+        for row in self.db.tables[self.table]:
+            if all(match(row) for match in self.filters):
+                row.update(self.changes)
+                updated.append(dict(row))
+        return Response(updated)
+
+
+class Rpc:
+    def __init__(self, db, params):
+        self.db = db
+        self.params = params
+
+    def execute(self):
+        # Same rules as apply_payment_transitions (migrations/009), in array order
+        self.db.calls.append(("rpc", "apply_payment_transitions"))
+        won = []
+        for index, change in enumerate(self.params["changes"]):
+            for row in self.db.tables["payments"]:
+                if (row["id"] == change["id"] and row["status"] == change["from_status"]
+                        and change["expected_amount_paid"] in (None, row["amount_paid"])):
+                    row.update(change["set"])
+                    won.append({"idx": index, "payment": dict(row)})
+        return Response(won)
+
+
+class Insert:
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+
+    def insert(self, rows):
+        self.db.tables.setdefault(self.table, []).extend(rows if isinstance(rows, list) else [rows])
+        return self
+
+    def execute(self):
+        self.db.calls.append((self.table, "insert"))
+        return Response([])
+
+
+class FakeSupabase:
+    def __init__(self, **tables):
+        self.tables = tables
+        self.calls = []
+
+    def table(self, name):
+        if name in ("payment_events", "webhook_outbox"):
+            return Insert(self, name)
+        return Query(self, name)
+
+    def rpc(self, name, params):
+        assert name == "apply_payment_transitions"
+        return Rpc(self, params)
+
+
+def test_concurrent_items_share_one_flush():
+    flushed = []
+
+    def flush(key, items):
+        flushed.append(list(items))
+        return [item * 2 for item in items]
+
+    batcher = WriteBatcher("test_share", flush, window=0.05, max_batch=100)
+    results = {}
+    threads = [
+        threading.Thread(target=lambda n=n: results.__setitem__(n, batcher.write("db", n)))
+        for n in range(10)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == {n: n * 2 for n in range(10)}
+    assert len(flushed) == 1
+
+
+def test_item_errors_fail_only_their_future():
+    batcher = WriteBatcher("test_errors", lambda key, items: [
+        ValueError("bad") if item == "bad" else item for item in items
+    ], window=0.01)
+    good = batcher.submit("db", "good")
+    bad = batcher.submit("db", "bad")
+
+    assert good.result(5) == "good"
+    with pytest.raises(ValueError):
+        bad.result(5)
+
+
+def test_timed_out_item_is_never_written():
+    release = threading.Event()
+    written = []
+
+    def flush(key, items):
+        release.wait(5)
+        written.extend(items)
+        return items
+
+    batcher = WriteBatcher("test_timeout", flush, window=0.01, max_batch=1)
+    first = batcher.submit("db", "first")     # holds the flusher
+    time.sleep(0.05)
+
+    with pytest.raises(TimeoutError):
+        batcher.write("db", "late", timeout=0.05)
+
+    release.set()
+    assert first.result(5) == "first"
+    time.sleep(0.05)
+    assert written == ["first"]
+
+
+def test_zero_window_writes_on_the_callers_thread():
+    threads = []
+    batcher = WriteBatcher("test_inline", lambda key, items: threads.append(threading.get_ident()) or items, window=0)
+
+    assert batcher.write("db", 1) == 1
+    assert threads == [threading.get_ident()]
+
+
+def test_flush_runs_under_the_earliest_callers_deadline():
+    seen = []
+    batcher = WriteBatcher("test_deadline", lambda key, items: seen.append(resilience.current_deadline()) or items, window=0.01)
+    deadline = time.monotonic() + 5
+
+    with resilience.deadline_at(deadline):
+        assert batcher.write("db", 1) == 1
+    assert seen == [deadline]
+
+
+def test_item_past_its_deadline_is_not_written_and_flags_the_request():
+    written = []
+    batcher = WriteBatcher("test_expired", lambda key, items: written.extend(items) or items, window=0.01)
+
+    with Flask(__name__).test_request_context():
+        with resilience.deadline_at(time.monotonic() - 1):
+            with pytest.raises(resilience.BudgetExceeded):
+                batcher.write("db", "late")
+        assert isinstance(g.unavailable, resilience.BudgetExceeded)
+    assert written == []
+
+
+def test_failed_payment_write_hands_the_sms_back(monkeypatch):
+    db = FakeSupabase(sms_messages=[{"id": 1, "used": False}])
+    payment = {"id": 7, "user_id": None, "status": "Not paid", "amount": 100, "amount_paid": 0}
+
+    def fail(supabase, moves):
+        raise resilience.DependencyUnavailable("payments down")
+
+    monkeypatch.setattr(reconcile, "sms_claims", WriteBatcher("test_claims_fail", reconcile.claim_many, window=0))
+    monkeypatch.setattr(reconcile, "payment_writes", WriteBatcher("test_writes_fail", fail, window=0))
+
+    with pytest.raises(resilience.DependencyUnavailable):
+        reconcile.settle_sms(db, payment, 1, payment_state.PAID_HELD, reconcile.Money.parse(100))
+    assert db.tables["sms_messages"] == [{"id": 1, "used": False}]
+
+
+def test_claim_many_claims_each_sms_once():
+    db = FakeSupabase(sms_messages=[{"id": 1, "used": False}, {"id": 2, "used": True}, {"id": 3, "used": False}])
+
+    assert reconcile.claim_many(db, [1, 2, 3, 1]) == [True, False, True, False]
+    assert db.calls == [("sms_messages", "update")]
+
+
+def test_transition_many_applies_moves_in_order():
+    payment = {"id": 7, "user_id": None, "status": "Not paid", "amount_paid": 0}
+    db = FakeSupabase(payments=[dict(payment)])
+
+    results = payment_state.transition_many(db, [
+        (payment, payment_state.PARTIALLY_PAID, {"amount_paid": 40}, "sms:1"),
+        (payment, payment_state.PARTIALLY_PAID, {"amount_paid": 60}, "sms:2"),
+        (payment, payment_state.PAID_RELEASED, None, "release"),
+    ])
+
+    assert results[0]["amount_paid"] == 40
+    assert results[1] is None                  # lost its compare-and-set to the first
+    assert isinstance(results[2], payment_state.InvalidTransition)
+    assert db.calls.count(("rpc", "apply_payment_transitions")) == 1
+
+
+def test_settling_concurrently_costs_one_claim_and_one_payment_write():
+    db = FakeSupabase(
+        sms_messages=[{"id": 100 + n, "used": False} for n in range(20)],
+        payments=[{"id": n, "user_id": None, "status": "Not paid", "amount": 100, "amount_paid": 0} for n in range(20)],
+    )
+    rows = [dict(row) for row in db.tables["payments"]]
+    results = [None] * 20
+
+    def settle(n):
+        results[n] = reconcile.settle_sms(db, rows[n], 100 + n, payment_state.PAID_HELD, reconcile.Money.parse(100))
+
+    # Fresh batchers with a window long enough for every thread to join in
+    claims = WriteBatcher("test_claims", reconcile.claim_many, window=0.05)
+    writes = WriteBatcher("test_writes", payment_state.transition_many, window=0.05)
+    original = reconcile.sms_claims, reconcile.payment_writes
+    reconcile.sms_claims, reconcile.payment_writes = claims, writes
+    try:
+        threads = [threading.Thread(target=settle, args=(n,)) for n in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        reconcile.sms_claims, reconcile.payment_writes = original
+
+    assert all(row is not None and row["status"] == payment_state.PAID_HELD for row in results)
+    assert db.calls.count(("sms_messages", "update")) == 1
+    assert db.calls.count(("rpc", "apply_payment_transitions")) == 1
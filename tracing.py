@@ -0,0 +1,245 @@
+import os
+import time
+import secrets
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+from flask import request, g
+
+# Request tracing: one span per request, child spans around every Supabase
+# query, SendGrid send and bcrypt call, so a slow /check-pay shows which step
+# took the time.
+#
+# TRACING selects where spans go:
+#   off     - nothing is recorded (default); span() is a no-op
+#   console - each finished request prints a waterfall of its spans
+#   memory  - finished traces are kept in `exporter.traces` (last TRACE_BUFFER)
+#   otel    - spans go to the OpenTelemetry SDK configured by the environment
+#             (needs the opentelemetry packages; falls back to off without them)
+#
+# The built-in spans use OpenTelemetry ids and field names, and an incoming
+# W3C traceparent header continues the caller's trace.
+
+TRACING = os.environ.get("TRACING", "off")   # off | console | memory | otel
+TRACE_BUFFER = int(os.environ.get("TRACE_BUFFER", 100))
+
+otel_trace = None
+if TRACING == "otel":
+    try:
+        from opentelemetry import trace as otel_trace, context as otel_context
+        from opentelemetry.propagate import extract as otel_extract
+    except ImportError:  # opentelemetry is optional, the built-in tracer is always there
+        otel_trace = None
+
+_current = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start_ns", "end_ns", "attributes", "status", "trace")
+
+    def __init__(self, name, parent=None, trace_id=None, parent_id=None, attributes=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else (trace_id or secrets.token_hex(16))
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent else parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes or {})
+        self.status = "UNSET"
+        # Spans of the same local trace share one list; the root exports it
+        self.trace = parent.trace if parent else []
+        self.trace.append(self)
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def record_error(self, error):
+        self.status = "ERROR"
+        self.attributes["exception.type"] = type(error).__name__
+        self.attributes["exception.message"] = str(error)
+
+    @property
+    def duration_ms(self):
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_id,
+            "start_time_unix_nano": self.start_ns,
+            "end_time_unix_nano": self.end_ns,
+            "attributes": self.attributes,
+            "status": self.status
+        }
+
+
+class ConsoleExporter:
+    def export(self, spans):
+        root = spans[0]
+        print(f"🔭 trace {root.trace_id} {root.name} {root.duration_ms:.1f} ms")
+        depth = {root.span_id: 0}
+        for span in spans[1:]:
+            depth[span.span_id] = depth.get(span.parent_id, 0) + 1
+            offset = (span.start_ns - root.start_ns) / 1e6
+            flag = " ❌" if span.status == "ERROR" else ""
+            print(f"   {'  ' * depth[span.span_id]}+{offset:7.1f} ms {span.duration_ms:7.1f} ms  {span.name}{flag}")
+
+
+class InMemoryExporter:
+    def __init__(self, max_traces=TRACE_BUFFER):
+        self.traces = deque(maxlen=max_traces)
+        self.lock = threading.Lock()
+
+    def export(self, spans):
+        with self.lock:
+            self.traces.append([span.to_dict() for span in spans])
+
+    def clear(self):
+        with self.lock:
+            self.traces.clear()
+
+
+def make_exporter(mode=TRACING):
+    if mode == "console":
+        return ConsoleExporter()
+    if mode == "memory":
+        return InMemoryExporter()
+    return None
+
+
+exporter = make_exporter()
+otel_tracer = otel_trace.get_tracer("trustpay") if TRACING == "otel" and otel_trace else None
+enabled = exporter is not None or otel_tracer is not None
+
+
+def parse_traceparent(header):
+    """
+    (trace_id, parent span id) from a W3C traceparent header, or (None, None).
+    """
+    parts = (header or "").split("-")
+    if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16:
+        return parts[1], parts[2]
+    return None, None
+
+
+def start_span(name, attributes=None, traceparent=None):
+    """
+    Open a span as the current one. Returns a handle for end_span().
+    """
+    if otel_tracer is not None:
+        parent_context = otel_extract({"traceparent": traceparent}) if traceparent else None
+        span = otel_tracer.start_span(name, context=parent_context, attributes=attributes)
+        return span, otel_context.attach(otel_trace.set_span_in_context(span))
+
+    parent = _current.get()
+    trace_id, parent_id = (None, None) if parent else parse_traceparent(traceparent)
+    span = Span(name, parent, trace_id, parent_id, attributes)
+    return span, _current.set(span)
+
+
+def end_span(handle, error=None):
+    span, token = handle
+    if otel_tracer is not None:
+        if error is not None:
+            span.record_exception(error)
+            span.set_status(otel_trace.Status(otel_trace.StatusCode.ERROR))
+        span.end()
+        otel_context.detach(token)
+        return
+
+    if error is not None:
+        span.record_error(error)
+    span.end_ns = time.time_ns()
+    try:
+        _current.reset(token)
+    except ValueError:
+        # Streamed responses finish in another context; nothing to restore there
+        pass
+    if span.trace[0] is span:
+        exporter.export(span.trace)
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    with span("bcrypt.checkpw"): ...  -- a child of whatever span is current.
+    """
+    if not enabled:
+        yield None
+        return
+    handle = start_span(name, attributes)
+    try:
+        yield handle[0]
+    except BaseException as e:
+        end_span(handle, e)
+        raise
+    end_span(handle)
+
+
+def instrument_postgrest():
+    """
+    Wrap execute() of the postgrest request builders supabase-py uses, so every
+    supabase.table(...)...execute() gets its own span.
+    """
+    from postgrest._sync import request_builder
+
+    operations = {"GET": "select", "HEAD": "select", "POST": "insert", "PATCH": "update", "DELETE": "delete"}
+
+    for name in ("SyncQueryRequestBuilder", "SyncSingleRequestBuilder",
+                 "SyncMaybeSingleRequestBuilder", "SyncExplainRequestBuilder"):
+        cls = getattr(request_builder, name, None)
+        if cls is None or getattr(cls.execute, "_traced", False):
+            continue
+
+        def make_traced(execute):
+            def traced_execute(self):
+                config = getattr(self, "request", None)
+                method = str(getattr(getattr(config, "http_method", None), "value", "")) or "GET"
+                table = str(getattr(config, "path", "")).rstrip("/").rsplit("/", 1)[-1]
+                with span(f"supabase {operations.get(method, method)} {table}", **{
+                    "db.system": "postgresql",
+                    "db.operation": operations.get(method, method),
+                    "db.sql.table": table,
+                    # Filter names only; values can be emails or phone numbers
+                    "db.postgrest.params": ",".join(sorted(set(getattr(config, "params", {}).keys())))
+                }):
+                    return execute(self)
+            traced_execute._traced = True
+            return traced_execute
+
+        cls.execute = make_traced(cls.execute)
+
+
+def init_tracing(app):
+    """
+    Give every request a root span and instrument Supabase calls.
+    """
+    if not enabled:
+        return
+
+    instrument_postgrest()
+
+    @app.before_request
+    def start_request_span():
+        route = request.url_rule.rule if request.url_rule else request.path
+        g.trace_span = start_span(f"{request.method} {route}", {
+            "http.request.method": request.method,
+            "http.route": route
+        }, request.headers.get("traceparent"))
+
+    @app.after_request
+    def tag_response(response):
+        handle = g.get("trace_span")
+        if handle is not None:
+            handle[0].set_attribute("http.response.status_code", response.status_code)
+        return response
+
+    @app.teardown_request
+    def end_request_span(error=None):
+        handle = g.pop("trace_span", None)
+        if handle is not None:
+            end_span(handle, error)
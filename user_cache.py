@@ -0,0 +1,101 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+# Login lookups without a Supabase round trip per attempt.
+#   known_users   - email -> {id, full_name, password hash}, short TTL
+#   unknown_users - emails with no account, shorter TTL, so enumeration and
+#                   credential-stuffing floods against made-up addresses stop
+#                   at a dict lookup (no query, no bcrypt)
+# Emails are keyed trimmed and lowercased, and looked up case-insensitively,
+# so "Foo@x.com " and "foo@x.com" share one entry and one forget().
+# Call forget(email) whenever a user's row or password changes.
+
+KNOWN_USER_TTL = int(os.environ.get("KNOWN_USER_TTL", 300))
+UNKNOWN_USER_TTL = int(os.environ.get("UNKNOWN_USER_TTL", 60))
+LOGIN_COLUMNS = "id, full_name, password"
+
+
+class TTLCache:
+    """
+    Thread-safe TTL map. At max_size the least recently used entry is dropped.
+    """
+    def __init__(self, ttl, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return default
+            value, expires = item
+            if expires < time.monotonic():
+                del self.items[key]
+                return default
+            self.items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = (value, time.monotonic() + self.ttl)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+
+known_users = TTLCache(KNOWN_USER_TTL)
+unknown_users = TTLCache(UNKNOWN_USER_TTL)
+
+
+def email_key(email):
+    return email.strip().lower()
+
+
+def email_pattern(key):
+    """
+    An ilike pattern matching exactly `key`, ignoring case.
+    """
+    return key.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def find_login_user(supabase, email):
+    """
+    The id/full_name/password hash for an email, or None if there is no such user.
+    """
+    key = email_key(email)
+    user = known_users.get(key)
+    if user is not None:
+        return user
+    if unknown_users.get(key):
+        return None
+
+    query = supabase.table('users').select(LOGIN_COLUMNS)
+    if "*" in key:
+        # PostgREST reads * in a like pattern as a wildcard and can't escape it
+        query = query.eq('email', email.strip())
+    else:
+        query = query.ilike('email', email_pattern(key))
+    response = query.limit(1).execute()
+    if not response.data:
+        unknown_users.set(key, True)
+        return None
+
+    user = response.data[0]
+    known_users.set(key, user)
+    return user
+
+
+def forget(email):
+    if not email:
+        return
+    key = email_key(email)
+    known_users.delete(key)
+    unknown_users.delete(key)
@@ -0,0 +1,406 @@
+import os
+import json
+import hmac
+import time
+import random
+import socket
+import secrets
+import ipaddress
+import threading
+from hashlib import sha256
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+
+from user_cache import TTLCache
+
+# Outbound webhooks so sellers hear about payments instead of polling
+# /buyer-transactions.
+#
+# Every payment state change in WEBHOOK_EVENTS writes one webhook_outbox row per
+# active endpoint of the seller (migrations/008_webhooks.sql). The dispatcher
+# thread claims due rows in batches and delivers them concurrently on an
+# asyncio loop with one pooled HTTP client per seller host, at most
+# WEBHOOK_SELLER_CONCURRENCY requests in flight per seller. Failures are
+# retried with exponential backoff and jitter until WEBHOOK_MAX_ATTEMPTS,
+# then the row is marked dead.
+#
+# Each request is signed: X-TrustPay-Signature: t=<unix time>,v1=<hex HMAC-SHA256
+# of "<t>.<body>" under the endpoint secret>. Receivers should recompute it and
+# reject old timestamps.
+#
+# URLs must resolve to public addresses only, checked at registration and
+# again before every send, so a seller can't point us at loopback, link-local
+# (cloud metadata) or private-range services. Each send connects to the
+# address it checked (pin_url), not to whatever the name resolves to next.
+
+WEBHOOK_EVENTS = ("partially-paid", "paid-held", "paid-released")
+WEBHOOK_POLL_INTERVAL = float(os.environ.get("WEBHOOK_POLL_INTERVAL", 2))   # seconds, 0 disables
+WEBHOOK_BATCH_SIZE = int(os.environ.get("WEBHOOK_BATCH_SIZE", 100))
+WEBHOOK_CONCURRENCY = int(os.environ.get("WEBHOOK_CONCURRENCY", 20))
+WEBHOOK_SELLER_CONCURRENCY = int(os.environ.get("WEBHOOK_SELLER_CONCURRENCY", 2))
+WEBHOOK_TIMEOUT = float(os.environ.get("WEBHOOK_TIMEOUT", 10))
+WEBHOOK_MAX_ATTEMPTS = int(os.environ.get("WEBHOOK_MAX_ATTEMPTS", 10))
+WEBHOOK_BASE_BACKOFF = 10        # seconds before the first retry
+WEBHOOK_MAX_BACKOFF = 6 * 3600
+WEBHOOK_CLAIM_TIMEOUT = 300      # a row stuck in "sending" this long is retried
+WEBHOOK_ALLOW_HTTP = os.environ.get("WEBHOOK_ALLOW_HTTP", "0") == "1"
+WEBHOOK_ALLOW_PRIVATE = os.environ.get("WEBHOOK_ALLOW_PRIVATE", "0") == "1"   # local testing only
+
+PAYLOAD_FIELDS = ("id", "status", "amount", "amount_paid", "product_name", "buyer_name", "updated_at")
+
+endpoint_cache = TTLCache(60)
+
+
+class InvalidWebhookUrl(ValueError):
+    pass
+
+
+def is_public_address(address):
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if getattr(ip, "ipv4_mapped", None):
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def check_host(host, port):
+    """
+    Raise InvalidWebhookUrl unless every address `host` resolves to is public.
+    Returns the first of them (None with WEBHOOK_ALLOW_PRIVATE).
+    """
+    if WEBHOOK_ALLOW_PRIVATE:
+        return None
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except (socket.gaierror, UnicodeError):
+        raise InvalidWebhookUrl(f"Webhook host {host} does not resolve")
+    for info in infos:
+        if not is_public_address(info[4][0]):
+            raise InvalidWebhookUrl("Webhook URL must point to a public address")
+    return infos[0][4][0]
+
+
+def url_port(parts):
+    allowed = ("https", "http") if WEBHOOK_ALLOW_HTTP else ("https",)
+    if parts.scheme not in allowed or not parts.hostname:
+        raise InvalidWebhookUrl(f"Webhook URL must be an absolute {' or '.join(allowed)} URL")
+    try:
+        return parts.port or (443 if parts.scheme == "https" else 80)
+    except ValueError:
+        raise InvalidWebhookUrl("Webhook URL has an invalid port")
+
+
+def check_url(url):
+    parts = urlsplit(url or "")
+    check_host(parts.hostname, url_port(parts))
+    return url
+
+
+def pin_url(url):
+    """
+    Check `url` and resolve it once: (url to connect to, extra headers, request
+    extensions). The request goes to the very address that was checked, with
+    the original name in the Host header and as the TLS server name, so a DNS
+    answer that changes between the check and the connect can't redirect it.
+    """
+    parts = urlsplit(url or "")
+    address = check_host(parts.hostname, url_port(parts))
+    if address is None:
+        return url, {}, {}
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    netloc = f"[{ip}]" if ip.version == 6 else str(ip)
+    if parts.port:
+        netloc += f":{parts.port}"
+    host = parts.netloc.rpartition("@")[2]
+    return parts._replace(netloc=netloc).geturl(), {"Host": host}, {"sni_hostname": parts.hostname}
+
+
+def sign(secret, timestamp, body):
+    return hmac.new(secret.encode(), f"{timestamp}.".encode() + body, sha256).hexdigest()
+
+
+def signature_header(secret, body, timestamp=None):
+    timestamp = int(timestamp or time.time())
+    return f"t={timestamp},v1={sign(secret, timestamp, body)}"
+
+
+def backoff(attempts):
+    delay = min(WEBHOOK_MAX_BACKOFF, WEBHOOK_BASE_BACKOFF * 2 ** (attempts - 1))
+    return delay * random.uniform(0.8, 1.2)
+
+
+# --- Endpoints -----------------------------------------------------------------
+
+def active_endpoints(supabase, user_ids):
+    """
+    {user_id: [endpoint ids]} for the given sellers, one query for the ones not cached.
+    """
+    found, missing = {}, []
+    for user_id in dict.fromkeys(str(user_id) for user_id in user_ids):
+        endpoints = endpoint_cache.get(user_id)
+        if endpoints is None:
+            missing.append(user_id)
+        else:
+            found[user_id] = endpoints
+    if missing:
+        response = (
+            supabase.table("webhook_endpoints")
+            .select("id, user_id")
+            .in_("user_id", missing)
+            .eq("active", True)
+            .execute()
+        )
+        for user_id in missing:
+            found[user_id] = []
+        for row in response.data or []:
+            found[str(row["user_id"])].append(row["id"])
+        for user_id in missing:
+            endpoint_cache.set(user_id, found[user_id])
+    return found
+
+
+def create_endpoint(supabase, user_id, url):
+    """
+    Register a webhook URL; the returned row includes the signing secret.
+    """
+    response = supabase.table("webhook_endpoints").insert({
+        "user_id": user_id,
+        "url": check_url(url),
+        "secret": "whsec_" + secrets.token_hex(24),
+        "active": True,
+        "created_at": datetime.utcnow().isoformat()
+    }).execute()
+    endpoint_cache.delete(str(user_id))
+    return response.data[0]
+
+
+def list_endpoints(supabase, user_id):
+    response = (
+        supabase.table("webhook_endpoints")
+        .select("id, url, active, created_at")
+        .eq("user_id", user_id)
+        .order("id")
+        .execute()
+    )
+    return response.data or []
+
+
+def delete_endpoint(supabase, user_id, endpoint_id):
+    response = (
+        supabase.table("webhook_endpoints")
+        .update({"active": False})
+        .eq("id", endpoint_id)
+        .eq("user_id", user_id)
+        .execute()
+    )
+    endpoint_cache.delete(str(user_id))
+    return bool(response.data)
+
+
+# --- Outbox --------------------------------------------------------------------
+
+def enqueue(supabase, changes):
+    """
+    Queue webhooks for (row, from_status) payments that just moved to
+    row["status"], with one outbox insert for the lot.
+    """
+    changes = [(row, from_status) for row, from_status in changes
+               if row.get("status") in WEBHOOK_EVENTS and row.get("user_id")]
+    if not changes:
+        return
+    try:
+        endpoints = active_endpoints(supabase, [row["user_id"] for row, _ in changes])
+        now = datetime.utcnow().isoformat()
+        outbox = []
+        for row, from_status in changes:
+            payload = {
+                "type": f"payment.{row['status']}",
+                "created_at": now,
+                "data": {"previous_status": from_status, **{field: row.get(field) for field in PAYLOAD_FIELDS}}
+            }
+            outbox += [{
+                "endpoint_id": endpoint_id,
+                "user_id": row["user_id"],
+                "event_type": payload["type"],
+                "payload": payload,
+                "status": "pending",
+                "attempts": 0,
+                "next_attempt_at": now,
+                "created_at": now
+            } for endpoint_id in endpoints.get(str(row["user_id"]), [])]
+        if not outbox:
+            return
+        supabase.table("webhook_outbox").insert(outbox).execute()
+        dispatcher.wake()
+    except Exception as e:
+        # The payment change stands; a lost webhook is what polling is still there for
+        print("⚠️ Could not queue webhooks:", e)
+
+
+class Dispatcher:
+    def __init__(self, transport=None):
+        self.transport = transport     # httpx transport override (tests)
+        self.clients = {}              # (scheme, host, port) -> httpx.AsyncClient
+        self.loop = None
+        self.wakeup = threading.Event()
+
+    def wake(self):
+        self.wakeup.set()
+
+    def client_for(self, url):
+        import httpx
+
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        client = self.clients.get(key)
+        if client is None:
+            client = httpx.AsyncClient(
+                timeout=WEBHOOK_TIMEOUT,
+                limits=httpx.Limits(max_connections=WEBHOOK_SELLER_CONCURRENCY, max_keepalive_connections=WEBHOOK_SELLER_CONCURRENCY),
+                transport=self.transport,
+                follow_redirects=False
+            )
+            self.clients[key] = client
+        return client
+
+    def claim(self, supabase, batch_size=WEBHOOK_BATCH_SIZE):
+        now = datetime.utcnow()
+        stale = (now - timedelta(seconds=WEBHOOK_CLAIM_TIMEOUT)).isoformat()
+        response = (
+            supabase.table("webhook_outbox")
+            .select("id")
+            .or_(f"and(status.eq.pending,next_attempt_at.lte.{now.isoformat()}),and(status.eq.sending,claimed_at.lt.{stale})")
+            .order("id")
+            .limit(batch_size)
+            .execute()
+        )
+        ids = [row["id"] for row in response.data or []]
+        if not ids:
+            return []
+        # Conditional claim, so two instances never send the same row
+        claimed = (
+            supabase.table("webhook_outbox")
+            .update({"status": "sending", "claimed_at": now.isoformat()})
+            .in_("id", ids)
+            .or_(f"status.eq.pending,and(status.eq.sending,claimed_at.lt.{stale})")
+            .execute()
+        )
+        return claimed.data or []
+
+    async def send(self, delivery, endpoint, semaphores):
+        import asyncio
+
+        body = json.dumps({"id": delivery["id"], **delivery["payload"]}, separators=(",", ":"), default=str).encode()
+        headers = {
+            "Content-Type": "application/json",
+            "User-Agent": "TrustPay-Webhooks/1",
+            "X-TrustPay-Event": delivery["event_type"],
+            "X-TrustPay-Delivery": str(delivery["id"]),
+            "X-TrustPay-Signature": signature_header(endpoint["secret"], body)
+        }
+        seller = semaphores.setdefault(delivery["user_id"], asyncio.Semaphore(WEBHOOK_SELLER_CONCURRENCY))
+        async with semaphores["*"], seller:
+            try:
+                # The name may resolve somewhere else than when it was registered
+                url, pinned_headers, extensions = await asyncio.to_thread(pin_url, endpoint["url"])
+                response = await self.client_for(endpoint["url"]).post(
+                    url, content=body, headers={**headers, **pinned_headers}, extensions=extensions
+                )
+            except Exception as e:
+                return delivery, f"{type(e).__name__}: {e}"
+        if 200 <= response.status_code < 300:
+            return delivery, None
+        return delivery, f"HTTP {response.status_code}"
+
+    async def send_all(self, deliveries, endpoints):
+        import asyncio
+
+        semaphores = {"*": asyncio.Semaphore(WEBHOOK_CONCURRENCY)}
+        jobs = []
+        results = []
+        for delivery in deliveries:
+            endpoint = endpoints.get(delivery["endpoint_id"])
+            if endpoint is None:
+                results.append((delivery, "Endpoint deleted"))
+            else:
+                jobs.append(self.send(delivery, endpoint, semaphores))
+        return results + list(await asyncio.gather(*jobs))
+
+    def record(self, supabase, results):
+        now = datetime.utcnow()
+        delivered = [delivery["id"] for delivery, error in results if error is None]
+        if delivered:
+            (
+                supabase.table("webhook_outbox")
+                .update({"status": "delivered", "delivered_at": now.isoformat(), "last_error": None})
+                .in_("id", delivered)
+                .execute()
+            )
+        for delivery, error in results:
+            if error is None:
+                continue
+            attempts = (delivery.get("attempts") or 0) + 1
+            dead = attempts >= WEBHOOK_MAX_ATTEMPTS or error == "Endpoint deleted"
+            supabase.table("webhook_outbox").update({
+                "status": "dead" if dead else "pending",
+                "attempts": attempts,
+                "last_error": error[:500],
+                "next_attempt_at": (now + timedelta(seconds=backoff(attempts))).isoformat()
+            }).eq("id", delivery["id"]).execute()
+            print(f"⚠️ Webhook {delivery['id']} to seller {delivery['user_id']} failed ({error}), attempt {attempts}{', giving up' if dead else ''}")
+        return len(delivered)
+
+    def dispatch_once(self, supabase):
+        """
+        Deliver one batch of due webhooks. Returns the number claimed.
+        """
+        import asyncio
+
+        deliveries = self.claim(supabase)
+        if not deliveries:
+            return 0
+        endpoint_ids = list({delivery["endpoint_id"] for delivery in deliveries})
+        response = (
+            supabase.table("webhook_endpoints")
+            .select("id, url, secret")
+            .in_("id", endpoint_ids)
+            .eq("active", True)
+            .execute()
+        )
+        endpoints = {row["id"]: row for row in response.data or []}
+
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+        results = self.loop.run_until_complete(self.send_all(deliveries, endpoints))
+        delivered = self.record(supabase, results)
+        print(f"🪝 Webhooks: {delivered}/{len(deliveries)} delivered")
+        return len(deliveries)
+
+    def run(self, supabase, interval):
+        while True:
+            try:
+                # Keep going while there is a backlog, otherwise wait for a wake-up
+                if self.dispatch_once(supabase) >= WEBHOOK_BATCH_SIZE:
+                    continue
+            except Exception as e:
+                print("⚠️ Error in webhook dispatcher:", e)
+            self.wakeup.wait(interval)
+            self.wakeup.clear()
+
+    def start(self, supabase, interval=WEBHOOK_POLL_INTERVAL):
+        if interval <= 0:
+            return None
+        thread = threading.Thread(
+            target=self.run,
+            args=(supabase, interval),
+            name="webhook_dispatcher",
+            daemon=True
+        )
+        thread.start()
+        return thread
+
+
+dispatcher = Dispatcher()
+
+
+def start_webhooks(supabase, interval=WEBHOOK_POLL_INTERVAL):
+    return dispatcher.start(supabase, interval)
@@ -0,0 +1,146 @@
+import os
+import time
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+from flask import g, has_request_context
+
+from resilience import BudgetExceeded, DependencyUnavailable, current_deadline, deadline_at
+
+# Write coalescing for the hot conditional updates (claiming an SMS, crediting
+# a payment). Callers submit an item and get a Future; a flusher thread
+# collects items per key (the Supabase client) until WRITE_BATCH_WINDOW has
+# passed since the first one or WRITE_BATCH_SIZE are waiting, then hands the
+# whole batch to the flush function in one call. While a flush is in flight
+# the next batch keeps filling, so under load N concurrent /check-pay requests
+# cost one round trip per table instead of N.
+#
+# flush(key, items) returns one result per item; an Exception in that list
+# fails only that item's future. With WRITE_BATCH_WINDOW=0 every item is
+# flushed on its own, on the caller's thread.
+#
+# A caller that gives up waiting cancels its item if it is still queued; the
+# flusher skips cancelled items, so a timed-out write is never applied behind
+# the caller's back. Once an item's flush has started, write() waits for it.
+#
+# Each item carries its caller's route deadline (resilience.py): items already
+# past it fail with BudgetExceeded, and the rest are flushed under the
+# earliest deadline among them. A DependencyUnavailable raised by the flush
+# is flagged on the caller's request so it is answered 503.
+
+WRITE_BATCH_WINDOW = float(os.environ.get("WRITE_BATCH_WINDOW", 0.005))   # seconds, 0 disables
+WRITE_BATCH_SIZE = int(os.environ.get("WRITE_BATCH_SIZE", 100))
+WRITE_BATCH_TIMEOUT = 30     # seconds a caller waits for its batch
+
+
+class WriteBatcher:
+    def __init__(self, name, flush, window=WRITE_BATCH_WINDOW, max_batch=WRITE_BATCH_SIZE):
+        self.name = name
+        self.flush = flush
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = {}      # key -> [(item, future, deadline)]
+        self.started = {}      # key -> monotonic time its first pending item arrived
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def submit(self, key, item):
+        """
+        Queue one item for the next flush of `key`. Returns its Future.
+        """
+        future = Future()
+        entry = (item, future, current_deadline())
+        if self.window <= 0:
+            self.run_batch(key, [entry])
+            return future
+
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+                self.thread.start()
+            batch = self.pending.setdefault(key, [])
+            if not batch:
+                self.started[key] = time.monotonic()
+            batch.append(entry)
+            if len(batch) == 1 or len(batch) >= self.max_batch:
+                self.cond.notify()
+        return future
+
+    def write(self, key, item, timeout=WRITE_BATCH_TIMEOUT):
+        """
+        submit() and wait: the item's result, or its exception raised here.
+        Raises TimeoutError if the item was still queued after `timeout`
+        seconds; it is then dropped, not written.
+        """
+        future = self.submit(key, item)
+        try:
+            try:
+                return future.result(timeout)
+            except FutureTimeout:
+                if future.cancel():
+                    raise TimeoutError(f"{self.name}: write not started within {timeout}s")
+                # Already being written; its outcome is what the caller must see
+                return future.result()
+        except DependencyUnavailable as e:
+            # Raised on the flusher thread, so guarded() couldn't flag the request
+            if has_request_context():
+                g.unavailable = e
+            raise
+
+    def take_due(self):
+        """
+        Pop the batches that are full or have waited out the window (lock held).
+        Returns them, or the seconds until the next one is due.
+        """
+        now = time.monotonic()
+        due = [
+            key for key, batch in self.pending.items()
+            if len(batch) >= self.max_batch or now - self.started[key] >= self.window
+        ]
+        if not due:
+            return self.window - (now - min(self.started.values()))
+        for key in due:
+            del self.started[key]
+        return [(key, self.pending.pop(key)) for key in due]
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                batches = self.take_due()
+                if not isinstance(batches, list):
+                    self.cond.wait(batches)
+                    continue
+            for key, batch in batches:
+                self.run_batch(key, batch)
+
+    def run_batch(self, key, batch):
+        for start in range(0, len(batch), self.max_batch):
+            # Items cancelled by a caller that stopped waiting are not written
+            chunk = [
+                (item, future, deadline) for item, future, deadline in batch[start:start + self.max_batch]
+                if future.set_running_or_notify_cancel()
+            ]
+            # Nor are items whose caller has run out of time
+            now = time.monotonic()
+            for _, future, deadline in chunk:
+                if deadline is not None and now > deadline:
+                    future.set_exception(BudgetExceeded())
+            chunk = [entry for entry in chunk if not entry[1].done()]
+            if not chunk:
+                continue
+            deadlines = [deadline for _, _, deadline in chunk if deadline is not None]
+            try:
+                with deadline_at(min(deadlines) if deadlines else None):
+                    results = self.flush(key, [item for item, _, _ in chunk])
+            except Exception as e:
+                # The whole write failed (timeout, open breaker): every caller gets it
+                for _, future, _ in chunk:
+                    future.set_exception(e)
+                continue
+            for (_, future, _), result in zip(chunk, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)